@@ -25,7 +25,9 @@ import os
 import logging
 import struct
 import time
-from shadowsocks import shell, eventloop, tcprelay, udprelay, asyncdns, common
+from shadowsocks import shell, eventloop, tcprelay, udprelay, asyncdns, common, replay
+from shadowsocks.crypto import table, backend
+from shadowsocks.obfsplugin import http_simple
 import threading
 import sys
 import traceback
@@ -47,7 +49,12 @@ class ServerPool(object):
 	def __init__(self):
 		shell.check_python()
 		self.config = shell.get_config(False)
-		self.dns_resolver = asyncdns.DNSResolver()
+		table.set_cache_dir(self.config['table_cache_dir'])
+		http_simple.set_header_limit(self.config['http_header_limit'])
+		replay.set_max_clients(self.config['replay_max_clients'])
+		self._cipher_methods = set()
+		self.select_cipher_backend(self.config['method'])
+		self.dns_resolver = asyncdns.DNSResolver(cache_file=self.config['dns_cache_file'])
 		if not self.config.get('dns_ipv6', False):
 			asyncdns.IPV6_CONNECTION_SUPPORT = False
 
@@ -71,6 +78,10 @@ class ServerPool(object):
 
 	def stop(self):
 		self.loop.stop()
+		# the resolver belongs to the loop thread, save it once that ends
+		if self.thread is not threading.current_thread():
+			self.thread.join(eventloop.TIMEOUT_PRECISION * 2)
+		self.dns_resolver.save_snapshot()
 
 	@staticmethod
 	def _loop(loop, dns_resolver, mgr):
@@ -105,10 +116,19 @@ class ServerPool(object):
 				return False
 		return True
 
+	def select_cipher_backend(self, method):
+		# ports come and go with the user list, pick a backend once per method
+		method = common.to_str(method).lower()
+		if not self.config['cipher_autoselect'] or method in self._cipher_methods:
+			return
+		self._cipher_methods.add(method)
+		backend.select_backends([method], self.config['cipher_backend_cache'])
+
 	def new_server(self, port, user_config):
 		ret = True
 		port = int(port)
 		ipv6_ok = False
+		self.select_cipher_backend(user_config.get('method', self.config['method']))
 
 		if 'server_ipv6' in self.config:
 			if port in self.tcp_ipv6_servers_pool:
@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 clowwindy
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import os
+import time
+import logging
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# pressure states, see AdmissionController
+NORMAL = 'normal'
+SOFT = 'soft'
+HARD = 'hard'
+
+# seconds between the summaries logged while under pressure
+ADMISSION_STATS_INTERVAL = 60
+
+# per process lists of open fds, /dev/fd for the BSDs
+FD_DIRS = ('/proc/self/fd', '/dev/fd')
+
+_controllers = {}
+
+
+def get_fd_limit():
+    # soft RLIMIT_NOFILE, None when unknown or unlimited
+    if resource is None:
+        return None
+    try:
+        limit = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+    except (ValueError, OSError):
+        return None
+    if limit == resource.RLIM_INFINITY or limit <= 0:
+        return None
+    return limit
+
+
+def count_open_fds():
+    # fds open in the process, None when it can not be listed
+    for fd_dir in FD_DIRS:
+        try:
+            # listing the directory takes an fd of its own
+            return len(os.listdir(fd_dir)) - 1
+        except OSError:
+            pass
+    return None
+
+
+def get_controller(loop, config):
+    # relays on the same loop share one controller
+    controller = _controllers.get(id(loop))
+    if controller is None:
+        controller = AdmissionController(config)
+        controller.add_to_loop(loop)
+        _controllers[id(loop)] = controller
+    return controller
+
+
+class AdmissionController(object):
+    """Keep the process clear of its fd limit, memory and loop stalls.
+
+    Every period the open sockets and queued bytes of the relays and the
+    longest time the loop took to handle one poll are compared with soft
+    and hard limits. Above a soft limit the busiest ports stop accepting
+    and all reads get smaller, above a hard limit every port accepts and
+    closes new connections right away. The listen ports in priority_users
+    are left alone. Ports shared by the multi-user ids in priority_uids
+    keep accepting and close the other users once they authenticate.
+    """
+
+    def __init__(self, config):
+        fd_limit = get_fd_limit()
+        self.fd_limit = fd_limit
+        self.fd_soft = None
+        self.fd_hard = None
+        if fd_limit:
+            self.fd_soft = int(fd_limit * config.get('admission_fd_soft',
+                                                     0.8))
+            self.fd_hard = int(fd_limit * config.get('admission_fd_hard',
+                                                     0.95))
+        self.buffer_soft = config.get('admission_buffer_soft', 128 << 20)
+        self.buffer_hard = config.get('admission_buffer_hard', 512 << 20)
+        self.lag_soft = config.get('admission_lag_soft', 0.5)
+        self.lag_hard = config.get('admission_lag_hard', 2.0)
+        self.priority_users = set(config.get('priority_users', []))
+        self.state = NORMAL
+        self.fds = 0
+        self.buffer_bytes = 0
+        self.loop_lag = 0
+        self.paused_ports = []
+        self._relays = []
+        self._loop = None
+        self._last_report = 0
+
+    def add_to_loop(self, loop):
+        if self._loop:
+            raise Exception('already add to loop')
+        self._loop = loop
+        loop.add_periodic(self.handle_periodic)
+
+    def add_relay(self, relay):
+        self._relays.append(relay)
+
+    def remove_relay(self, relay):
+        if relay in self._relays:
+            self._relays.remove(relay)
+
+    def is_priority(self, relay):
+        return relay.listen_port() in self.priority_users
+
+    def open_fds(self):
+        # the whole process counts, UDP, DNS and the crypto pool included.
+        # Without a fd list only the TCP relays are seen
+        fds = count_open_fds()
+        if fds is None:
+            fds = 0
+            for relay in self._relays:
+                fds += relay.open_fds()
+        return fds
+
+    def get_state(self, fds, buffer_bytes, loop_lag):
+        if (self.fd_hard and fds >= self.fd_hard) or \
+                buffer_bytes >= self.buffer_hard or loop_lag >= self.lag_hard:
+            return HARD
+        if (self.fd_soft and fds >= self.fd_soft) or \
+                buffer_bytes >= self.buffer_soft or loop_lag >= self.lag_soft:
+            return SOFT
+        return NORMAL
+
+    def handle_periodic(self):
+        if self._loop is not None:
+            self.loop_lag = self._loop.dispatch_lag()
+        self.fds = self.open_fds()
+        self.buffer_bytes = 0
+        for relay in self._relays:
+            self.buffer_bytes += relay.pending_bytes()
+        state = self.get_state(self.fds, self.buffer_bytes, self.loop_lag)
+        if state != self.state:
+            logging.warn('admission: %s -> %s, %d fds of %s, %d bytes '
+                         'queued, loop lag %.2fs' % (
+                             self.state, state, self.fds, self.fd_limit,
+                             self.buffer_bytes, self.loop_lag))
+            self.state = state
+            self._last_report = time.time()
+        self.apply()
+        now = time.time()
+        if self.state != NORMAL and \
+                now - self._last_report >= ADMISSION_STATS_INTERVAL:
+            self._last_report = now
+            stats = self.get_stats()
+            logging.warn('admission: %s, paused ports %s, %d connections '
+                         'rejected' % (self.state, stats['paused_ports'],
+                                       stats['rejected']))
+
+    def apply(self):
+        # the busiest ports stop accepting under soft pressure, the ones
+        # with at least the average connection count
+        busy = [relay for relay in self._relays
+                if not self.is_priority(relay) and
+                not relay.has_priority_uids()]
+        paused = []
+        if self.state == SOFT and busy:
+            average = sum(relay.server_connections
+                          for relay in busy) / len(busy)
+            paused = [relay for relay in busy
+                      if relay.server_connections >= average]
+        self.paused_ports = [relay.listen_port() for relay in paused]
+        for relay in self._relays:
+            priority = self.is_priority(relay)
+            relay.set_pressure(self.state != NORMAL and not priority,
+                               relay in paused,
+                               self.state == HARD and not priority)
+
+    def get_stats(self):
+        rejected = 0
+        for relay in self._relays:
+            rejected += relay.rejected_connections
+        return {'state': self.state, 'fds': self.fds,
+                'fd_limit': self.fd_limit, 'buffer_bytes': self.buffer_bytes,
+                'loop_lag': self.loop_lag,
+                'paused_ports': list(self.paused_ports),
+                'rejected': rejected}
+
+
+class _Relay(object):
+    def __init__(self, port, connections, priority_uids=False):
+        self.port = port
+        self.priority_uids = priority_uids
+        self.server_connections = connections
+        self.fds = connections * 2
+        self.rejected_connections = 0
+        self.pressure = None
+
+    def listen_port(self):
+        return self.port
+
+    def has_priority_uids(self):
+        return self.priority_uids
+
+    def open_fds(self):
+        return self.fds
+
+    def pending_bytes(self):
+        return 0
+
+    def set_pressure(self, shed, pause_accept, reject):
+        self.pressure = (shed, pause_accept, reject)
+
+
+class _Loop(object):
+    def __init__(self):
+        self.lag = 0
+
+    def add_periodic(self, callback):
+        pass
+
+    def dispatch_lag(self):
+        return self.lag
+
+
+def test_count_open_fds():
+    fds = count_open_fds()
+    if fds is not None:
+        r, w = os.pipe()
+        assert count_open_fds() == fds + 2
+        os.close(r)
+        os.close(w)
+
+
+def test_admission():
+    controller = AdmissionController({'priority_users': [8003]})
+    loop = _Loop()
+    controller.add_to_loop(loop)
+    controller.fd_limit = 2000
+    controller.fd_soft = 1600
+    controller.fd_hard = 1900
+    relays = [_Relay(8001, 300), _Relay(8002, 50), _Relay(8003, 100)]
+    controller.open_fds = lambda: sum(relay.fds for relay in relays)
+    for relay in relays:
+        controller.add_relay(relay)
+    controller.handle_periodic()
+    assert controller.state == NORMAL
+    assert relays[0].pressure == (False, False, False)
+    # the busiest port stops accepting, the priority one keeps going
+    relays[0].fds = 1360
+    controller.handle_periodic()
+    assert controller.state == SOFT
+    assert controller.get_stats()['paused_ports'] == [8001]
+    assert relays[0].pressure == (True, True, False)
+    assert relays[1].pressure == (True, False, False)
+    assert relays[2].pressure == (False, False, False)
+    relays[1].fds = 400
+    controller.handle_periodic()
+    assert controller.state == HARD
+    assert relays[0].pressure == (True, False, True)
+    assert relays[2].pressure == (False, False, False)
+    relays[0].fds = 100
+    controller.handle_periodic()
+    assert controller.state == NORMAL
+    assert controller.get_stats()['paused_ports'] == []
+    # a slow poll sheds load, the next quick one ends it
+    loop.lag = 0.6
+    controller.handle_periodic()
+    assert controller.state == SOFT
+    loop.lag = 0.01
+    controller.handle_periodic()
+    assert controller.state == NORMAL
+    # a multi-user port with priority uids keeps accepting
+    relays.append(_Relay(8004, 1000, True))
+    relays[3].fds = 0
+    controller.add_relay(relays[3])
+    relays[0].fds = 1360
+    relays[1].fds = 100
+    controller.handle_periodic()
+    assert controller.state == SOFT
+    assert controller.get_stats()['paused_ports'] == [8001]
+    assert relays[3].pressure == (True, False, False)
+
+
+if __name__ == '__main__':
+    test_count_open_fds()
+    test_admission()
@@ -21,7 +21,10 @@ from __future__ import absolute_import, division, print_function, \
 import os
 import socket
 import struct
+import errno
 import re
+import time
+import mmap
 import logging
 
 if __name__ == '__main__':
@@ -31,10 +34,43 @@ if __name__ == '__main__':
     file_path = os.path.dirname(os.path.realpath(inspect.getfile(inspect.currentframe())))
     sys.path.insert(0, os.path.join(file_path, '../'))
 
-from shadowsocks import common, lru_cache, eventloop, shell
+from shadowsocks import common, lru_cache, eventloop
 
 CACHE_SWEEP_INTERVAL = 30
 
+# positive answers are kept for the record TTL clamped to [MIN, MAX],
+# negative answers (rfc2308) for the SOA minimum clamped to NEGATIVE_MAX
+DNS_CACHE_SIZE = 4096
+DNS_MIN_TTL = 60
+DNS_MAX_TTL = 3600
+DNS_NEGATIVE_TTL = 60
+DNS_NEGATIVE_MAX_TTL = 300
+# a hit in the last 10% of the TTL refreshes the entry in the background
+DNS_PREFETCH_RATIO = 0.1
+
+# snapshot: magic, then per entry expire, ttl, name length, packed address
+# length (0 for a negative answer), name, packed address
+DNS_SNAPSHOT_MAGIC = b'SSRDNS\x00\x01'
+DNS_SNAPSHOT_ENTRY = '!IIBB'
+DNS_SNAPSHOT_INTERVAL = 300
+
+# EDNS0 payload size advertised over UDP, the dns flag day 2020 value.
+# a truncated answer is asked again over TCP, reusing one pipelined
+# connection per server (rfc7766) until it is idle for a while
+DNS_EDNS_PAYLOAD = 1232
+DNS_UDP_RECV_SIZE = 4096
+DNS_TCP_IDLE_TIMEOUT = 10
+
+# a query is sent to the fastest server first, then retransmitted to the
+# next one with exponential backoff; all sends stay valid and the first
+# answer wins. timers are checked from handle_periodic
+DNS_QUERY_TIMEOUT = 8
+DNS_RETRY_MIN = 1
+DNS_RETRY_MAX = 4
+DNS_RTT_INITIAL = 0.5
+DNS_RTT_MAX = 5
+DNS_RTT_ALPHA = 0.25
+
 VALID_HOSTNAME = re.compile(br"(?!-)[A-Z\d_-]{1,63}(?<!-)$", re.IGNORECASE)
 
 common.patch_socket()
@@ -75,8 +111,14 @@ QTYPE_A = 1
 QTYPE_AAAA = 28
 QTYPE_CNAME = 5
 QTYPE_NS = 2
+QTYPE_SOA = 6
+QTYPE_OPT = 41
 QCLASS_IN = 1
 
+RCODE_NOERROR = 0
+RCODE_FORMERR = 1
+RCODE_NXDOMAIN = 3
+
 
 def detect_ipv6_supprot():
     if 'has_ipv6' in dir(socket):
@@ -108,163 +150,148 @@ def build_address(address):
     return b''.join(results)
 
 
-def build_request(address, qtype):
-    request_id = os.urandom(2)
-    header = struct.pack('!BBHHHH', 1, 0, 1, 0, 0, 0)
+def build_request(address, qtype, request_id=None, payload_size=0):
+    if request_id is None:
+        request_id = os.urandom(2)
+    else:
+        request_id = struct.pack('!H', request_id)
+    header = struct.pack('!BBHHHH', 1, 0, 1, 0, 0, 1 if payload_size else 0)
     addr = build_address(address)
     qtype_qclass = struct.pack('!HH', qtype, QCLASS_IN)
+    if payload_size:
+        # rfc6891 OPT pseudo record: root name, the payload size as class
+        opt = b'\x00' + struct.pack('!HHIH', QTYPE_OPT, payload_size, 0, 0)
+        return request_id + header + addr + qtype_qclass + opt
     return request_id + header + addr + qtype_qclass
 
 
-def parse_ip(addrtype, data, length, offset):
-    if addrtype == QTYPE_A:
-        return socket.inet_ntop(socket.AF_INET, data[offset:offset + length])
-    elif addrtype == QTYPE_AAAA:
-        return socket.inet_ntop(socket.AF_INET6, data[offset:offset + length])
-    elif addrtype in [QTYPE_CNAME, QTYPE_NS]:
-        return parse_name(data, offset)[1]
-    else:
-        return data[offset:offset + length]
+# a name is at most 255 bytes, so a longer pointer chain must be a loop
+MAX_NAME_POINTERS = 127
+MAX_NAME_LENGTH = 255
 
 
-def parse_name(data, offset):
-    p = offset
+def byte_view(data):
+    if bytes is str:
+        # python 2 memoryview items are str, bytearray items are int
+        return bytearray(data)
+    return memoryview(data)
+
+
+def read_name(view, offset):
+    """Decompress the name at offset without recursion.
+    return the offset just past the name and the list of its labels"""
+    length = len(view)
     labels = []
-    l = common.ord(data[p])
-    while l > 0:
-        if (l & (128 + 64)) == (128 + 64):
-            # pointer
-            pointer = struct.unpack('!H', data[p:p + 2])[0]
-            pointer &= 0x3FFF
-            r = parse_name(data, pointer)
-            labels.append(r[1])
-            p += 2
-            # pointer is the end
-            return p - offset, b'.'.join(labels)
-        else:
-            labels.append(data[p + 1:p + 1 + l])
-            p += 1 + l
-        l = common.ord(data[p])
-    return p - offset + 1, b'.'.join(labels)
+    name_length = 0
+    end = None
+    pointers = 0
+    p = offset
+    while True:
+        if p >= length:
+            raise Exception('name out of range')
+        l = view[p]
+        if l == 0:
+            break
+        if (l & 0xC0) == 0xC0:
+            if p + 1 >= length:
+                raise Exception('name out of range')
+            if end is None:
+                end = p + 2
+            pointers += 1
+            pointer = ((l & 0x3F) << 8) | view[p + 1]
+            # a pointer must go backwards, so decompression always ends
+            if pointers > MAX_NAME_POINTERS or pointer >= p:
+                raise Exception('bad name pointer')
+            p = pointer
+            continue
+        if l & 0xC0:
+            raise Exception('bad label type')
+        name_length += l + 1
+        if p + 1 + l > length or name_length > MAX_NAME_LENGTH:
+            raise Exception('name too long')
+        labels.append(bytes(view[p + 1:p + 1 + l]))
+        p += 1 + l
+    if end is None:
+        end = p + 1
+    return end, labels
 
 
-# rfc1035
-# record
-#                                    1  1  1  1  1  1
-#      0  1  2  3  4  5  6  7  8  9  0  1  2  3  4  5
-#    +--+--+--+--+--+--+--+--+--+--+--+--+--+--+--+--+
-#    |                                               |
-#    /                                               /
-#    /                      NAME                     /
-#    |                                               |
-#    +--+--+--+--+--+--+--+--+--+--+--+--+--+--+--+--+
-#    |                      TYPE                     |
-#    +--+--+--+--+--+--+--+--+--+--+--+--+--+--+--+--+
-#    |                     CLASS                     |
-#    +--+--+--+--+--+--+--+--+--+--+--+--+--+--+--+--+
-#    |                      TTL                      |
-#    |                                               |
-#    +--+--+--+--+--+--+--+--+--+--+--+--+--+--+--+--+
-#    |                   RDLENGTH                    |
-#    +--+--+--+--+--+--+--+--+--+--+--+--+--+--+--+--|
-#    /                     RDATA                     /
-#    /                                               /
-#    +--+--+--+--+--+--+--+--+--+--+--+--+--+--+--+--+
-def parse_record(data, offset, question=False):
-    nlen, name = parse_name(data, offset)
-    if not question:
-        record_type, record_class, record_ttl, record_rdlength = struct.unpack(
-            '!HHiH', data[offset + nlen:offset + nlen + 10]
-        )
-        ip = parse_ip(record_type, data, record_rdlength, offset + nlen + 10)
-        return nlen + 10 + record_rdlength, \
-               (name, ip, record_type, record_class, record_ttl)
-    else:
-        record_type, record_class = struct.unpack(
-            '!HH', data[offset + nlen:offset + nlen + 4]
-        )
-        return nlen + 4, (name, None, record_type, record_class, None, None)
-
-
-def parse_header(data):
-    if len(data) >= 12:
-        header = struct.unpack('!HBBHHHH', data[:12])
-        res_id = header[0]
-        res_qr = header[1] & 128
-        res_tc = header[1] & 2
-        res_ra = header[2] & 128
-        res_rcode = header[2] & 15
-        # assert res_tc == 0
-        # assert res_rcode in [0, 3]
-        res_qdcount = header[3]
-        res_ancount = header[4]
-        res_nscount = header[5]
-        res_arcount = header[6]
-        return (res_id, res_qr, res_tc, res_ra, res_rcode, res_qdcount,
-                res_ancount, res_nscount, res_arcount)
-    return None
-
-
-def parse_response1(data):
+def skip_name(view, offset):
+    # owner names of the records are not needed, so pointers are not followed
+    length = len(view)
+    p = offset
+    while p < length:
+        l = view[p]
+        if l == 0:
+            return p + 1
+        if (l & 0xC0) == 0xC0:
+            return p + 2
+        if l & 0xC0:
+            raise Exception('bad label type')
+        p += 1 + l
+    raise Exception('name out of range')
+
+
+def parse_name(data, offset):
+    end, labels = read_name(byte_view(data), offset)
+    return end - offset, b'.'.join(labels)
+
+
+def parse_response(data):
+    """Parse the question and every A/AAAA answer with its TTL.
+    CNAME answers are kept without address for their TTL, the SOA in
+    the authority section gives the negative TTL, other records are
+    skipped. return None if data is not a valid response"""
     try:
-        if len(data) >= 12:
-            header = parse_header(data)
-            if not header:
+        view = byte_view(data)
+        length = len(view)
+        if length < 12:
+            return None
+        res_id, flags, res_qdcount, res_ancount, res_nscount, res_arcount = \
+            struct.unpack_from('!HHHHHH', view, 0)
+        response = DNSResponse()
+        response.rcode = flags & 15
+        offset = 12
+        for i in range(res_qdcount):
+            offset, labels = read_name(view, offset)
+            qtype, qclass = struct.unpack_from('!HH', view, offset)
+            offset += 4
+            if i == 0:
+                response.hostname = b'.'.join(labels)
+            response.questions.append((None, qtype, qclass))
+        answers = response.answers
+        for i in range(res_ancount + res_nscount):
+            offset = skip_name(view, offset)
+            rtype, rclass, ttl, rdlength = \
+                struct.unpack_from('!HHIH', view, offset)
+            offset += 10
+            if offset + rdlength > length:
                 return None
-            res_id, res_qr, res_tc, res_ra, res_rcode, res_qdcount, \
-            res_ancount, res_nscount, res_arcount = header
-
-            qds = []
-            ans = []
-            offset = 12
-            for i in range(0, res_qdcount):
-                l, r = parse_record(data, offset, True)
-                offset += l
-                if r:
-                    qds.append(r)
-            for i in range(0, res_ancount):
-                l, r = parse_record(data, offset)
-                offset += l
-                if r:
-                    ans.append(r)
-            for i in range(0, res_nscount):
-                l, r = parse_record(data, offset)
-                offset += l
-            for i in range(0, res_arcount):
-                l, r = parse_record(data, offset)
-                offset += l
-            response = DNSResponse()
-            if qds:
-                response.hostname = qds[0][0]
-            for an in qds:
-                response.questions.append((an[1], an[2], an[3]))
-            for an in ans:
-                response.answers.append((an[1], an[2], an[3]))
-            return response
+            if ttl > 0x7FFFFFFF:
+                # rfc2181 section 8
+                ttl = 0
+            if i < res_ancount:
+                if rtype == QTYPE_A and rdlength == 4:
+                    answers.append(('%d.%d.%d.%d' % struct.unpack_from(
+                        '!BBBB', view, offset), rtype, rclass, ttl))
+                elif rtype == QTYPE_AAAA and rdlength == 16:
+                    answers.append((socket.inet_ntop(
+                        socket.AF_INET6, bytes(view[offset:offset + 16])),
+                        rtype, rclass, ttl))
+                elif rtype == QTYPE_CNAME:
+                    answers.append((None, rtype, rclass, ttl))
+            elif rtype == QTYPE_SOA and response.negative_ttl is None \
+                    and rdlength >= 22:
+                # rfc2308 section 5: min(SOA TTL, SOA MINIMUM)
+                minimum = struct.unpack_from('!I', view,
+                                             offset + rdlength - 4)[0]
+                response.negative_ttl = min(ttl, minimum)
+            offset += rdlength
+        return response
     except Exception as e:
-        shell.print_exception(e)
+        logging.debug('bad dns response: %s' % (e,))
         return None
 
-def parse_response(data):
-    start = 12
-    end = data.find(b'\x00', 12)
-    domain = b''
-    while start < end:
-        offset = data[start]
-        start = start + 1
-        domain = domain + data[start:start + offset] + b'.'
-        start = start + offset
-    response_code = data[end+2]
-    ip = None
-    if response_code == 1:
-        ip = data[-4:]
-        ip = [ str(x) for x in ip ]
-        ip = '.'.join(ip)
-    response = DNSResponse()
-    response.hostname = domain[0:-1]
-    response.questions.append((None, 1, 1))
-    response.answers.append((ip, 1, 1))
-    return response
 
 def is_valid_hostname(hostname):
     if len(hostname) > 255:
@@ -277,8 +304,10 @@ def is_valid_hostname(hostname):
 class DNSResponse(object):
     def __init__(self):
         self.hostname = None
+        self.rcode = RCODE_NOERROR
+        self.negative_ttl = None
         self.questions = []  # each: (addr, type, class)
-        self.answers = []  # each: (addr, type, class)
+        self.answers = []  # each: (addr, type, class, ttl)
 
     def __str__(self):
         return '%s: %s' % (self.hostname, str(self.answers))
@@ -288,14 +317,275 @@ STATUS_IPV4 = 0
 STATUS_IPV6 = 1
 
 
+class DNSCache(object):
+    """TTL aware LRU cache of hostname -> ip, ip is None for a negative
+    answer. This class is not thread safe"""
+
+    def __init__(self, size=DNS_CACHE_SIZE):
+        self.size = size
+        # hostname -> [ip, expire, ttl, prefetching], oldest access first
+        self._entries = lru_cache.OrderedDict()
+        self.dirty = False
+
+    def __contains__(self, hostname):
+        return self.get(hostname) is not None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, hostname, now=None):
+        entry = self._entries.get(hostname)
+        if entry is None:
+            return None
+        if now is None:
+            now = time.time()
+        del self._entries[hostname]
+        if entry[1] <= now:
+            return None
+        self._entries[hostname] = entry
+        return entry
+
+    def need_prefetch(self, entry, now=None):
+        if entry[0] is None or entry[3]:
+            return False
+        if now is None:
+            now = time.time()
+        return entry[1] - now <= entry[2] * DNS_PREFETCH_RATIO
+
+    def put(self, hostname, ip, ttl=None, now=None):
+        if now is None:
+            now = time.time()
+        if ip is None:
+            if ttl is None:
+                ttl = DNS_NEGATIVE_TTL
+            ttl = max(0, min(ttl, DNS_NEGATIVE_MAX_TTL))
+        else:
+            if ttl is None:
+                ttl = DNS_MIN_TTL
+            ttl = max(DNS_MIN_TTL, min(ttl, DNS_MAX_TTL))
+        if hostname in self._entries:
+            del self._entries[hostname]
+        self._entries[hostname] = [ip, now + ttl, ttl, False]
+        self.dirty = True
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def dump(self, path, now=None):
+        if now is None:
+            now = time.time()
+        records = [DNS_SNAPSHOT_MAGIC]
+        for hostname, entry in self._entries.items():
+            ip, expire = entry[0], entry[1]
+            if expire <= now or len(hostname) > 255:
+                continue
+            if ip is None:
+                packed = b''
+            else:
+                packed = socket.inet_pton(common.is_ip(ip), common.to_str(ip))
+            records.append(struct.pack(DNS_SNAPSHOT_ENTRY, int(expire),
+                                       entry[2], len(hostname), len(packed)))
+            records.append(hostname)
+            records.append(packed)
+        # write aside and rename, a crash never leaves a partial snapshot
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(b''.join(records))
+            f.flush()
+            os.fsync(f.fileno())
+        getattr(os, 'replace', os.rename)(tmp_path, path)
+        self.dirty = False
+        return len(records) // 3
+
+    def load(self, path, now=None):
+        if now is None:
+            now = time.time()
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < len(DNS_SNAPSHOT_MAGIC):
+                return 0
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if data[:len(DNS_SNAPSHOT_MAGIC)] != DNS_SNAPSHOT_MAGIC:
+                raise Exception('bad dns snapshot %s' % path)
+            offset = len(DNS_SNAPSHOT_MAGIC)
+            entry_size = struct.calcsize(DNS_SNAPSHOT_ENTRY)
+            count = 0
+            while offset + entry_size <= size:
+                expire, ttl, name_len, ip_len = struct.unpack_from(
+                    DNS_SNAPSHOT_ENTRY, data, offset)
+                offset += entry_size
+                if offset + name_len + ip_len > size:
+                    raise Exception('truncated dns snapshot %s' % path)
+                hostname = data[offset:offset + name_len]
+                packed = data[offset + name_len:offset + name_len + ip_len]
+                offset += name_len + ip_len
+                if expire <= now or hostname in self._entries:
+                    continue
+                if ip_len == 4:
+                    ip = socket.inet_ntop(socket.AF_INET, packed)
+                elif ip_len == 16:
+                    ip = socket.inet_ntop(socket.AF_INET6, packed)
+                elif ip_len == 0:
+                    ip = None
+                else:
+                    raise Exception('bad dns snapshot %s' % path)
+                self._entries[hostname] = [ip, expire, ttl, False]
+                count += 1
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+            return count
+        finally:
+            data.close()
+
+    def sweep(self, now=None):
+        if now is None:
+            now = time.time()
+        expired = [hostname for hostname, entry in self._entries.items()
+                   if entry[1] <= now]
+        for hostname in expired:
+            del self._entries[hostname]
+        if expired:
+            logging.debug('%d dns entries swept' % len(expired))
+        return len(expired)
+
+
+class DNSQuery(object):
+    def __init__(self, hostname, qtype, request_id, req, servers):
+        self.hostname = hostname
+        self.qtype = qtype
+        self.request_id = request_id
+        self.req = req
+        self.servers = servers  # ranked, fastest first
+        self.sent = {}  # server -> [last send time, send count]
+        self.tries = 0
+        self.start = time.time()
+        self.next_send = self.start
+        self.payload_size = 0
+        self.tcp = False
+
+
+class DNSTCPConnection(object):
+    """Queries pipelined on one TCP connection to a server, each message
+    prefixed with its 2 bytes length"""
+
+    def __init__(self, resolver, server, loop):
+        self._resolver = resolver
+        self._loop = loop
+        self.server = server
+        self.request_ids = set()
+        self.last_active = time.time()
+        self._connected = False
+        self._data_to_write = []
+        self._data_to_read = b''
+        self._sock = socket.socket(common.is_ip(server[0]), socket.SOCK_STREAM,
+                                   socket.SOL_TCP)
+        self._sock.setblocking(False)
+        self._sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
+        try:
+            self._sock.connect(server)
+        except (OSError, IOError) as e:
+            if eventloop.errno_from_exception(e) not in \
+                    (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN):
+                self._sock.close()
+                raise
+        self._mode = eventloop.POLL_OUT | eventloop.POLL_ERR
+        loop.add(self._sock, self._mode, self)
+
+    def send(self, request_id, req):
+        self.request_ids.add(request_id)
+        self.last_active = time.time()
+        self._data_to_write.append(struct.pack('!H', len(req)) + req)
+        if self._connected:
+            self._flush()
+
+    def _update_mode(self, mode):
+        if mode != self._mode:
+            self._mode = mode
+            self._loop.modify(self._sock, mode)
+
+    def _flush(self):
+        data = b''.join(self._data_to_write)
+        self._data_to_write = []
+        try:
+            sent = self._sock.send(data)
+        except (OSError, IOError) as e:
+            if eventloop.errno_from_exception(e) not in \
+                    (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINPROGRESS):
+                raise
+            sent = 0
+        if sent < len(data):
+            self._data_to_write.append(data[sent:])
+            self._update_mode(eventloop.POLL_IN | eventloop.POLL_OUT |
+                              eventloop.POLL_ERR)
+        else:
+            self._update_mode(eventloop.POLL_IN | eventloop.POLL_ERR)
+
+    def _on_read(self):
+        try:
+            data = self._sock.recv(DNS_UDP_RECV_SIZE)
+        except (OSError, IOError) as e:
+            if eventloop.errno_from_exception(e) in \
+                    (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise
+        if not data:
+            self.close()
+            return
+        self.last_active = time.time()
+        self._data_to_read += data
+        while len(self._data_to_read) >= 2:
+            length = struct.unpack('!H', self._data_to_read[:2])[0]
+            if len(self._data_to_read) < 2 + length:
+                break
+            message = self._data_to_read[2:2 + length]
+            self._data_to_read = self._data_to_read[2 + length:]
+            if length >= 2:
+                self.request_ids.discard(struct.unpack('!H', message[:2])[0])
+            self._resolver._handle_response(message, self.server)
+
+    def handle_event(self, sock, fd, event):
+        if self._sock is None:
+            return
+        try:
+            if event & eventloop.POLL_ERR:
+                raise Exception('dns tcp connection to %s failed' %
+                                (self.server,))
+            if event & eventloop.POLL_OUT:
+                self._connected = True
+                self._flush()
+            if event & (eventloop.POLL_IN | eventloop.POLL_HUP):
+                self._on_read()
+        except Exception as e:
+            logging.warn('dns over tcp %s: %s' % (self.server, e))
+            self.close()
+        self._resolver._check_queries_due()
+
+    def close(self):
+        if self._sock is None:
+            return
+        self._loop.remove(self._sock)
+        self._sock.close()
+        self._sock = None
+        self._resolver._remove_tcp_connection(self)
+
+
 class DNSResolver(object):
-    def __init__(self, black_hostname_list=None, config=None):
+    def __init__(self, black_hostname_list=None, config=None,
+                 cache_file=None):
         self._loop = None
         self._hosts = {}
         self._hostname_status = {}
         self._hostname_to_cb = {}
         self._cb_to_hostname = {}
-        self._cache = lru_cache.LRUCache(timeout=3600)
+        self._cache = DNSCache()
+        self._cache_file = cache_file
+        self._last_snapshot_time = time.time()
+        self._queries = {}  # request id -> DNSQuery
+        self._hostname_to_query = {}
+        self._server_rtt = {}
+        # when _check_queries has work next, see _check_queries_due
+        self._next_check = 0
+        self._last_sweep_time = time.time()
         # read black_hostname_list from config
         if type(black_hostname_list) != list:
             self._black_hostname_list = []
@@ -306,9 +596,12 @@ class DNSResolver(object):
             ))
         logging.info('black_hostname_list init as : ' + str(self._black_hostname_list))
         self._sock = None
+        self._sock6 = None
+        self._tcp_conns = {}  # server -> DNSTCPConnection
         self._servers = None
         self._parse_resolv()
         self._parse_hosts()
+        self._load_snapshot()
         if config is not None:
             self._resolve_sync(config['server'].encode())
         # TODO monitor hosts change and reload hosts
@@ -329,10 +622,7 @@ class DNSResolver(object):
                         else:
                             server = parts[0]
                             port = 53
-                        if common.is_ip(server) == socket.AF_INET:
-                            if type(server) != str:
-                                server = server.decode('utf8')
-                            self._servers.append((server, port))
+                        self._add_server(server, port)
         except IOError:
             pass
         if not self._servers:
@@ -346,16 +636,47 @@ class DNSResolver(object):
                                 parts = line.split()
                                 if len(parts) >= 2:
                                     server = parts[1]
-                                    if common.is_ip(server) == socket.AF_INET:
-                                        if type(server) != str:
-                                            server = server.decode('utf8')
-                                        self._servers.append((server, 53))
+                                    self._add_server(server, 53)
             except IOError:
                 pass
         if not self._servers:
             self._servers = [('8.8.4.4', 53), ('8.8.8.8', 53)]
+        for server in self._servers:
+            self._server_rtt[server] = DNS_RTT_INITIAL
         logging.info('dns server: %s' % (self._servers,))
 
+    def _add_server(self, server, port):
+        family = common.is_ip(server)
+        if not family:
+            return
+        server = common.to_str(server)
+        if family == socket.AF_INET6:
+            # recvfrom reports the canonical form
+            server = socket.inet_ntop(family, socket.inet_pton(family, server))
+        self._servers.append((server, port))
+
+    def _load_snapshot(self):
+        if not self._cache_file or not os.path.exists(self._cache_file):
+            return
+        try:
+            count = self._cache.load(self._cache_file)
+            logging.info('loaded %d dns cache entries from %s' %
+                         (count, self._cache_file))
+        except Exception as e:
+            logging.warn('failed to load dns cache %s: %s' %
+                         (self._cache_file, e))
+
+    def save_snapshot(self):
+        if not self._cache_file or not self._cache.dirty:
+            return
+        try:
+            count = self._cache.dump(self._cache_file)
+            logging.debug('saved %d dns cache entries to %s' %
+                          (count, self._cache_file))
+        except Exception as e:
+            logging.warn('failed to save dns cache %s: %s' %
+                         (self._cache_file, e))
+
     def _parse_hosts(self):
         etc_path = '/etc/hosts'
         if 'WINDIR' in os.environ:
@@ -378,31 +699,46 @@ class DNSResolver(object):
             self._hosts['localhost'] = '127.0.0.1'
 
     def _resolve_sync (self, hostname):
-        if self._sock is None:
-            self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
-                            socket.SOL_UDP)
-            self._sock.setblocking(True)
-        if IPV6_CONNECTION_SUPPORT:
-            self._hostname_status[hostname] = STATUS_IPV6
-            self._send_req(hostname, QTYPE_AAAA)
-        else:
-            self._hostname_status[hostname] = STATUS_IPV4
-            self._send_req(hostname, QTYPE_A)
-        data, addr = self._sock.recvfrom(1024)
-        if addr not in self._servers:
-            logging.warn('received a packet other than our dns')
+        self._send_first_req(hostname)
+        query = self._hostname_to_query.get(hostname)
+        if query is None:
             return
-        self._handle_data(data)
+        sock = self._get_udp_socket(common.is_ip(query.servers[0][0]))
+        data, addr = sock.recvfrom(DNS_UDP_RECV_SIZE)
+        self._handle_response(data, addr)
+
+    def _get_udp_socket(self, family):
+        sock = self._sock6 if family == socket.AF_INET6 else self._sock
+        if sock is None:
+            sock = socket.socket(family, socket.SOCK_DGRAM, socket.SOL_UDP)
+            if self._loop:
+                sock.setblocking(False)
+                self._loop.add(sock, eventloop.POLL_IN, self)
+            else:
+                sock.setblocking(True)
+            if family == socket.AF_INET6:
+                self._sock6 = sock
+            else:
+                self._sock = sock
+        return sock
+
+    def _close_udp_sockets(self):
+        for sock in (self._sock, self._sock6):
+            if sock:
+                if self._loop:
+                    self._loop.remove(sock)
+                sock.close()
+        self._sock = None
+        self._sock6 = None
 
     def add_to_loop(self, loop):
         if self._loop:
             raise Exception('already add to loop')
+        # the sockets used by _resolve_sync are blocking
+        self._close_udp_sockets()
         self._loop = loop
-        # TODO when dns server is IPv6
-        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
-                                   socket.SOL_UDP)
-        self._sock.setblocking(False)
-        loop.add(self._sock, eventloop.POLL_IN, self)
+        for family in set(common.is_ip(server[0]) for server in self._servers):
+            self._get_udp_socket(family)
         loop.add_periodic(self.handle_periodic)
 
     def _call_callback(self, hostname, ip, error=None):
@@ -420,16 +756,25 @@ class DNSResolver(object):
         if hostname in self._hostname_status:
             del self._hostname_status[hostname]
 
+    def _cache_negative(self, hostname, response):
+        # rfc2308: only NXDOMAIN and NODATA are cacheable failures
+        if response.rcode in (RCODE_NOERROR, RCODE_NXDOMAIN):
+            self._cache.put(hostname, None, response.negative_ttl)
+
     def _handle_data(self, data):
         response = parse_response(data)
         if response and response.hostname:
             hostname = response.hostname
             ip = None
+            ttl = None
             for answer in response.answers:
                 if answer[1] in (QTYPE_A, QTYPE_AAAA) and \
                                 answer[2] == QCLASS_IN:
                     ip = answer[0]
                     break
+            if ip:
+                # the CNAME chain expires with its shortest lived record
+                ttl = min(answer[3] for answer in response.answers)
             if IPV6_CONNECTION_SUPPORT:
                 if not ip and self._hostname_status.get(hostname, STATUS_IPV4) \
                         == STATUS_IPV6:
@@ -437,11 +782,12 @@ class DNSResolver(object):
                     self._send_req(hostname, QTYPE_A)
                 else:
                     if ip:
-                        self._cache[hostname] = ip
+                        self._cache.put(hostname, ip, ttl)
                         self._call_callback(hostname, ip)
                     elif self._hostname_status.get(hostname, None) == STATUS_IPV4:
                         for question in response.questions:
                             if question[1] == QTYPE_A:
+                                self._cache_negative(hostname, response)
                                 self._call_callback(hostname, None)
                                 break
             else:
@@ -451,35 +797,169 @@ class DNSResolver(object):
                     self._send_req(hostname, QTYPE_AAAA)
                 else:
                     if ip:
-                        self._cache[hostname] = ip
+                        self._cache.put(hostname, ip, ttl)
                         self._call_callback(hostname, ip)
                     elif self._hostname_status.get(hostname, None) == STATUS_IPV6:
                         for question in response.questions:
                             if question[1] == QTYPE_AAAA:
+                                self._cache_negative(hostname, response)
                                 self._call_callback(hostname, None)
                                 break
 
     def handle_event(self, sock, fd, event):
-        if sock != self._sock:
+        if sock != self._sock and sock != self._sock6:
             return
         if event & eventloop.POLL_ERR:
             logging.error('dns socket err')
-            self._loop.remove(self._sock)
-            self._sock.close()
-            # TODO when dns server is IPv6
-            self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
-                                       socket.SOL_UDP)
-            self._sock.setblocking(False)
-            self._loop.add(self._sock, eventloop.POLL_IN, self)
+            family = sock.family
+            self._loop.remove(sock)
+            sock.close()
+            if sock == self._sock6:
+                self._sock6 = None
+            else:
+                self._sock = None
+            self._get_udp_socket(family)
         else:
-            data, addr = sock.recvfrom(1024)
+            data, addr = sock.recvfrom(DNS_UDP_RECV_SIZE)
+            self._handle_response(data, addr)
+        self._check_queries_due()
+
+    def _handle_response(self, data, addr):
+        if len(data) < 12:
+            return
+        # IPv6 addresses come with flow info and scope id
+        addr = addr[:2]
+        request_id, flags = struct.unpack('!HH', data[:4])
+        query = self._queries.get(request_id)
+        if query is None or addr not in query.sent:
             if addr not in self._servers:
                 logging.warn('received a packet other than our dns')
-                return
-            self._handle_data(data)
+            else:
+                logging.debug('drop a late or unknown dns response %d',
+                              request_id)
+            return
+        if flags & 0x200 and not query.tcp and self._loop:
+            # truncated, ask the same server again over TCP
+            logging.debug('dns response for %s truncated, retry over tcp',
+                          query.hostname)
+            query.tcp = True
+            self._send_tcp(query, addr)
+            return
+        if (flags & 15) == RCODE_FORMERR and query.payload_size:
+            # a server not knowing EDNS0 gets the plain query
+            query.payload_size = 0
+            query.req = build_request(query.hostname, query.qtype,
+                                      query.request_id)
+            self._send_udp(query, addr)
+            return
+        send_time, count = query.sent[addr]
+        if count == 1 and not query.tcp:
+            # Karn: a retransmitted query gives no reliable sample
+            self._update_rtt(addr, time.time() - send_time)
+        self._remove_query(query)
+        self._handle_data(data)
+
+    def _send_udp(self, query, server):
+        try:
+            sock = self._get_udp_socket(common.is_ip(server[0]))
+            sock.sendto(query.req, server)
+        except (OSError, IOError) as e:
+            logging.warn('send dns query to %s: %s' % (server, e))
+
+    def _send_tcp(self, query, server):
+        conn = self._tcp_conns.get(server)
+        try:
+            if conn is None:
+                conn = DNSTCPConnection(self, server, self._loop)
+                self._tcp_conns[server] = conn
+            conn.send(query.request_id, query.req)
+        except (OSError, IOError) as e:
+            logging.warn('send dns query over tcp to %s: %s' % (server, e))
+            if conn is not None:
+                conn.close()
+
+    def _remove_tcp_connection(self, conn):
+        if self._tcp_conns.get(conn.server) is conn:
+            del self._tcp_conns[conn.server]
+
+    def _check_tcp_connections(self, now):
+        for conn in list(self._tcp_conns.values()):
+            idle = now - conn.last_active
+            if (not conn.request_ids and idle >= DNS_TCP_IDLE_TIMEOUT) or \
+                    idle >= DNS_QUERY_TIMEOUT:
+                conn.close()
+
+    def _update_rtt(self, server, rtt):
+        srtt = self._server_rtt.get(server, DNS_RTT_INITIAL)
+        srtt += DNS_RTT_ALPHA * (rtt - srtt)
+        self._server_rtt[server] = min(srtt, DNS_RTT_MAX)
+
+    def _remove_query(self, query):
+        if self._queries.get(query.request_id) is query:
+            del self._queries[query.request_id]
+        if self._hostname_to_query.get(query.hostname) is query:
+            del self._hostname_to_query[query.hostname]
+
+    def _send_query(self, query, now):
+        server = query.servers[query.tries % len(query.servers)]
+        logging.debug('resolving %s with type %d using server %s',
+                      query.hostname, query.qtype, server)
+        sent = query.sent.get(server)
+        if sent:
+            sent[0] = now
+            sent[1] += 1
+        else:
+            query.sent[server] = [now, 1]
+        interval = max(DNS_RETRY_MIN, 2 * self._server_rtt[server])
+        interval = min(interval * (2 ** query.tries), DNS_RETRY_MAX)
+        query.tries += 1
+        query.next_send = now + interval
+        self._next_check = min(self._next_check, query.next_send,
+                               query.start + DNS_QUERY_TIMEOUT)
+        if query.tcp:
+            self._send_tcp(query, server)
+        else:
+            self._send_udp(query, server)
+
+    def _check_queries(self, now):
+        self._next_check = now + DNS_QUERY_TIMEOUT
+        for query in list(self._queries.values()):
+            if now - query.start >= DNS_QUERY_TIMEOUT:
+                logging.warn('dns query for %s timed out', query.hostname)
+                for server in query.sent:
+                    self._update_rtt(server, DNS_RTT_MAX)
+                self._remove_query(query)
+                self._call_callback(query.hostname, None, Exception(
+                    'timed out resolving hostname %s' % query.hostname))
+                continue
+            if now >= query.next_send:
+                # the server did not answer in time, hedge to the next one
+                server = query.servers[(query.tries - 1) % len(query.servers)]
+                self._update_rtt(server, 2 * self._server_rtt[server])
+                self._send_query(query, now)
+            self._next_check = min(self._next_check, query.next_send,
+                                   query.start + DNS_QUERY_TIMEOUT)
+
+    def _check_queries_due(self):
+        # periodic callbacks wait for an idle poll, so DNS events and new
+        # lookups run the retransmits and timeouts too
+        if self._queries:
+            now = time.time()
+            if now >= self._next_check:
+                self._check_queries(now)
 
     def handle_periodic(self):
-        self._cache.sweep()
+        now = time.time()
+        if self._queries:
+            self._check_queries(now)
+        if self._tcp_conns:
+            self._check_tcp_connections(now)
+        if now - self._last_sweep_time >= CACHE_SWEEP_INTERVAL:
+            self._cache.sweep(now)
+            self._last_sweep_time = now
+        if now - self._last_snapshot_time >= DNS_SNAPSHOT_INTERVAL:
+            self.save_snapshot()
+            self._last_snapshot_time = now
 
     def remove_callback(self, callback):
         hostname = self._cb_to_hostname.get(callback)
@@ -493,12 +973,47 @@ class DNSResolver(object):
                     if hostname in self._hostname_status:
                         del self._hostname_status[hostname]
 
+    def _send_first_req(self, hostname):
+        if IPV6_CONNECTION_SUPPORT:
+            self._hostname_status[hostname] = STATUS_IPV6
+            self._send_req(hostname, QTYPE_AAAA)
+        else:
+            self._hostname_status[hostname] = STATUS_IPV4
+            self._send_req(hostname, QTYPE_A)
+
+    def _resolve_cached(self, hostname, callback):
+        entry = self._cache.get(hostname)
+        if entry is None:
+            return False
+        ip = entry[0]
+        logging.debug('hit cache: %s ==>> %s', hostname, ip)
+        if self._cache.need_prefetch(entry) and \
+                hostname not in self._hostname_to_cb:
+            # refresh in the background, the answer just updates the cache
+            logging.debug('prefetch %s', hostname)
+            entry[3] = True
+            self._send_first_req(hostname)
+        if ip:
+            callback((hostname, ip), None)
+        else:
+            callback((hostname, None),
+                     Exception('unable to parse hostname %s' % hostname))
+        return True
+
     def _send_req(self, hostname, qtype):
-        req = build_request(hostname, qtype)
-        for server in self._servers:
-            logging.debug('resolving %s with type %d using server %s',
-                          hostname, qtype, server)
-            self._sock.sendto(req, server)
+        old_query = self._hostname_to_query.get(hostname)
+        if old_query is not None:
+            self._remove_query(old_query)
+        request_id = struct.unpack('!H', os.urandom(2))[0]
+        while request_id in self._queries:
+            request_id = (request_id + 1) & 0xFFFF
+        req = build_request(hostname, qtype, request_id, DNS_EDNS_PAYLOAD)
+        servers = sorted(self._servers, key=lambda s: self._server_rtt[s])
+        query = DNSQuery(hostname, qtype, request_id, req, servers)
+        query.payload_size = DNS_EDNS_PAYLOAD
+        self._queries[request_id] = query
+        self._hostname_to_query[hostname] = query
+        self._send_query(query, query.start)
 
     def resolve(self, hostname, callback):
         if type(hostname) != bytes:
@@ -511,10 +1026,8 @@ class DNSResolver(object):
             logging.debug('hit hosts: %s', hostname)
             ip = self._hosts[hostname]
             callback((hostname, ip), None)
-        elif hostname in self._cache:
-            logging.debug('hit cache: %s ==>> %s', hostname, self._cache[hostname])
-            ip = self._cache[hostname]
-            callback((hostname, ip), None)
+        elif self._resolve_cached(hostname, callback):
+            return
         elif any(hostname.endswith(t) for t in self._black_hostname_list):
             callback(None, Exception('hostname <%s> is block by the black hostname list' % hostname))
             return
@@ -528,34 +1041,30 @@ class DNSResolver(object):
                 if addrs:
                     af, socktype, proto, canonname, sa = addrs[0]
                     logging.debug('DNS resolve %s %s' % (hostname, sa[0]))
-                    self._cache[hostname] = sa[0]
+                    self._cache.put(hostname, sa[0])
                     callback((hostname, sa[0]), None)
                     return
             arr = self._hostname_to_cb.get(hostname, None)
             if not arr:
-                if IPV6_CONNECTION_SUPPORT:
-                    self._hostname_status[hostname] = STATUS_IPV6
-                    self._send_req(hostname, QTYPE_AAAA)
-                else:
-                    self._hostname_status[hostname] = STATUS_IPV4
-                    self._send_req(hostname, QTYPE_A)
+                self._check_queries_due()
+                self._send_first_req(hostname)
                 self._hostname_to_cb[hostname] = [callback]
                 self._cb_to_hostname[callback] = hostname
             else:
+                # the pending query retransmits on its own timer
                 arr.append(callback)
-                # TODO send again only if waited too long
-                if IPV6_CONNECTION_SUPPORT:
-                    self._send_req(hostname, QTYPE_AAAA)
-                else:
-                    self._send_req(hostname, QTYPE_A)
+                self._check_queries_due()
 
     def close(self):
-        if self._sock:
-            if self._loop:
-                self._loop.remove_periodic(self.handle_periodic)
-                self._loop.remove(self._sock)
-            self._sock.close()
-            self._sock = None
+        self.save_snapshot()
+        for conn in list(self._tcp_conns.values()):
+            conn.close()
+        self._close_udp_sockets()
+        if self._loop:
+            self._loop.remove_periodic(self.handle_periodic)
+            self._loop = None
+        self._queries = {}
+        self._hostname_to_query = {}
 
 
 def test():
@@ -627,5 +1136,311 @@ def test():
     dns_resolver.close()
 
 
+def test_dns_cache():
+    cache = DNSCache(size=2)
+    now = 1000
+    cache.put(b'a.com', '1.1.1.1', 1, now=now)
+    entry = cache.get(b'a.com', now=now)
+    assert entry[0] == '1.1.1.1'
+    assert entry[2] == DNS_MIN_TTL
+    assert not cache.need_prefetch(entry, now=now)
+    assert cache.need_prefetch(entry, now=now + DNS_MIN_TTL - 1)
+    assert cache.get(b'a.com', now=now + DNS_MIN_TTL) is None
+    assert len(cache) == 0
+
+    cache.put(b'b.com', '2.2.2.2', 86400, now=now)
+    assert cache.get(b'b.com', now=now)[2] == DNS_MAX_TTL
+    cache.put(b'c.com', None, None, now=now)
+    entry = cache.get(b'c.com', now=now)
+    assert entry[0] is None and entry[2] == DNS_NEGATIVE_TTL
+    assert not cache.need_prefetch(entry, now=now + DNS_NEGATIVE_TTL - 1)
+    cache.put(b'd.com', None, 86400, now=now)
+    assert cache.get(b'd.com', now=now)[2] == DNS_NEGATIVE_MAX_TTL
+    # b.com is the least recently used one
+    assert cache.get(b'b.com', now=now) is None
+    assert cache.get(b'c.com', now=now) is not None
+    assert cache.sweep(now=now + DNS_NEGATIVE_MAX_TTL) == 2
+    assert len(cache) == 0
+
+
+def test_parse_negative_response():
+    question = build_address(b'nx.example.com') + struct.pack('!HH', QTYPE_A,
+                                                              QCLASS_IN)
+    soa = build_address(b'ns.example.com') + \
+        build_address(b'root.example.com') + \
+        struct.pack('!IIIII', 1, 7200, 3600, 1209600, 120)
+    authority = b'\xc0\x0c' + struct.pack('!HHiH', QTYPE_SOA, QCLASS_IN,
+                                            900, len(soa)) + soa
+    data = struct.pack('!HBBHHHH', 1, 0x81, 0x83, 1, 0, 1, 0) + \
+        question + authority
+    response = parse_response(data)
+    assert response.hostname == b'nx.example.com'
+    assert response.rcode == RCODE_NXDOMAIN
+    assert response.negative_ttl == 120
+    assert not response.answers
+
+
+def build_test_response():
+    question = build_address(b'www.example.com') + \
+        struct.pack('!HH', QTYPE_A, QCLASS_IN)
+    # www.example.com CNAME cdn.example.com, compressed against the question
+    cname = b'\x03cdn\xc0\x10'
+    answers = b'\xc0\x0c' + \
+        struct.pack('!HHiH', QTYPE_CNAME, QCLASS_IN, 600, len(cname)) + \
+        cname + \
+        b'\xc0\x2d' + struct.pack('!HHiH', QTYPE_A, QCLASS_IN, 300, 4) + \
+        b'\x01\x02\x03\x04' + \
+        b'\xc0\x2d' + struct.pack('!HHiH', QTYPE_A, QCLASS_IN, 120, 4) + \
+        b'\x05\x06\x07\x08' + \
+        b'\xc0\x2d' + struct.pack('!HHiH', QTYPE_AAAA, QCLASS_IN, 60, 16) + \
+        b'\x20\x01\x0d\xb8' + b'\x00' * 11 + b'\x01'
+    # an OPT record in the additional section is skipped
+    additional = b'\x00' + struct.pack('!HHiH', 41, 4096, 0, 0)
+    return struct.pack('!HBBHHHH', 1, 0x81, 0x80, 1, 4, 0, 1) + \
+        question + answers + additional
+
+
+def test_parse_response():
+    data = build_test_response()
+    response = parse_response(data)
+    assert response.hostname == b'www.example.com'
+    assert response.rcode == RCODE_NOERROR
+    assert response.questions == [(None, QTYPE_A, QCLASS_IN)]
+    assert response.answers == [
+        (None, QTYPE_CNAME, QCLASS_IN, 600),
+        ('1.2.3.4', QTYPE_A, QCLASS_IN, 300),
+        ('5.6.7.8', QTYPE_A, QCLASS_IN, 120),
+        ('2001:db8::1', QTYPE_AAAA, QCLASS_IN, 60),
+    ]
+    assert parse_name(data, 0x2d) == (6, b'cdn.example.com')
+
+    # pointer loops and forward pointers are rejected
+    assert parse_response(data[:12] + b'\xc0\x0c' + data[-15:]) is None
+    assert parse_response(data[:12] + b'\x01a\xc0\x0c') is None
+    assert parse_response(data[:12] + b'\xc0\x10\x00') is None
+    assert parse_response(data[:11]) is None
+
+
+def test_parse_fuzz():
+    import random
+    rnd = random.Random(0)
+    corpus = [build_test_response()]
+    question = build_address(b'nx.example.com') + \
+        struct.pack('!HH', QTYPE_AAAA, QCLASS_IN)
+    corpus.append(struct.pack('!HBBHHHH', 1, 0x81, 0x83, 1, 0, 0, 0) +
+                  question)
+    for seed in corpus:
+        for i in range(2000):
+            data = bytearray(seed)
+            for j in range(rnd.randint(1, 4)):
+                data[rnd.randrange(len(data))] = rnd.randrange(256)
+            if rnd.random() < 0.3:
+                data = data[:rnd.randrange(len(data))]
+            response = parse_response(bytes(data))
+            assert response is None or isinstance(response, DNSResponse)
+
+
+def test_dns_snapshot():
+    import tempfile
+    path = os.path.join(tempfile.mkdtemp(), 'dns.cache')
+    now = time.time()
+    cache = DNSCache()
+    cache.put(b'a.com', '1.2.3.4', 600, now=now)
+    cache.put(b'b.com', '2001:db8::1', 600, now=now)
+    cache.put(b'nx.com', None, 120, now=now)
+    cache.put(b'old.com', '5.6.7.8', 60, now=now - 120)
+    assert cache.dirty
+    assert cache.dump(path, now=now) == 3
+    assert not cache.dirty
+    assert not [f for f in os.listdir(os.path.dirname(path))
+                if f.endswith('.tmp')]
+
+    cache = DNSCache()
+    assert cache.load(path, now=now) == 3
+    assert cache.get(b'a.com', now=now)[0] == '1.2.3.4'
+    assert cache.get(b'b.com', now=now)[0] == '2001:db8::1'
+    assert cache.get(b'nx.com', now=now)[0] is None
+    assert cache.get(b'old.com', now=now) is None
+    assert not cache.dirty
+    # entries expired while the process was down are dropped
+    cache = DNSCache()
+    assert cache.load(path, now=now + 200) == 2
+
+    with open(path, 'r+b') as f:
+        f.truncate(os.path.getsize(path) - 1)
+    try:
+        DNSCache().load(path, now=now)
+        assert False
+    except Exception as e:
+        assert 'truncated' in str(e)
+    os.remove(path)
+    os.rmdir(os.path.dirname(path))
+
+
+def build_test_answer(req, flags):
+    # the question of req without its EDNS0 OPT record
+    return req[:2] + struct.pack('!BBHHHH', flags, 0x80, 1, 1, 0, 0) + \
+        req[12:-11] + b'\xc0\x0c'
+
+
+def test_query_retransmit():
+    global IPV6_CONNECTION_SUPPORT
+    ipv6_support = IPV6_CONNECTION_SUPPORT
+    IPV6_CONNECTION_SUPPORT = False
+
+    class FakeSocket(object):
+        def __init__(self):
+            self.sent = []
+
+        def sendto(self, data, addr):
+            self.sent.append((data, addr))
+
+    results = []
+
+    def callback(result, error):
+        results.append((result, error))
+
+    try:
+        dns_resolver = DNSResolver()
+        dns_resolver._servers = [('10.0.0.1', 53), ('10.0.0.2', 53)]
+        dns_resolver._server_rtt = {('10.0.0.1', 53): 0.3,
+                                    ('10.0.0.2', 53): 0.1}
+        dns_resolver._sock = FakeSocket()
+        dns_resolver.resolve(b'example.com', callback)
+        dns_resolver.resolve(b'example.com', callback)
+        sent = dns_resolver._sock.sent
+        assert [addr for data, addr in sent] == [('10.0.0.2', 53)]
+        query = dns_resolver._hostname_to_query[b'example.com']
+        dns_resolver._check_queries(query.next_send)
+        assert sent[-1] == (sent[0][0], ('10.0.0.1', 53))
+
+        answer = build_test_answer(sent[0][0], 0x81) + \
+            struct.pack('!HHiH', QTYPE_A, QCLASS_IN, 300, 4) + \
+            b'\x01\x02\x03\x04'
+        # a response from a server we never asked is dropped
+        dns_resolver._handle_response(answer, ('10.0.0.3', 53))
+        assert not results
+        dns_resolver._handle_response(answer, ('10.0.0.1', 53))
+        assert results == [((b'example.com', '1.2.3.4'), None)] * 2
+        assert not dns_resolver._queries
+        # the late answer of the hedged query is ignored
+        dns_resolver._handle_response(answer, ('10.0.0.2', 53))
+        assert len(results) == 2
+
+        dns_resolver.resolve(b'lost.example.com', callback)
+        query = dns_resolver._hostname_to_query[b'lost.example.com']
+        # a new lookup retransmits a query that is due
+        query.next_send -= DNS_RETRY_MAX
+        dns_resolver._next_check = 0
+        count = len(sent)
+        dns_resolver.resolve(b'other.example.com', callback)
+        assert sent[count][0] == query.req
+        dns_resolver._check_queries(query.start + DNS_QUERY_TIMEOUT)
+        assert results[-1][0] == (b'lost.example.com', None)
+        assert results[-1][1] is not None
+        assert query.request_id not in dns_resolver._queries
+        assert dns_resolver._server_rtt[('10.0.0.2', 53)] > 0.1
+    finally:
+        IPV6_CONNECTION_SUPPORT = ipv6_support
+
+
+def test_tcp_fallback():
+    global IPV6_CONNECTION_SUPPORT
+    ipv6_support = IPV6_CONNECTION_SUPPORT
+    IPV6_CONNECTION_SUPPORT = False
+
+    class FakeLoop(object):
+        def __init__(self):
+            self.handlers = {}
+
+        def add(self, sock, mode, handler):
+            self.handlers[sock] = mode
+
+        def modify(self, sock, mode):
+            self.handlers[sock] = mode
+
+        def remove(self, sock):
+            del self.handlers[sock]
+
+        def add_periodic(self, callback):
+            pass
+
+        def remove_periodic(self, callback):
+            pass
+
+    class FakeSocket(object):
+        def __init__(self):
+            self.sent = []
+
+        def sendto(self, data, addr):
+            self.sent.append((data, addr))
+
+    results = []
+
+    def callback(result, error):
+        results.append((result, error))
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    listener.settimeout(5)
+    server = listener.getsockname()
+    try:
+        dns_resolver = DNSResolver()
+        dns_resolver._servers = [server]
+        dns_resolver._server_rtt = {server: DNS_RTT_INITIAL}
+        dns_resolver._loop = FakeLoop()
+        dns_resolver._sock = FakeSocket()
+        reqs = []
+        for hostname in (b'a.example.com', b'b.example.com'):
+            dns_resolver.resolve(hostname, callback)
+            req = dns_resolver._sock.sent[-1][0]
+            # EDNS0 OPT record advertising our payload size
+            assert req[-11:] == b'\x00' + struct.pack(
+                '!HHIH', QTYPE_OPT, DNS_EDNS_PAYLOAD, 0, 0)
+            dns_resolver._handle_response(build_test_answer(req, 0x83),
+                                          server)
+            reqs.append(req)
+        assert not results
+        # both retries are pipelined on one connection
+        assert len(dns_resolver._tcp_conns) == 1
+        conn = dns_resolver._tcp_conns[server]
+        sock, addr = listener.accept()
+        sock.settimeout(5)
+        conn.handle_event(conn._sock, conn._sock.fileno(), eventloop.POLL_OUT)
+        expected = b''.join(struct.pack('!H', len(req)) + req for req in reqs)
+        data = b''
+        while len(data) < len(expected):
+            data += sock.recv(4096)
+        assert data == expected
+
+        answers = [build_test_answer(req, 0x81) +
+                   struct.pack('!HHiH', QTYPE_A, QCLASS_IN, 300, 4) +
+                   struct.pack('!BBBB', 10, 0, 0, i + 1)
+                   for i, req in enumerate(reqs)]
+        sock.sendall(b''.join(struct.pack('!H', len(answer)) + answer
+                              for answer in answers))
+        while len(results) < 2:
+            conn.handle_event(conn._sock, conn._sock.fileno(),
+                              eventloop.POLL_IN)
+        assert results == [((b'a.example.com', '10.0.0.1'), None),
+                           ((b'b.example.com', '10.0.0.2'), None)]
+        assert not conn.request_ids
+        dns_resolver._check_tcp_connections(time.time() +
+                                            DNS_TCP_IDLE_TIMEOUT)
+        assert not dns_resolver._tcp_conns
+        sock.close()
+    finally:
+        listener.close()
+        IPV6_CONNECTION_SUPPORT = ipv6_support
+
+
 if __name__ == '__main__':
+    test_dns_cache()
+    test_parse_response()
+    test_parse_fuzz()
+    test_dns_snapshot()
+    test_tcp_fallback()
+    test_query_retransmit()
+    test_parse_negative_response()
     test()
@@ -0,0 +1,523 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 clowwindy
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import sys
+import time
+import json
+import argparse
+
+if __name__ == '__main__':
+    import os
+    import inspect
+    file_path = os.path.dirname(os.path.realpath(inspect.getfile(inspect.currentframe())))
+    sys.path.insert(0, os.path.join(file_path, '../'))
+
+
+def run_for(func, seconds):
+    # return calls per second of func
+    count = 0
+    batch = 1
+    start = time.time()
+    while True:
+        for i in range(batch):
+            func()
+        count += batch
+        elapsed = time.time() - start
+        if elapsed >= seconds:
+            return count / elapsed
+        batch *= 2
+
+
+CRYPTO_CHUNK_SIZES = (64, 256, 1024, 4096, 16384, 65536)
+CRYPTO_OPS = (('encrypt', 1), ('decrypt', 0))
+
+
+def bench_crypto_method(method, sizes, seconds):
+    # {'setup_ns': ns, 'encrypt': {size: {'mb_s', 'ns_call'}}, 'decrypt': ..}
+    from shadowsocks import encrypt
+
+    key_len, iv_len, m = encrypt.method_supported[method]
+    # key_len 0 means the password is used as the key
+    key = b'k' * (key_len or 32)
+    iv = b'i' * iv_len
+    rate = run_for(lambda: m(method, key, iv, 1), seconds)
+    result = {'setup_ns': 1e9 / rate}
+    for op_name, op in CRYPTO_OPS:
+        cipher = m(method, key, iv, op)
+        result[op_name] = {}
+        for size in sizes:
+            data = b'\0' * size
+            rate = run_for(lambda: cipher.update(data), seconds)
+            result[op_name][str(size)] = {
+                'mb_s': rate * size / 1024 / 1024,
+                'ns_call': 1e9 / rate,
+            }
+    return result
+
+
+def print_crypto_results(results, sizes, baseline=None, threshold=0):
+    # print the results table, return the regressions against baseline
+    regressions = []
+    print('%-18s %-8s %6s %10s %12s %9s' % ('method', 'op', 'size', 'MB/s',
+                                             'ns/call', 'change'))
+    for method in sorted(results):
+        result = results[method]
+        base = (baseline or {}).get(method, None)
+        change = ''
+        if base:
+            ratio = base['setup_ns'] / result['setup_ns'] - 1
+            change = '%+8.1f%%' % (ratio * 100)
+        print('%-18s %-8s %6s %10s %12.0f %9s' % (
+            method, 'setup', '', '', result['setup_ns'], change))
+        for op_name, op in CRYPTO_OPS:
+            for size in sizes:
+                row = result[op_name][str(size)]
+                change = ''
+                flag = ''
+                if base and str(size) in base.get(op_name, {}):
+                    base_row = base[op_name][str(size)]
+                    ratio = row['mb_s'] / base_row['mb_s'] - 1
+                    change = '%+8.1f%%' % (ratio * 100)
+                    if ratio < -threshold:
+                        flag = ' REGRESSION'
+                        regressions.append((method, op_name, size, ratio))
+                print('%-18s %-8s %6d %10.1f %12.0f %9s%s' % (
+                    method, op_name, size, row['mb_s'], row['ns_call'],
+                    change, flag))
+    return regressions
+
+
+def bench_crypto(args):
+    from shadowsocks import encrypt
+
+    methods = args.method or sorted(encrypt.method_supported)
+    sizes = CRYPTO_CHUNK_SIZES
+    if args.sizes:
+        sizes = [int(size) for size in args.sizes.split(',')]
+    results = {}
+    for method in methods:
+        try:
+            results[method] = bench_crypto_method(method, sizes, args.seconds)
+        except Exception as e:
+            print('skip %s: %s' % (method, e), file=sys.stderr)
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)['results']
+    regressions = print_crypto_results(results, sizes, baseline,
+                                       args.threshold / 100.0)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'python': sys.version.split()[0], 'seconds': args.seconds,
+                       'results': results}, f, indent=2, sort_keys=True)
+    if regressions:
+        print('%d regressions over %.0f%%' % (len(regressions),
+                                               args.threshold))
+        sys.exit(1)
+
+
+def bench_dns(args):
+    from shadowsocks import asyncdns
+
+    data = asyncdns.build_test_response()
+    print('%-20s %12s' % ('parser', 'parses/s'))
+    rate = run_for(lambda: asyncdns.parse_response(data), args.seconds)
+    print('%-20s %12.0f' % ('parse_response', rate))
+
+
+def bench_cryptopool(args):
+    import select
+    from shadowsocks import cryptopool, encrypt, eventloop
+
+    data = b'\0' * args.size
+    total = args.connections * args.count * args.size
+    print('%-20s %12s' % ('threads', 'MB/s'))
+    # 0 threads encrypts everything inline on the calling thread
+    for threads in [0] + [int(n) for n in args.threads.split(',')]:
+        ciphers = [encrypt.Encryptor(b'key', args.method)
+                   for i in range(args.connections)]
+        start = time.time()
+        if threads == 0:
+            for i in range(args.count):
+                for cipher in ciphers:
+                    cipher.encrypt(data)
+        else:
+            pool = cryptopool.CryptoPool(threads, 0)
+            for i in range(args.count):
+                for cipher in ciphers:
+                    pool.submit(cipher, cipher.encrypt, data,
+                                lambda result, error: None)
+            while pool._pending:
+                select.select([pool._wakeup_r], [], [], 1)
+                pool.handle_event(pool._wakeup_r, pool._wakeup_r.fileno(),
+                                  eventloop.POLL_IN)
+            pool.close()
+        elapsed = time.time() - start
+        print('%-20d %12.1f' % (threads, total / elapsed / 1024 / 1024))
+
+
+def bench_hmac(args):
+    import hmac
+    import struct
+    import hashlib
+    from shadowsocks.crypto import mac
+
+    user_key = b'k' * 16
+    mac_id = struct.pack('<I', 1)
+    print('%-8s %6s %-20s %12s' % ('hash', 'size', 'method', 'packets/s'))
+    for hashfunc in (hashlib.md5, hashlib.sha1):
+        for size in (2, 1400):
+            data = b'\0' * size
+            cases = (
+                ('hmac.new', lambda: hmac.new(user_key + mac_id, data,
+                                              hashfunc).digest()),
+                ('hmac_digest', lambda: mac.hmac_digest(user_key + mac_id,
+                                                        data, hashfunc)),
+                ('cached_hmac_digest', lambda: mac.cached_hmac_digest(
+                    user_key, data, hashfunc, mac_id)),
+            )
+            for name, func in cases:
+                rate = run_for(func, args.seconds)
+                print('%-8s %6d %-20s %12.0f' % (hashfunc().name, size, name,
+                                                 rate))
+
+
+def bench_aead(args):
+    from shadowsocks import encrypt, pipeline
+
+    # the stream ciphers need the protocol MAC, the AEAD ones do not
+    cases = [('aes-128-ctr', 'auth_aes128_md5')]
+    cases += [(method, 'origin') for method in
+              ('aes-128-gcm', 'aes-256-gcm', 'chacha20-ietf-poly1305')]
+    if args.method:
+        cases = [case for case in cases if case[0] in args.method]
+    print('%-24s %-16s %6s %10s' % ('method', 'protocol', 'size', 'MB/s'))
+    for method, protocol_name in cases:
+        for size in (64, 1400, 16384):
+            data = b'\0' * size
+            encryptor = encrypt.Encryptor(b'password', method)
+            protocol = pipeline.new_plugin(protocol_name, method,
+                                           encryptor.cipher_iv, True)
+            encryptor.encrypt(protocol.client_pre_encrypt(data))
+
+            def send():
+                encryptor.encrypt(protocol.client_pre_encrypt(data))
+            rate = run_for(send, args.seconds)
+            print('%-24s %-16s %6d %10.1f' % (method, protocol_name, size,
+                                              rate * size / 1024 / 1024))
+
+
+def bench_pipeline(args):
+    from shadowsocks import encrypt, pipeline
+
+    def new_ends(protocol_name, obfs_name, method):
+        ends = []
+        send_buffer = bytearray(64 * 1024 + pipeline.SEND_BUFFER_EXTRA)
+        for is_local in (True, False):
+            encryptor = encrypt.Encryptor(b'password', method)
+            iv = encryptor.cipher_iv
+            protocol = pipeline.new_plugin(protocol_name, method, iv,
+                                           is_local)
+            obfs = pipeline.new_plugin(obfs_name, method, iv, is_local)
+            ends.append((protocol, encryptor, obfs,
+                         pipeline.Pipeline(protocol, encryptor, obfs,
+                                           is_local, send_buffer)))
+        return ends
+
+    def wrappers(ends, data):
+        (protocol, encryptor, obfs, p), (s_protocol, s_encryptor, s_obfs,
+                                         s_p) = ends
+
+        def run():
+            buf = obfs.client_encode(encryptor.encrypt(
+                protocol.client_pre_encrypt(data)))
+            buf = s_obfs.server_decode(buf)[0]
+            server_info = s_protocol.get_server_info()
+            if not server_info.recv_iv:
+                server_info.recv_iv = buf[:len(server_info.iv)]
+            return s_protocol.server_post_decrypt(s_encryptor.decrypt(buf))[0]
+        return run
+
+    def fused(ends, data):
+        client = ends[0][3]
+        server = ends[1][3]
+
+        def run():
+            return server.server_recv(bytes(client.send(data, True)))[0]
+        return run
+
+    combinations = (('origin', 'plain'), ('auth_aes128_md5', 'plain'),
+                    ('auth_chain_a', 'plain'),
+                    ('auth_aes128_md5', 'http_simple'),
+                    ('auth_chain_a', 'http_simple'))
+    print('%-16s %-12s %6s %-9s %10s' % ('protocol', 'obfs', 'size',
+                                         'path', 'MB/s'))
+    for protocol_name, obfs_name in combinations:
+        for size in (1400, 16384):
+            data = b'\0' * size
+            for name, build in (('wrappers', wrappers), ('pipeline', fused)):
+                try:
+                    ends = new_ends(protocol_name, obfs_name, args.method)
+                    run = build(ends, data)
+                    # the first packets carry the handshakes
+                    if run() != data or run() != data:
+                        raise Exception('data does not match')
+                    rate = run_for(run, args.seconds) * size / 1024 / 1024
+                except Exception as e:
+                    print('%-16s %-12s %6d %-9s failed: %s' % (
+                        protocol_name, obfs_name, size, name, e))
+                    continue
+                print('%-16s %-12s %6d %-9s %10.1f' % (
+                    protocol_name, obfs_name, size, name, rate))
+
+
+AUTH_CHAIN_PROTOCOLS = ('auth_chain_a', 'auth_chain_b', 'auth_chain_c',
+                        'auth_chain_d', 'auth_chain_e')
+
+
+def bench_decode(args):
+    from shadowsocks import pipeline
+
+    method = 'aes-128-ctr'
+    iv = b'\0' * 16
+    burst_size = 64 * 1024
+    data = b'\0' * burst_size
+    print('%-16s %-8s %10s' % ('protocol', 'side', 'MB/s'))
+    for name in args.protocol or AUTH_CHAIN_PROTOCOLS:
+        for side in ('server', 'client'):
+            count = 0
+            elapsed = 0
+            try:
+                while elapsed < args.seconds:
+                    client = pipeline.new_plugin(name, method, iv, True)
+                    server = pipeline.new_plugin(name, method, iv, False)
+                    server.get_server_info().recv_iv = iv
+                    server.server_post_decrypt(client.client_pre_encrypt(
+                        b'\0' * 64))
+                    client.client_post_decrypt(server.server_pre_encrypt(b''))
+                    # encode the bursts first, only the decoding is timed
+                    if side == 'server':
+                        bursts = [client.client_pre_encrypt(data)
+                                  for i in range(16)]
+                        decode = lambda buf: server.server_post_decrypt(buf)[0]
+                    else:
+                        bursts = [server.server_pre_encrypt(data)
+                                  for i in range(16)]
+                        decode = client.client_post_decrypt
+                    start = time.time()
+                    for buf in bursts:
+                        if decode(buf) != data:
+                            raise Exception('data does not match')
+                    elapsed += time.time() - start
+                    count += len(bursts)
+            except Exception as e:
+                print('%-16s %-8s failed: %s' % (name, side, e))
+                continue
+            print('%-16s %-8s %10.1f' % (name, side, count * burst_size /
+                                         elapsed / 1024 / 1024))
+
+
+def bench_deflate(args):
+    import os
+    from shadowsocks import pipeline
+
+    size = 256 * 1024
+    streams = (
+        ('text', b''.join(b'GET /item/%d HTTP/1.1\r\nHost: example.com\r\n'
+                          % i for i in range(size // 32))[:size]),
+        ('random', os.urandom(size)),
+    )
+    cpu_time = getattr(time, 'process_time', time.time)
+    print('%-8s %-8s %6s %12s %12s' % ('data', 'format', 'ratio',
+                                      'pack ms/MB', 'unpack ms/MB'))
+    for data_name, data in streams:
+        for param in ('', 'stream'):
+            client = pipeline.new_plugin('verify_deflate', 'aes-128-ctr',
+                                         b'\0' * 16, True)
+            server = pipeline.new_plugin('verify_deflate', 'aes-128-ctr',
+                                         b'\0' * 16, False)
+            client.get_server_info().protocol_param = param
+            client.set_server_info(client.get_server_info())
+            count = 0
+            sent = 0
+            pack_time = 0
+            unpack_time = 0
+            while pack_time + unpack_time < args.seconds:
+                start = cpu_time()
+                buf = client.client_pre_encrypt(data)
+                pack_time += cpu_time() - start
+                start = cpu_time()
+                if server.server_post_decrypt(buf)[0] != data:
+                    raise Exception('data does not match')
+                unpack_time += cpu_time() - start
+                count += 1
+                sent += len(buf)
+            mb = count * size / 1024 / 1024
+            print('%-8s %-8s %6.2f %12.2f %12.2f' % (
+                data_name, param or 'classic', sent / (count * size),
+                pack_time * 1000 / mb, unpack_time * 1000 / mb))
+
+
+def bench_replay(args):
+    import struct
+    from shadowsocks import replay
+
+    table = replay.ReplayTable('bench', 60 * 10)
+    table.max_clients = args.clients
+    table.set_max_client(args.clients)
+    client_ids = [struct.pack('<I', i) for i in range(args.clients)]
+    start = time.time()
+    for i, client_id in enumerate(client_ids):
+        table.insert(i % args.users, client_id, 1)
+    fill_rate = args.clients / (time.time() - start)
+    users, clients, size = table.memory_usage()
+    print('%d clients of %d users, %.1f MB, %.0f bytes per client' % (
+        clients, users, size / 1024 / 1024, size / clients))
+    state = {'i': 0, 'connection_id': 2}
+
+    def reconnect():
+        # next connection of a tracked client
+        i = state['i']
+        if i == args.clients:
+            i = 0
+            state['connection_id'] += 1
+        table.insert(i % args.users, client_ids[i], state['connection_id'])
+        state['i'] = i + 1
+
+    def new_client():
+        # a client never seen before, the oldest one is evicted
+        i = state['i']
+        table.insert(i % args.users, struct.pack('<Q', i), 1)
+        state['i'] = i + 1
+
+    print('%-12s %12s' % ('case', 'inserts/s'))
+    print('%-12s %12.0f' % ('fill', fill_rate))
+    print('%-12s %12.0f' % ('reconnect', run_for(reconnect, args.seconds)))
+    state['i'] = 0
+    print('%-12s %12.0f' % ('new client', run_for(new_client, args.seconds)))
+    if len(table) != args.clients:
+        raise Exception('table grew past its limit')
+
+
+def bench_backends(args):
+    from shadowsocks import encrypt
+    from shadowsocks.crypto import backend
+
+    if args.method:
+        methods = args.method
+    else:
+        methods = sorted(method for method in encrypt.method_supported
+                         if len(backend.candidates(method)) > 1)
+    print('%-20s %-10s %12s' % ('method', 'backend', 'MB/s'))
+    for method in methods:
+        name, results = backend.pick_backend(method, args.seconds)
+        for backend_name in sorted(results):
+            print('%-20s %-10s %12.1f%s' % (
+                method, backend_name, results[backend_name],
+                backend_name == name and ' *' or ''))
+    if args.cache:
+        chosen = backend.select_backends(methods, args.cache, args.seconds)
+        print('saved %s to %s' % (chosen, args.cache))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='shadowsocks benchmarks')
+    parser.add_argument('-t', '--seconds', type=float, default=1.0,
+                        help='time spent on each case')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('dns', help='DNS response parse rate')
+    crypto_parser = subparsers.add_parser(
+        'crypto', help='cipher throughput and setup cost of every method')
+    crypto_parser.add_argument('-m', '--method', action='append',
+                               help='method to run, may be repeated')
+    crypto_parser.add_argument('--sizes',
+                               help='comma separated chunk sizes in bytes')
+    crypto_parser.add_argument('--json', help='write the results to a file')
+    crypto_parser.add_argument('--compare',
+                               help='compare with a saved --json baseline')
+    crypto_parser.add_argument('--threshold', type=float, default=10.0,
+                               help='MB/s drop in percent counted as a '
+                                    'regression')
+    pool_parser = subparsers.add_parser(
+        'cryptopool', help='crypto pool throughput by thread count')
+    pool_parser.add_argument('-m', '--method', default='aes-256-cfb')
+    pool_parser.add_argument('--threads', default='1,2,4,8',
+                             help='comma separated thread counts')
+    pool_parser.add_argument('-c', '--connections', type=int, default=16)
+    pool_parser.add_argument('-n', '--count', type=int, default=64,
+                             help='buffers per connection')
+    pool_parser.add_argument('-s', '--size', type=int, default=64 * 1024,
+                             help='buffer size in bytes')
+    subparsers.add_parser('hmac', help='protocol plugin HMAC rate')
+    aead_parser = subparsers.add_parser(
+        'aead', help='AEAD methods against aes-128-ctr with auth_aes128_md5')
+    aead_parser.add_argument('-m', '--method', action='append',
+                             help='method to run, may be repeated')
+    pipeline_parser = subparsers.add_parser(
+        'pipeline', help='protocol, cipher and obfs stages through the obfs '
+                         'wrappers and through a pipeline')
+    pipeline_parser.add_argument('-m', '--method', default='aes-128-ctr')
+    decode_parser = subparsers.add_parser(
+        'decode', help='auth_chain frame decoding of 64 KB bursts')
+    decode_parser.add_argument('-p', '--protocol', action='append',
+                               help='protocol to run, may be repeated')
+    subparsers.add_parser(
+        'deflate', help='verify_deflate CPU time per MB of compressible and '
+                        'random data')
+    replay_parser = subparsers.add_parser(
+        'replay', help='auth protocol replay table inserts and memory')
+    replay_parser.add_argument('-n', '--clients', type=int, default=1 << 20,
+                               help='clients tracked')
+    replay_parser.add_argument('-u', '--users', type=int, default=10000)
+    backends_parser = subparsers.add_parser(
+        'backends', help='compare cipher backends of methods served by more '
+                         'than one')
+    backends_parser.add_argument('-m', '--method', action='append',
+                                 help='method to compare, may be repeated')
+    backends_parser.add_argument('--cache',
+                                 help='write the choice to this cache file')
+    args = parser.parse_args()
+    if args.command == 'dns':
+        bench_dns(args)
+    elif args.command == 'crypto':
+        bench_crypto(args)
+    elif args.command == 'hmac':
+        bench_hmac(args)
+    elif args.command == 'aead':
+        bench_aead(args)
+    elif args.command == 'pipeline':
+        bench_pipeline(args)
+    elif args.command == 'decode':
+        bench_decode(args)
+    elif args.command == 'deflate':
+        bench_deflate(args)
+    elif args.command == 'replay':
+        bench_replay(args)
+    elif args.command == 'backends':
+        bench_backends(args)
+    elif args.command == 'cryptopool':
+        bench_cryptopool(args)
+    else:
+        parser.print_help()
+        sys.exit(2)
+
+
+if __name__ == '__main__':
+    main()
@@ -24,7 +24,6 @@ import logging
 import binascii
 import re
 
-from shadowsocks import lru_cache
 
 def compat_ord(s):
     if type(s) == int:
@@ -355,21 +354,16 @@ class PortRange(object):
         return self.range_str != other.range_str
 
 class UDPAsyncDNSHandler(object):
-    dns_cache = lru_cache.LRUCache(timeout=1800)
     def __init__(self, params):
         self.params = params
         self.remote_addr = None
         self.call_back = None
 
     def resolve(self, dns_resolver, remote_addr, call_back):
-        if remote_addr in UDPAsyncDNSHandler.dns_cache:
-            if call_back:
-                call_back("", remote_addr, UDPAsyncDNSHandler.dns_cache[remote_addr], self.params)
-        else:
-            self.call_back = call_back
-            self.remote_addr = remote_addr
-            dns_resolver.resolve(remote_addr[0], self._handle_dns_resolved)
-            UDPAsyncDNSHandler.dns_cache.sweep()
+        # the resolver cache answers synchronously on a hit
+        self.call_back = call_back
+        self.remote_addr = remote_addr
+        dns_resolver.resolve(remote_addr[0], self._handle_dns_resolved)
 
     def _handle_dns_resolved(self, result, error):
         if error:
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+#
+# Copyright 2015 clowwindy
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import hmac
+import struct
+import hashlib
+
+from shadowsocks import common
+
+AEAD_TAG_SIZE = 16
+AEAD_NONCE_SIZE = 12
+AEAD_CHUNK_SIZE_MASK = 0x3FFF
+AEAD_SUBKEY_INFO = b'ss-subkey'
+
+
+def hkdf_sha1(key, salt, info, length):
+    # RFC 5869 with HMAC-SHA1
+    prk = hmac.new(salt, key, hashlib.sha1).digest()
+    okm = b''
+    block = b''
+    i = 1
+    while len(okm) < length:
+        block = hmac.new(prk, block + info + common.chr(i),
+                         hashlib.sha1).digest()
+        okm += block
+        i += 1
+    return okm[:length]
+
+
+def nonce_increment(nonce):
+    # little endian increment of a bytearray
+    for i in range(len(nonce)):
+        if nonce[i] != 0xFF:
+            nonce[i] += 1
+            return
+        nonce[i] = 0
+
+
+class AeadCryptoBase(object):
+    """Shadowsocks AEAD framing over the seal and open of a backend.
+
+    The iv of the method is the salt and every session is keyed with
+    HKDF-SHA1(key, salt, 'ss-subkey'). A TCP stream is a sequence of
+    chunks, each an encrypted 2 byte length and an encrypted payload,
+    both sealed with their own nonce. A UDP packet is sealed once with a
+    zero nonce, see update_packet.
+
+    Subclasses implement seal(data) and open(data) with self._subkey and
+    self._nonce, open raises when the tag does not match.
+    """
+
+    def __init__(self, cipher_name, key, iv, op):
+        self._op = op
+        self._subkey = hkdf_sha1(key, iv, AEAD_SUBKEY_INFO, len(key))
+        self._nonce = bytearray(AEAD_NONCE_SIZE)
+        self._buf = b''
+        # payload length of the chunk being received, 0 for none
+        self._chunk_len = 0
+
+    def _seal_next(self, data):
+        data = self.seal(data)
+        nonce_increment(self._nonce)
+        return data
+
+    def _open_next(self, data):
+        data = self.open(data)
+        nonce_increment(self._nonce)
+        return data
+
+    def update(self, data):
+        if self._op:
+            return self._encrypt(data)
+        return self._decrypt(data)
+
+    def _encrypt(self, data):
+        out = []
+        for pos in range(0, len(data), AEAD_CHUNK_SIZE_MASK):
+            chunk = data[pos:pos + AEAD_CHUNK_SIZE_MASK]
+            out.append(self._seal_next(struct.pack('>H', len(chunk))))
+            out.append(self._seal_next(chunk))
+        return b''.join(out)
+
+    def _decrypt(self, data):
+        buf = self._buf + data
+        out = []
+        pos = 0
+        while True:
+            if not self._chunk_len:
+                if len(buf) - pos < 2 + AEAD_TAG_SIZE:
+                    break
+                length = struct.unpack('>H', self._open_next(
+                    buf[pos:pos + 2 + AEAD_TAG_SIZE]))[0]
+                if length == 0 or length > AEAD_CHUNK_SIZE_MASK:
+                    raise Exception('invalid AEAD chunk length %d' % length)
+                self._chunk_len = length
+                pos += 2 + AEAD_TAG_SIZE
+            end = pos + self._chunk_len + AEAD_TAG_SIZE
+            if len(buf) < end:
+                break
+            out.append(self._open_next(buf[pos:end]))
+            self._chunk_len = 0
+            pos = end
+        self._buf = buf[pos:]
+        return b''.join(out)
+
+    def update_into(self, data, out):
+        data = self.update(data)
+        l = len(data)
+        if len(out) < l:
+            raise Exception('output buffer too small')
+        out[:l] = data
+        return l
+
+    def update_packet(self, data):
+        # seal or open a whole UDP packet
+        if self._op:
+            return self.seal(data)
+        return self.open(data)
+
+    def clean(self):
+        pass
+
+
+def run_aead(cipher, decipher, udp_cipher, udp_decipher):
+    # chunk boundaries of the decipher input differ from the cipher's
+    from os import urandom
+    import random
+
+    plain = urandom(100 * 1024)
+    cipher_text = b''
+    pos = 0
+    while pos < len(plain):
+        l = random.randint(1, 40000)
+        cipher_text += cipher.update(plain[pos:pos + l])
+        pos += l
+    result = []
+    pos = 0
+    while pos < len(cipher_text):
+        l = random.randint(1, 20000)
+        result.append(decipher.update(cipher_text[pos:pos + l]))
+        pos += l
+    assert b''.join(result) == plain
+
+    packet = udp_cipher.update_packet(plain[:1400])
+    assert len(packet) == 1400 + AEAD_TAG_SIZE
+    assert udp_decipher.update_packet(packet) == plain[:1400]
+    try:
+        udp_decipher.update_packet(packet[:-1] + b'\x00')
+    except Exception:
+        pass
+    else:
+        assert False
+
+
+def test_hkdf_sha1():
+    # RFC 5869 test case 4
+    ikm = b'\x0b' * 11
+    salt = bytes(bytearray(range(0x0d)))
+    info = bytes(bytearray(range(0xf0, 0xfa)))
+    okm = hkdf_sha1(ikm, salt, info, 42)
+    assert okm == bytes(bytearray.fromhex(
+        '085a01ea1b10f36933068b56efa5ad81a4f14b822f5b091568a9cdd4f155fda2'
+        'c22e422478d305f3f896'))
+
+
+def test_nonce_increment():
+    nonce = bytearray(3)
+    nonce_increment(nonce)
+    assert nonce == bytearray(b'\x01\x00\x00')
+    nonce = bytearray(b'\xff\xff\x00')
+    nonce_increment(nonce)
+    assert nonce == bytearray(b'\x00\x00\x01')
+
+
+if __name__ == '__main__':
+    test_hkdf_sha1()
+    test_nonce_increment()
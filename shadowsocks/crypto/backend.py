@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+#
+# Copyright 2015 clowwindy
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import os
+import sys
+import json
+import time
+import hashlib
+import logging
+import platform
+from ctypes import c_char_p
+
+if __name__ == '__main__':
+    import inspect
+    file_path = os.path.dirname(os.path.realpath(inspect.getfile(inspect.currentframe())))
+    sys.path.insert(0, os.path.join(file_path, '../../'))
+
+from shadowsocks import common, encrypt
+from shadowsocks.crypto import openssl, sodium, rc4_md5, table
+
+# a small packet, a typical tcp read and a large read
+BENCH_CHUNK_SIZES = (64, 1500, 16384)
+BENCH_SECONDS = 0.05
+
+VERIFY_KEY = b'k' * 32
+VERIFY_IV = b'i' * 32
+
+
+def backends():
+    # (name, ciphers) of every backend, including methods a backend only
+    # serves when it is selected
+    openssl_ciphers = dict(openssl.ciphers)
+    openssl_ciphers.update(openssl.alt_ciphers)
+    sodium_ciphers = dict(sodium.ciphers)
+    sodium_ciphers.update(sodium.alt_ciphers)
+    return (('openssl', openssl_ciphers),
+            ('sodium', sodium_ciphers),
+            ('rc4_md5', rc4_md5.ciphers),
+            ('table', table.ciphers))
+
+
+def candidates(method):
+    return [(name, ciphers[method]) for name, ciphers in backends()
+            if method in ciphers]
+
+
+def library_versions():
+    versions = {}
+    try:
+        if not openssl.loaded:
+            openssl.load_openssl()
+        version = getattr(openssl.libcrypto, 'OpenSSL_version', None) or \
+            getattr(openssl.libcrypto, 'SSLeay_version', None)
+        if version is not None:
+            version.restype = c_char_p
+            versions['openssl'] = common.to_str(version(0))
+    except Exception:
+        pass
+    try:
+        if not sodium.loaded:
+            sodium.load_libsodium()
+        sodium.libsodium.sodium_version_string.restype = c_char_p
+        versions['sodium'] = common.to_str(
+            sodium.libsodium.sodium_version_string())
+    except Exception:
+        pass
+    return versions
+
+
+def cpu_flags():
+    try:
+        with open('/proc/cpuinfo', 'r') as f:
+            for line in f:
+                if line.startswith('flags') or line.startswith('Features'):
+                    return line.split(':', 1)[1].strip()
+    except (OSError, IOError):
+        pass
+    return platform.processor()
+
+
+def fingerprint():
+    # a cached choice is only valid for the same libraries and cpu
+    versions = library_versions()
+    data = '%s|%s|%s|%s' % (platform.machine(), platform.python_version(),
+                            ','.join('%s=%s' % item
+                                     for item in sorted(versions.items())),
+                            cpu_flags())
+    return hashlib.sha1(common.to_bytes(data)).hexdigest()
+
+
+def _new_cipher(method, info, op):
+    key_len, iv_len, m = info
+    return m(method, VERIFY_KEY[:key_len], VERIFY_IV[:iv_len], op)
+
+
+def check_backend(method, info, expected=None):
+    # encrypt a chunked stream, return the cipher text if it decrypts back
+    # and equals expected
+    plain = b''.join(common.chr(i % 256) * size
+                     for i, size in enumerate(BENCH_CHUNK_SIZES))
+    try:
+        cipher = _new_cipher(method, info, 1)
+        decipher = _new_cipher(method, info, 0)
+        out = []
+        pos = 0
+        for size in BENCH_CHUNK_SIZES:
+            out.append(cipher.update(plain[pos:pos + size]))
+            pos += size
+        cipher_text = b''.join(out)
+        if decipher.update(cipher_text) != plain:
+            return None
+    except Exception as e:
+        logging.debug('backend check %s: %s', method, e)
+        return None
+    if expected is not None and cipher_text != expected:
+        return None
+    return cipher_text
+
+
+def bench_backend(method, info, seconds=BENCH_SECONDS):
+    # mean MB/s over BENCH_CHUNK_SIZES
+    cipher = _new_cipher(method, info, 1)
+    rates = []
+    for size in BENCH_CHUNK_SIZES:
+        data = b'\x00' * size
+        count = 0
+        start = time.time()
+        while True:
+            for i in range(16):
+                cipher.update(data)
+            count += 16
+            elapsed = time.time() - start
+            if elapsed >= seconds:
+                break
+        rates.append(count * size / elapsed / 1024 / 1024)
+    return sum(rates) / len(rates)
+
+
+def pick_backend(method, seconds=BENCH_SECONDS):
+    # return (name, {name: MB/s}) of the fastest backend whose output
+    # matches the default one, name is None if none works
+    default = encrypt.method_supported.get(method, None)
+    expected = None
+    if default is not None:
+        expected = check_backend(method, default)
+    results = {}
+    for name, info in candidates(method):
+        if check_backend(method, info, expected) is None:
+            logging.info('cipher backend %s does not match for %s',
+                         name, method)
+            continue
+        results[name] = bench_backend(method, info, seconds)
+    if not results:
+        return None, results
+    return max(results, key=results.get), results
+
+
+def load_cache(cache_file, key):
+    if not cache_file:
+        return {}
+    try:
+        with open(cache_file, 'r') as f:
+            cache = json.load(f)
+        if cache.get('fingerprint') == key:
+            return cache.get('methods', {})
+    except (OSError, IOError, ValueError):
+        pass
+    return {}
+
+
+def save_cache(cache_file, key, methods):
+    # workers started together may save at the same time, each writes its
+    # own temp file and the replace is atomic
+    tmp_file = '%s.%d.tmp' % (cache_file, os.getpid())
+    try:
+        with open(tmp_file, 'w') as f:
+            json.dump({'fingerprint': key, 'methods': methods}, f,
+                      indent=2, sort_keys=True)
+        getattr(os, 'replace', os.rename)(tmp_file, cache_file)
+    except (OSError, IOError) as e:
+        logging.warning('can not save cipher backend cache %s: %s',
+                        cache_file, e)
+        try:
+            os.unlink(tmp_file)
+        except OSError:
+            pass
+
+
+def use_backend(method, name):
+    for backend_name, info in candidates(method):
+        if backend_name == name:
+            encrypt.method_supported[method] = info
+            return True
+    return False
+
+
+def select_backends(methods, cache_file=None, seconds=BENCH_SECONDS):
+    # benchmark the backends of methods served by more than one and use
+    # the fastest, return {method: backend name}
+    key = fingerprint()
+    cached = load_cache(cache_file, key)
+    chosen = {}
+    changed = False
+    for method in methods:
+        method = common.to_str(method).lower()
+        if len(candidates(method)) < 2 or method in chosen:
+            continue
+        name = cached.get(method, None)
+        if name is None or not use_backend(method, name):
+            name, results = pick_backend(method, seconds)
+            if name is None:
+                continue
+            logging.info('cipher backend for %s: %s (%s)' % (
+                method, name, ', '.join('%s %.1f MB/s' % item
+                                        for item in sorted(results.items()))))
+            use_backend(method, name)
+            changed = True
+        chosen[method] = name
+    if cache_file and changed:
+        cached.update(chosen)
+        save_cache(cache_file, key, cached)
+    return chosen
+
+
+def test_select_backends():
+    import tempfile
+
+    method = 'chacha20-ietf'
+    default = encrypt.method_supported[method]
+    try:
+        names = [name for name, info in candidates(method)
+                 if check_backend(method, info) is not None]
+        if len(names) < 2:
+            return
+        expected = check_backend(method, default)
+        for name, info in candidates(method):
+            assert check_backend(method, info, expected) is not None
+
+        cache_file = os.path.join(tempfile.mkdtemp(), 'backend.json')
+        chosen = select_backends([method], cache_file, 0.01)
+        assert chosen[method] in names
+        assert load_cache(cache_file, fingerprint()) == chosen
+        assert os.listdir(os.path.dirname(cache_file)) == ['backend.json']
+        assert select_backends([method], cache_file, 0.01) == chosen
+        assert load_cache(cache_file, 'other') == {}
+    finally:
+        encrypt.method_supported[method] = default
+
+
+if __name__ == '__main__':
+    test_select_backends()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+#
+# Copyright 2015 clowwindy
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import hmac
+import hashlib
+from collections import OrderedDict
+
+HMAC_CACHE_SIZE = 1024
+
+_trans_ipad = bytes(bytearray((x ^ 0x36) for x in range(256)))
+_trans_opad = bytes(bytearray((x ^ 0x5C) for x in range(256)))
+
+_digest_names = {
+    hashlib.md5: 'md5',
+    hashlib.sha1: 'sha1',
+}
+
+_cached_keys = OrderedDict()
+
+
+def hmac_digest(key, data, hashfunc):
+    # one-shot HMAC for keys that are only used a few times, such as the
+    # per connection iv + key
+    if hasattr(hmac, 'digest'):
+        return hmac.digest(key, data, _digest_names.get(hashfunc, hashfunc))
+    return hmac.new(key, data, hashfunc).digest()
+
+
+class HMACKey(object):
+    """HMAC with the inner and outer pads of a key prefix hashed once.
+
+    The real key is prefix + suffix, so keys such as user_key + pack_id
+    only pad and hash the few suffix bytes per packet. Keys longer than the
+    block size fall back to hmac_digest.
+    """
+
+    def __init__(self, prefix, hashfunc):
+        self._prefix = prefix
+        self._hashfunc = hashfunc
+        self._inner = hashfunc(prefix.translate(_trans_ipad))
+        self._outer = hashfunc(prefix.translate(_trans_opad))
+        self._pad_len = self._inner.block_size - len(prefix)
+        self._ipad = b'\x36' * self._pad_len
+        self._opad = b'\x5C' * self._pad_len
+
+    def digest(self, data, suffix=b''):
+        n = len(suffix)
+        if n > self._pad_len:
+            return hmac_digest(self._prefix + suffix, data, self._hashfunc)
+        inner = self._inner.copy()
+        outer = self._outer.copy()
+        if n:
+            inner.update(suffix.translate(_trans_ipad) + self._ipad[n:])
+            outer.update(suffix.translate(_trans_opad) + self._opad[n:])
+        else:
+            inner.update(self._ipad)
+            outer.update(self._opad)
+        inner.update(data)
+        outer.update(inner.digest())
+        return outer.digest()
+
+
+def cached_hmac_key(key, hashfunc):
+    # HMACKey of a user key, shared by every connection of the user. Only
+    # pass keys from the user table, per connection keys would push the
+    # users out of the cache, keep a private HMACKey for them instead
+    mac = _cached_keys.pop((key, hashfunc), None)
+    if mac is None:
+        if len(_cached_keys) >= HMAC_CACHE_SIZE:
+            _cached_keys.popitem(last=False)
+        mac = HMACKey(key, hashfunc)
+    _cached_keys[(key, hashfunc)] = mac
+    return mac
+
+
+def cached_hmac_digest(key, data, hashfunc, key_suffix=b''):
+    # HMAC with the key key + key_suffix, see cached_hmac_key
+    return cached_hmac_key(key, hashfunc).digest(data, key_suffix)
+
+
+def test_hmac():
+    import struct
+    for hashfunc in (hashlib.md5, hashlib.sha1):
+        for key in (b'', b'k' * 16, b'\xff' * 20, b'k' * 64, b'k' * 100):
+            for suffix in (b'', struct.pack('<I', 0x12345678)):
+                for data in (b'', b'ab', b'x' * 1400):
+                    expected = hmac.new(key + suffix, data, hashfunc).digest()
+                    assert hmac_digest(key + suffix, data, hashfunc) == \
+                        expected
+                    assert cached_hmac_digest(key, data, hashfunc,
+                                              suffix) == expected
+                    assert HMACKey(key, hashfunc).digest(data, suffix) == \
+                        expected
+
+    # least recently used keys are evicted first
+    _cached_keys.clear()
+    first = cached_hmac_key(b'first', hashlib.md5)
+    for i in range(HMAC_CACHE_SIZE * 2):
+        cached_hmac_key(('k%d' % i).encode(), hashlib.md5)
+        assert cached_hmac_key(b'first', hashlib.md5) is first
+    assert len(_cached_keys) == HMAC_CACHE_SIZE
+    assert (b'k0', hashlib.md5) not in _cached_keys
+
+
+if __name__ == '__main__':
+    test_hmac()
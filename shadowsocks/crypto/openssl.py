@@ -17,11 +17,12 @@
 from __future__ import absolute_import, division, print_function, \
     with_statement
 
-from ctypes import c_char_p, c_int, c_long, byref, \
-    create_string_buffer, c_void_p
+import threading
+from ctypes import c_char_p, c_int, c_long, byref, addressof, \
+    create_string_buffer, c_void_p, string_at
 
 from shadowsocks import common
-from shadowsocks.crypto import util
+from shadowsocks.crypto import util, aead
 
 __all__ = ['ciphers']
 
@@ -29,12 +30,18 @@ libcrypto = None
 loaded = False
 
 buf_size = 2048
+# output buffers are per thread, crypto pool workers run update() too
+_local = threading.local()
 
 ctx_cleanup = None
+cipher_block_size = None
+
+EVP_CTRL_AEAD_GET_TAG = 0x10
+EVP_CTRL_AEAD_SET_TAG = 0x11
 
 
 def load_openssl():
-    global loaded, libcrypto, buf, ctx_cleanup
+    global loaded, libcrypto, ctx_cleanup, cipher_block_size
 
     libcrypto = util.find_library(('crypto', 'eay32'),
                                   'EVP_get_cipherbyname',
@@ -49,7 +56,16 @@ def load_openssl():
                                             c_char_p, c_char_p, c_int)
 
     libcrypto.EVP_CipherUpdate.argtypes = (c_void_p, c_void_p, c_void_p,
-                                           c_char_p, c_int)
+                                           c_void_p, c_int)
+    libcrypto.EVP_CipherFinal_ex.argtypes = (c_void_p, c_void_p, c_void_p)
+    libcrypto.EVP_CIPHER_CTX_ctrl.argtypes = (c_void_p, c_int, c_int,
+                                              c_void_p)
+    # renamed in OpenSSL 3.0
+    if hasattr(libcrypto, 'EVP_CIPHER_get_block_size'):
+        cipher_block_size = libcrypto.EVP_CIPHER_get_block_size
+    else:
+        cipher_block_size = libcrypto.EVP_CIPHER_block_size
+    cipher_block_size.argtypes = (c_void_p,)
 
     if hasattr(libcrypto, "EVP_CIPHER_CTX_cleanup"):
         libcrypto.EVP_CIPHER_CTX_cleanup.argtypes = (c_void_p,)
@@ -65,7 +81,6 @@ def load_openssl():
     if hasattr(libcrypto, 'OpenSSL_add_all_ciphers'):
         libcrypto.OpenSSL_add_all_ciphers()
 
-    buf = create_string_buffer(buf_size)
     loaded = True
 
 
@@ -78,6 +93,14 @@ def load_cipher(cipher_name):
     return None
 
 
+def output_buffer(size):
+    buf = getattr(_local, 'buf', None)
+    if buf is None or len(buf) < size:
+        buf = create_string_buffer(max(size * 2, buf_size))
+        _local.buf = buf
+    return buf
+
+
 def rand_bytes(length):
     if not loaded:
         load_openssl()
@@ -100,6 +123,8 @@ class OpenSSLCrypto(object):
             raise Exception('cipher %s not found in libcrypto' % cipher_name)
         key_ptr = c_char_p(key)
         iv_ptr = c_char_p(iv)
+        # a block mode may output up to block_size - 1 extra bytes
+        self._extra = cipher_block_size(cipher) - 1
         self._ctx = libcrypto.EVP_CIPHER_CTX_new()
         if not self._ctx:
             raise Exception('can not create cipher context')
@@ -110,16 +135,26 @@ class OpenSSLCrypto(object):
             raise Exception('can not initialize cipher context')
 
     def update(self, data):
-        global buf_size, buf
         cipher_out_len = c_long(0)
         l = len(data)
-        if buf_size < l:
-            buf_size = l * 2
-            buf = create_string_buffer(buf_size)
+        buf = output_buffer(l + self._extra)
         libcrypto.EVP_CipherUpdate(self._ctx, byref(buf),
                                    byref(cipher_out_len), c_char_p(data), l)
-        # buf is copied to a str object when we access buf.raw
-        return buf.raw[:cipher_out_len.value]
+        # copy only the output, buf.raw would copy the whole buffer
+        return string_at(buf, cipher_out_len.value)
+
+    def update_into(self, data, out):
+        # out may be the same buffer as data, return the output length
+        l = len(data)
+        if len(out) < l + self._extra:
+            raise Exception('output buffer too small')
+        if not l:
+            return 0
+        cipher_out_len = c_int(0)
+        libcrypto.EVP_CipherUpdate(self._ctx, util.buffer_arg(out),
+                                   byref(cipher_out_len),
+                                   util.buffer_arg(data), l)
+        return cipher_out_len.value
 
     def __del__(self):
         self.clean()
@@ -131,15 +166,97 @@ class OpenSSLCrypto(object):
             self._ctx = None
 
 
+class OpenSSLAeadCrypto(aead.AeadCryptoBase):
+    def __init__(self, cipher_name, key, iv, op):
+        self._ctx = None
+        super(OpenSSLAeadCrypto, self).__init__(cipher_name, key, iv, op)
+        if not loaded:
+            load_openssl()
+        cipher_name = aead_cipher_names.get(cipher_name, cipher_name)
+        cipher = libcrypto.EVP_get_cipherbyname(common.to_bytes(cipher_name))
+        if not cipher:
+            raise Exception('cipher %s not found in libcrypto' % cipher_name)
+        self._ctx = libcrypto.EVP_CIPHER_CTX_new()
+        if not self._ctx:
+            raise Exception('can not create cipher context')
+        # the key is set once, every chunk only sets a new nonce
+        r = libcrypto.EVP_CipherInit_ex(self._ctx, cipher, None,
+                                        c_char_p(self._subkey), None,
+                                        c_int(op))
+        if not r:
+            self.clean()
+            raise Exception('can not initialize cipher context')
+
+    def _set_nonce(self):
+        r = libcrypto.EVP_CipherInit_ex(self._ctx, None, None, None,
+                                        c_char_p(bytes(self._nonce)), -1)
+        if not r:
+            raise Exception('can not set AEAD nonce')
+
+    def seal(self, data):
+        self._set_nonce()
+        l = len(data)
+        buf = output_buffer(l + aead.AEAD_TAG_SIZE)
+        out_len = c_int(0)
+        libcrypto.EVP_CipherUpdate(self._ctx, byref(buf), byref(out_len),
+                                   c_char_p(data), l)
+        l = out_len.value
+        final_len = c_int(0)
+        libcrypto.EVP_CipherFinal_ex(self._ctx, c_void_p(addressof(buf) + l),
+                                     byref(final_len))
+        l += final_len.value
+        libcrypto.EVP_CIPHER_CTX_ctrl(self._ctx, EVP_CTRL_AEAD_GET_TAG,
+                                      aead.AEAD_TAG_SIZE,
+                                      c_void_p(addressof(buf) + l))
+        return string_at(buf, l + aead.AEAD_TAG_SIZE)
+
+    def open(self, data):
+        l = len(data) - aead.AEAD_TAG_SIZE
+        if l < 0:
+            raise Exception('AEAD data too short')
+        self._set_nonce()
+        tag = c_char_p(data[l:])
+        libcrypto.EVP_CIPHER_CTX_ctrl(self._ctx, EVP_CTRL_AEAD_SET_TAG,
+                                      aead.AEAD_TAG_SIZE, tag)
+        buf = output_buffer(l)
+        out_len = c_int(0)
+        libcrypto.EVP_CipherUpdate(self._ctx, byref(buf), byref(out_len),
+                                   c_char_p(data), l)
+        l = out_len.value
+        final_len = c_int(0)
+        r = libcrypto.EVP_CipherFinal_ex(self._ctx,
+                                         c_void_p(addressof(buf) + l),
+                                         byref(final_len))
+        if r <= 0:
+            raise Exception('AEAD tag mismatch')
+        return string_at(buf, l + final_len.value)
+
+    def __del__(self):
+        self.clean()
+
+    def clean(self):
+        if self._ctx:
+            ctx_cleanup(self._ctx)
+            libcrypto.EVP_CIPHER_CTX_free(self._ctx)
+            self._ctx = None
+
+
+# method name -> libcrypto name
+aead_cipher_names = {
+    'chacha20-ietf-poly1305': 'chacha20-poly1305',
+}
+
+
 ciphers = {
     # CBC mode need a special use way that different from other.
     # CBC mode encrypt message with 16n length, and need 16n+1 length space to decrypt it , otherwise don't decrypt it
     'aes-128-cbc': (16, 16, OpenSSLCrypto),
     'aes-192-cbc': (24, 16, OpenSSLCrypto),
     'aes-256-cbc': (32, 16, OpenSSLCrypto),
-    'aes-128-gcm': (16, 16, OpenSSLCrypto),
-    'aes-192-gcm': (24, 16, OpenSSLCrypto),
-    'aes-256-gcm': (32, 16, OpenSSLCrypto),
+    # AEAD, the iv is the salt of the session subkey
+    'aes-128-gcm': (16, 16, OpenSSLAeadCrypto),
+    'aes-192-gcm': (24, 24, OpenSSLAeadCrypto),
+    'aes-256-gcm': (32, 32, OpenSSLAeadCrypto),
     'aes-128-cfb': (16, 16, OpenSSLCrypto),
     'aes-192-cfb': (24, 16, OpenSSLCrypto),
     'aes-256-cfb': (32, 16, OpenSSLCrypto),
@@ -168,6 +285,20 @@ ciphers = {
 }
 
 
+class OpenSSLChacha20IETF(OpenSSLCrypto):
+    def __init__(self, cipher_name, key, iv, op):
+        # EVP_chacha20 takes a 32 bit block counter before the 96 bit nonce
+        super(OpenSSLChacha20IETF, self).__init__('chacha20', key,
+                                                  b'\x00' * 4 + iv, op)
+
+
+# methods served by another backend unless crypto.backend picks openssl
+alt_ciphers = {
+    'chacha20-ietf': (32, 12, OpenSSLChacha20IETF),
+    'chacha20-ietf-poly1305': (32, 32, OpenSSLAeadCrypto),
+}
+
+
 def run_method(method):
     cipher = OpenSSLCrypto(method, b'k' * 32, b'i' * 16, 1)
     decipher = OpenSSLCrypto(method, b'k' * 32, b'i' * 16, 0)
@@ -179,6 +310,29 @@ def test_aes_128_cfb():
     run_method('aes-128-cfb')
 
 
+def test_update_into():
+    for method in ('aes-128-cfb', 'aes-256-ctr'):
+        cipher = OpenSSLCrypto(method, b'k' * 32, b'i' * 16, 1)
+        decipher = OpenSSLCrypto(method, b'k' * 32, b'i' * 16, 0)
+        util.run_cipher_into(cipher, decipher)
+
+
+def test_chacha20_ietf():
+    cipher = OpenSSLChacha20IETF('chacha20-ietf', b'k' * 32, b'i' * 12, 1)
+    decipher = OpenSSLChacha20IETF('chacha20-ietf', b'k' * 32, b'i' * 12, 0)
+    util.run_cipher(cipher, decipher)
+
+
+def test_aead():
+    for method in ('aes-128-gcm', 'aes-256-gcm', 'chacha20-ietf-poly1305'):
+        key_len, salt_len = 32, 32
+        if method == 'aes-128-gcm':
+            key_len, salt_len = 16, 16
+        cryptos = [OpenSSLAeadCrypto(method, b'k' * key_len, b's' * salt_len,
+                                     op) for op in (1, 0, 1, 0)]
+        aead.run_aead(*cryptos)
+
+
 def test_aes_256_cfb():
     run_method('aes-256-cfb')
 
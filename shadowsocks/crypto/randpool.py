@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+#
+# Copyright 2015 clowwindy
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import os
+import struct
+
+RAND_POOL_SIZE = 64 * 1024
+
+
+def urandom(length):
+    try:
+        return os.urandom(length)
+    except NotImplementedError:
+        from shadowsocks.crypto import openssl
+        return openssl.rand_bytes(length)
+
+
+class RandomPool(object):
+    """Random bytes read from the OS CSPRNG in large blocks.
+
+    Every refill allocates a new block, so views handed out earlier stay
+    valid. A forked child drops the block inherited from its parent,
+    otherwise the workers would hand out the same bytes.
+    """
+
+    def __init__(self, size=RAND_POOL_SIZE):
+        self._size = size
+        self._view = memoryview(b'')
+        self._pos = 0
+        if hasattr(os, 'register_at_fork'):
+            self._pid = None
+            os.register_at_fork(after_in_child=self.reset)
+        else:
+            self._pid = os.getpid()
+
+    def reset(self):
+        self._view = memoryview(b'')
+        self._pos = 0
+
+    def view(self, length):
+        # length random bytes as a memoryview
+        if length > self._size:
+            return memoryview(urandom(length))
+        pos = self._pos
+        if pos + length > len(self._view) or \
+                (self._pid is not None and self._pid != os.getpid()):
+            if self._pid is not None:
+                self._pid = os.getpid()
+            self._view = memoryview(urandom(self._size))
+            pos = 0
+        self._pos = pos + length
+        return self._view[pos:pos + length]
+
+    def bytes(self, length):
+        return self.view(length).tobytes()
+
+
+_pool = RandomPool()
+
+
+def rand_view(length):
+    return _pool.view(length)
+
+
+def rand_bytes(length):
+    return _pool.view(length).tobytes()
+
+
+def rand_uint8():
+    return struct.unpack('B', _pool.view(1))[0]
+
+
+def rand_uint16():
+    return struct.unpack('<H', _pool.view(2))[0]
+
+
+def rand_uint32():
+    return struct.unpack('<I', _pool.view(4))[0]
+
+
+def test_rand_pool():
+    pool = RandomPool(64)
+    seen = set()
+    for i in range(100):
+        data = pool.bytes(16)
+        assert len(data) == 16
+        assert data not in seen
+        seen.add(data)
+    view = pool.view(10)
+    data = view.tobytes()
+    for i in range(20):
+        pool.view(30)
+    # a refill allocates a new block instead of overwriting the old one
+    assert view.tobytes() == data
+    assert len(pool.bytes(100)) == 100
+    assert 0 <= rand_uint8() < 256
+    assert 0 <= rand_uint16() < 65536
+    assert 0 <= rand_uint32() < 2 ** 32
+    assert len(rand_bytes(0)) == 0
+
+
+def test_rand_pool_fork():
+    if not hasattr(os, 'fork'):
+        return
+    rand_bytes(1)
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        os.write(w, rand_bytes(16))
+        os._exit(0)
+    os.close(w)
+    child = os.read(r, 16)
+    os.close(r)
+    os.waitpid(pid, 0)
+    assert child != rand_bytes(16)
+
+
+if __name__ == '__main__':
+    test_rand_pool()
+    test_rand_pool_fork()
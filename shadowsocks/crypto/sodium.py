@@ -17,26 +17,24 @@
 from __future__ import absolute_import, division, print_function, \
     with_statement
 
-from ctypes import c_char_p, c_int, c_ulong, c_ulonglong, byref, \
-    create_string_buffer, c_void_p
+from ctypes import c_char_p, c_int, c_ulong, c_ulonglong, c_void_p, \
+    byref, create_string_buffer, string_at
 
 import logging
 
-from shadowsocks.crypto import util
+from shadowsocks.crypto import util, aead
 
 __all__ = ['ciphers']
 
 libsodium = None
 loaded = False
 
-buf_size = 2048
-
 # for salsa20 and chacha20 and chacha20-ietf
 BLOCK_SIZE = 64
 
 
 def load_libsodium():
-    global loaded, libsodium, buf
+    global loaded, libsodium
 
     libsodium = util.find_library('sodium', 'crypto_stream_salsa20_xor_ic',
                                   'libsodium')
@@ -44,19 +42,19 @@ def load_libsodium():
         raise Exception('libsodium not found')
 
     libsodium.crypto_stream_salsa20_xor_ic.restype = c_int
-    libsodium.crypto_stream_salsa20_xor_ic.argtypes = (c_void_p, c_char_p,
+    libsodium.crypto_stream_salsa20_xor_ic.argtypes = (c_void_p, c_void_p,
                                                        c_ulonglong,
                                                        c_char_p, c_ulonglong,
                                                        c_char_p)
     libsodium.crypto_stream_chacha20_xor_ic.restype = c_int
-    libsodium.crypto_stream_chacha20_xor_ic.argtypes = (c_void_p, c_char_p,
+    libsodium.crypto_stream_chacha20_xor_ic.argtypes = (c_void_p, c_void_p,
                                                         c_ulonglong,
                                                         c_char_p, c_ulonglong,
                                                         c_char_p)
 
     try:
         libsodium.crypto_stream_chacha20_ietf_xor_ic.restype = c_int
-        libsodium.crypto_stream_chacha20_ietf_xor_ic.argtypes = (c_void_p, c_char_p,
+        libsodium.crypto_stream_chacha20_ietf_xor_ic.argtypes = (c_void_p, c_void_p,
                                                                  c_ulonglong,
                                                                  c_char_p, c_ulong,
                                                                  c_char_p)
@@ -66,7 +64,7 @@ def load_libsodium():
 
     try:
         libsodium.crypto_stream_xsalsa20_xor_ic.restype = c_int
-        libsodium.crypto_stream_xsalsa20_xor_ic.argtypes = (c_void_p, c_char_p,
+        libsodium.crypto_stream_xsalsa20_xor_ic.argtypes = (c_void_p, c_void_p,
                                                             c_ulonglong,
                                                             c_char_p, c_ulonglong,
                                                             c_char_p)
@@ -76,7 +74,7 @@ def load_libsodium():
 
     try:
         libsodium.crypto_stream_xchacha20_xor_ic.restype = c_int
-        libsodium.crypto_stream_xchacha20_xor_ic.argtypes = (c_void_p, c_char_p,
+        libsodium.crypto_stream_xchacha20_xor_ic.argtypes = (c_void_p, c_void_p,
                                                              c_ulonglong,
                                                              c_char_p, c_ulonglong,
                                                              c_char_p)
@@ -84,7 +82,22 @@ def load_libsodium():
         logging.info("XChaCha20 not support. XChaCha20 only support since libsodium v1.0.12")
         pass
 
-    buf = create_string_buffer(buf_size)
+    for name in ('chacha20poly1305_ietf', 'aes256gcm'):
+        try:
+            encrypt = getattr(libsodium, 'crypto_aead_%s_encrypt' % name)
+            decrypt = getattr(libsodium, 'crypto_aead_%s_decrypt' % name)
+        except AttributeError:
+            logging.info("AEAD %s not support." % name)
+            continue
+        encrypt.restype = c_int
+        encrypt.argtypes = (c_void_p, c_void_p, c_char_p, c_ulonglong,
+                            c_char_p, c_ulonglong, c_char_p, c_char_p,
+                            c_char_p)
+        decrypt.restype = c_int
+        decrypt.argtypes = (c_void_p, c_void_p, c_char_p, c_char_p,
+                            c_ulonglong, c_char_p, c_ulonglong, c_char_p,
+                            c_char_p)
+
     loaded = True
 
 
@@ -112,38 +125,116 @@ class SodiumCrypto(object):
         self.counter = 0
 
     def update(self, data):
-        global buf_size, buf
-        l = len(data)
+        out = bytearray(len(data))
+        self.update_into(data, out)
+        return bytes(out)
 
-        # we can only prepend some padding to make the encryption align to
-        # blocks
+    def update_into(self, data, out):
+        # out may be the same buffer as data, return the output length
+        l = len(data)
+        if len(out) < l:
+            raise Exception('output buffer too small')
+        if not l:
+            return 0
+        in_ptr, in_ref = util.buffer_address(data)
+        out_ptr, out_ref = util.buffer_address(out)
+        block_counter = self.counter // BLOCK_SIZE
         padding = self.counter % BLOCK_SIZE
-        if buf_size < padding + l:
-            buf_size = (padding + l) * 2
-            buf = create_string_buffer(buf_size)
-
+        done = 0
         if padding:
-            data = (b'\0' * padding) + data
-        self.cipher(byref(buf), c_char_p(data), padding + l,
-                    self.iv_ptr, int(self.counter / BLOCK_SIZE), self.key_ptr)
+            # the stream can only start at a block boundary, finish the
+            # partial block in a scratch block instead of copying all data
+            done = min(l, BLOCK_SIZE - padding)
+            block = bytearray(BLOCK_SIZE)
+            block[padding:padding + done] = data[:done]
+            block_ptr, block_ref = util.buffer_address(block)
+            self.cipher(block_ptr, block_ptr, padding + done,
+                        self.iv_ptr, block_counter, self.key_ptr)
+            out[:done] = block[padding:padding + done]
+            block_counter += 1
+        if done < l:
+            self.cipher(out_ptr + done, in_ptr + done, l - done,
+                        self.iv_ptr, block_counter, self.key_ptr)
         self.counter += l
-        # buf is copied to a str object when we access buf.raw
-        # strip off the padding
-        return buf.raw[padding:padding + l]
+        return l
 
     def clean(self):
         pass
 
 
+class SodiumAeadCrypto(aead.AeadCryptoBase):
+    def __init__(self, cipher_name, key, iv, op):
+        super(SodiumAeadCrypto, self).__init__(cipher_name, key, iv, op)
+        if not loaded:
+            load_libsodium()
+        if cipher_name == 'chacha20-ietf-poly1305':
+            name = 'chacha20poly1305_ietf'
+        elif cipher_name == 'aes-256-gcm':
+            # AES-GCM of libsodium needs AES-NI and CLMUL
+            if not libsodium.crypto_aead_aes256gcm_is_available():
+                raise Exception('aes-256-gcm not available in libsodium')
+            name = 'aes256gcm'
+        else:
+            raise Exception('Unknown cipher')
+        self._aead_encrypt = getattr(libsodium,
+                                     'crypto_aead_%s_encrypt' % name)
+        self._aead_decrypt = getattr(libsodium,
+                                     'crypto_aead_%s_decrypt' % name)
+
+    def seal(self, data):
+        # a buffer per call, crypto pool workers may run this too
+        l = len(data) + aead.AEAD_TAG_SIZE
+        buf = create_string_buffer(l)
+        out_len = c_ulonglong(0)
+        self._aead_encrypt(buf, byref(out_len), data, len(data), None, 0,
+                           None, bytes(self._nonce), self._subkey)
+        return string_at(buf, out_len.value)
+
+    def open(self, data):
+        l = len(data) - aead.AEAD_TAG_SIZE
+        if l < 0:
+            raise Exception('AEAD data too short')
+        buf = create_string_buffer(max(l, 1))
+        out_len = c_ulonglong(0)
+        r = self._aead_decrypt(buf, byref(out_len), None, data, len(data),
+                               None, 0, bytes(self._nonce), self._subkey)
+        if r != 0:
+            raise Exception('AEAD tag mismatch')
+        return string_at(buf, out_len.value)
+
+
 ciphers = {
     'salsa20': (32, 8, SodiumCrypto),
     'chacha20': (32, 8, SodiumCrypto),
     'chacha20-ietf': (32, 12, SodiumCrypto),
     'xchacha20': (32, 24, SodiumCrypto),
     'xsalsa20': (32, 24, SodiumCrypto),
+    'chacha20-ietf-poly1305': (32, 32, SodiumAeadCrypto),
+}
+
+# methods served by another backend unless crypto.backend picks sodium
+alt_ciphers = {
+    'aes-256-gcm': (32, 32, SodiumAeadCrypto),
 }
 
 
+def test_update_into():
+    for method in ('salsa20', 'chacha20-ietf'):
+        cipher = SodiumCrypto(method, b'k' * 32, b'i' * 16, 1)
+        decipher = SodiumCrypto(method, b'k' * 32, b'i' * 16, 0)
+        util.run_cipher_into(cipher, decipher)
+    # the output matches update() whatever the chunk boundaries are
+    cipher = SodiumCrypto('chacha20', b'k' * 32, b'i' * 16, 1)
+    expected = cipher.update(b'\0' * 300)
+    cipher = SodiumCrypto('chacha20', b'k' * 32, b'i' * 16, 1)
+    out = bytearray(300)
+    view = memoryview(out)
+    pos = 0
+    for l in (1, 62, 1, 64, 100, 72):
+        pos += cipher.update_into(b'\0' * l, view[pos:pos + l])
+    assert bytes(out) == expected
+
+
 def test_salsa20():
     cipher = SodiumCrypto('salsa20', b'k' * 32, b'i' * 16, 1)
     decipher = SodiumCrypto('salsa20', b'k' * 32, b'i' * 16, 0)
@@ -165,6 +256,21 @@ def test_chacha20_ietf():
     util.run_cipher(cipher, decipher)
 
 
+def test_aead():
+    from shadowsocks.crypto import openssl
+
+    cryptos = [SodiumAeadCrypto('chacha20-ietf-poly1305', b'k' * 32,
+                                b's' * 32, op) for op in (1, 0, 1, 0)]
+    aead.run_aead(*cryptos)
+    # same output as libcrypto
+    cipher = SodiumAeadCrypto('chacha20-ietf-poly1305', b'k' * 32,
+                              b's' * 32, 1)
+    expected = openssl.OpenSSLAeadCrypto('chacha20-ietf-poly1305', b'k' * 32,
+                                         b's' * 32, 1)
+    for l in (1, 100, 20000):
+        assert cipher.update(b'x' * l) == expected.update(b'x' * l)
+
+
 def test_xchacha20():
     cipher = SodiumCrypto('xchacha20', b'k' * 32, b'i' * 24, 1)
     decipher = SodiumCrypto('xchacha20', b'k' * 32, b'i' * 24, 0)
@@ -180,6 +286,8 @@ def test_xsalsa20():
 
 
 if __name__ == '__main__':
+    test_update_into()
+    test_aead()
     test_chacha20_ietf()
     test_chacha20()
     test_salsa20()
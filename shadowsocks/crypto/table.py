@@ -17,14 +17,30 @@
 from __future__ import absolute_import, division, print_function, \
     with_statement
 
+import os
+import hmac
+import errno
 import string
 import struct
 import hashlib
+import logging
+import collections
 
+from shadowsocks import common
 
 __all__ = ['ciphers']
 
-cached_tables = {}
+TABLE_CACHE_SIZE = 256
+
+# key -> [encrypt_table, decrypt_table], least recently used first
+cached_tables = collections.OrderedDict()
+# tables are also saved here when set, see set_cache_dir
+cache_dir = None
+# a table is the whole key, the files are named by a keyed hash of it with
+# the random salt kept next to them
+TABLE_SALT_FILE = 'salt'
+TABLE_SALT_SIZE = 32
+_salt = None
 
 if hasattr(string, 'maketrans'):
     maketrans = string.maketrans
@@ -39,19 +55,106 @@ def get_table(key):
     m.update(key)
     s = m.digest()
     a, b = struct.unpack('<QQ', s)
-    table = maketrans(b'', b'')
-    table = [table[i: i + 1] for i in range(len(table))]
+    # round i sorts by a % (x + i), take the moduli from one precomputed
+    # list instead of working out 256 of them in a lambda every round.
+    # list.sort is stable, so the result is the same as the original build
+    mods = [a % n for n in range(1, 1024 + 256)]
+    table = list(range(256))
     for i in range(1, 1024):
-        table.sort(key=lambda x: int(a % (ord(x) + i)))
-    return table
+        table.sort(key=mods[i - 1:i + 255].__getitem__)
+    return [common.chr(x) for x in table]
+
+
+def set_cache_dir(path):
+    global cache_dir, _salt
+    cache_dir = path or None
+    _salt = None
+
+
+def _open_private(path):
+    # only the owner can read, fails when path exists
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    return os.fdopen(fd, 'wb')
+
+
+def _get_salt():
+    global _salt
+    if _salt is not None:
+        return _salt
+    path = os.path.join(cache_dir, TABLE_SALT_FILE)
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir, 0o700)
+        with _open_private(path) as f:
+            f.write(os.urandom(TABLE_SALT_SIZE))
+    except (OSError, IOError) as e:
+        if getattr(e, 'errno', None) != errno.EEXIST:
+            logging.warning('can not create table cache salt %s: %s',
+                            path, e)
+            return None
+    try:
+        with open(path, 'rb') as f:
+            salt = f.read()
+    except (OSError, IOError):
+        return None
+    # another process may still be writing it, try again next time
+    if len(salt) == TABLE_SALT_SIZE:
+        _salt = salt
+    return _salt
+
+
+def _cache_file(key):
+    salt = _get_salt()
+    if salt is None:
+        return None
+    return os.path.join(cache_dir, 'table-%s' %
+                        hmac.new(salt, key, hashlib.sha256).hexdigest())
+
+
+def _load_table(key):
+    cache_file = _cache_file(key)
+    if cache_file is None:
+        return None
+    try:
+        with open(cache_file, 'rb') as f:
+            encrypt_table = f.read()
+    except (OSError, IOError):
+        return None
+    # a broken file is ignored and rebuilt
+    if len(encrypt_table) != 256 or len(set(encrypt_table)) != 256:
+        return None
+    return encrypt_table
+
+
+def _save_table(key, encrypt_table):
+    cache_file = _cache_file(key)
+    if cache_file is None:
+        return
+    tmp_file = '%s.%d.tmp' % (cache_file, os.getpid())
+    try:
+        with _open_private(tmp_file) as f:
+            f.write(encrypt_table)
+        getattr(os, 'replace', os.rename)(tmp_file, cache_file)
+    except (OSError, IOError) as e:
+        logging.warning('can not save table cache %s: %s', cache_file, e)
 
 
 def init_table(key):
-    if key not in cached_tables:
-        encrypt_table = b''.join(get_table(key))
+    tables = cached_tables.pop(key, None)
+    if tables is None:
+        encrypt_table = None
+        if cache_dir:
+            encrypt_table = _load_table(key)
+        if encrypt_table is None:
+            encrypt_table = b''.join(get_table(key))
+            if cache_dir:
+                _save_table(key, encrypt_table)
         decrypt_table = maketrans(encrypt_table, maketrans(b'', b''))
-        cached_tables[key] = [encrypt_table, decrypt_table]
-    return cached_tables[key]
+        tables = [encrypt_table, decrypt_table]
+        if len(cached_tables) >= TABLE_CACHE_SIZE:
+            cached_tables.popitem(last=False)
+    cached_tables[key] = tables
+    return tables
 
 
 class TableCipher(object):
@@ -65,6 +168,15 @@ class TableCipher(object):
         else:
             return translate(data, self._decrypt_table)
 
+    def update_into(self, data, out):
+        l = len(data)
+        if len(out) < l:
+            raise Exception('output buffer too small')
+        if type(data) is not bytes:
+            data = bytes(data)
+        out[:l] = self.update(data)
+        return l
+
     def clean(self):
         pass
 
@@ -75,6 +187,13 @@ class NoneCipher(object):
     def update(self, data):
         return data
 
+    def update_into(self, data, out):
+        l = len(data)
+        if len(out) < l:
+            raise Exception('output buffer too small')
+        out[:l] = data
+        return l
+
     def clean(self):
         pass
 
@@ -182,6 +301,61 @@ def test_encryption():
     util.run_cipher(cipher, decipher)
 
 
+def test_update_into():
+    from shadowsocks.crypto import util
+
+    for cipher_class in (TableCipher, NoneCipher):
+        cipher = cipher_class('table', b'test', b'', 1)
+        decipher = cipher_class('table', b'test', b'', 0)
+        util.run_cipher_into(cipher, decipher)
+
+
+def test_table_cache():
+    import shutil
+    import tempfile
+
+    root = tempfile.mkdtemp()
+    path = os.path.join(root, 'tables')
+    try:
+        set_cache_dir(path)
+        cached_tables.clear()
+        tables = init_table(b'cached')
+        name = os.path.basename(_cache_file(b'cached'))
+        assert sorted(os.listdir(path)) == sorted([name, TABLE_SALT_FILE])
+        assert hashlib.sha256(b'cached').hexdigest() not in name
+        assert os.stat(path).st_mode & 0o777 == 0o700
+        for name in os.listdir(path):
+            mode = os.stat(os.path.join(path, name)).st_mode
+            assert mode & 0o777 == 0o600
+        cached_tables.clear()
+        assert init_table(b'cached') == tables
+        # a damaged file is rebuilt
+        with open(_cache_file(b'cached'), 'wb') as f:
+            f.write(b'\0' * 256)
+        cached_tables.clear()
+        assert init_table(b'cached') == tables
+    finally:
+        set_cache_dir(None)
+        shutil.rmtree(root)
+    global TABLE_CACHE_SIZE
+    cache_size = TABLE_CACHE_SIZE
+    TABLE_CACHE_SIZE = 4
+    try:
+        cached_tables.clear()
+        for i in range(10):
+            init_table(common.to_bytes('key%d' % i))
+        assert len(cached_tables) == 4
+        # a lookup moves the key to the end
+        init_table(b'key6')
+        init_table(b'key10')
+        assert list(cached_tables.keys()) == [b'key8', b'key9', b'key6',
+                                              b'key10']
+    finally:
+        TABLE_CACHE_SIZE = cache_size
+
+
 if __name__ == '__main__':
     test_table_result()
     test_encryption()
+    test_update_into()
+    test_table_cache()
@@ -19,6 +19,7 @@ from __future__ import absolute_import, division, print_function, \
 
 import os
 import logging
+from ctypes import c_char, c_char_p, c_void_p, addressof, byref, cast
 
 
 def find_library_nt(name):
@@ -102,6 +103,30 @@ def find_library(possible_lib_names, search_symbol, library_name):
     return None
 
 
+def buffer_address(data):
+    # return the address of the contents of bytes, bytearray or a writable
+    # memoryview without copying, and the object to keep alive during the
+    # call. only a read only memoryview is copied
+    if type(data) is bytes:
+        return cast(c_char_p(data), c_void_p).value, data
+    if isinstance(data, memoryview) and data.readonly:
+        data = data.tobytes()
+        return cast(c_char_p(data), c_void_p).value, data
+    ref = (c_char * len(data)).from_buffer(data)
+    return addressof(ref), ref
+
+
+def buffer_arg(data):
+    # data as a c_void_p argument without working out its address, which
+    # is cheaper than buffer_address for a single call. bytes are passed
+    # as they are, a writable buffer by reference
+    if type(data) is bytes:
+        return data
+    if isinstance(data, memoryview) and data.readonly:
+        return data.tobytes()
+    return byref(c_char.from_buffer(data))
+
+
 def run_cipher(cipher, decipher):
     from os import urandom
     import random
@@ -132,6 +157,45 @@ def run_cipher(cipher, decipher):
     assert b''.join(results) == plain
 
 
+def run_cipher_into(cipher, decipher):
+    from os import urandom
+    import random
+
+    plain = urandom(1024 * 1024)
+    buf = bytearray(len(plain))
+    view = memoryview(buf)
+    pos = 0
+    while pos < len(plain):
+        l = random.randint(1, 32768)
+        chunk = memoryview(plain)[pos:pos + l]
+        pos += cipher.update_into(chunk, view[pos:pos + l])
+    pos = 0
+    while pos < len(buf):
+        # in place
+        l = random.randint(1, 32768)
+        pos += decipher.update_into(view[pos:pos + l], view[pos:pos + l])
+    assert bytes(buf) == plain
+
+
+def test_buffer_address():
+    import ctypes
+    from ctypes import string_at
+    data = b'abcdef'
+    address, ref = buffer_address(data)
+    assert string_at(address, len(data)) == data
+    buf = bytearray(data)
+    address, ref = buffer_address(memoryview(buf)[2:])
+    assert string_at(address, 4) == b'cdef'
+    address, ref = buffer_address(memoryview(data)[1:3])
+    assert string_at(address, 2) == b'bc'
+    memmove = ctypes.memmove
+    memmove.argtypes = (c_void_p, c_void_p, ctypes.c_size_t)
+    out = bytearray(4)
+    memmove(buffer_arg(memoryview(out)[1:]), buffer_arg(data), 3)
+    memmove(buffer_arg(out), buffer_arg(memoryview(data)[4:]), 1)
+    assert out == bytearray(b'eabc')
+
+
 def test_find_library():
     assert find_library('c', 'strcpy', 'libc') is not None
     assert find_library(['c'], 'strcpy', 'libc') is not None
@@ -145,4 +209,5 @@ def test_find_library():
 
 
 if __name__ == '__main__':
+    test_buffer_address()
     test_find_library()
@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 clowwindy
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import errno
+import socket
+import threading
+import collections
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+if __name__ == '__main__':
+    import os
+    import sys
+    import inspect
+    file_path = os.path.dirname(os.path.realpath(inspect.getfile(inspect.currentframe())))
+    sys.path.insert(0, os.path.join(file_path, '../'))
+
+from shadowsocks import eventloop, shell
+
+
+# buffers smaller than this are cheaper to encrypt inline than to hand over
+CRYPTO_OFFLOAD_THRESHOLD = 16 * 1024
+
+# job fields
+JOB_KEY = 0
+JOB_FUNC = 1
+JOB_DATA = 2
+JOB_CALLBACK = 3
+JOB_RESULT = 4
+JOB_ERROR = 5
+JOB_CANCELLED = 6
+
+_pools = {}
+
+
+def get_pool(loop, threads, threshold=CRYPTO_OFFLOAD_THRESHOLD):
+    # relays on the same loop share one pool, each calls release() when
+    # it closes and the last one closes the pool
+    pool = _pools.get(id(loop))
+    if pool is None:
+        pool = CryptoPool(threads, threshold)
+        pool.add_to_loop(loop)
+        _pools[id(loop)] = pool
+    pool._refs += 1
+    return pool
+
+
+class CryptoPool(object):
+    """Run cipher updates on worker threads.
+
+    ctypes releases the GIL while libcrypto and libsodium work, so large
+    buffers of different connections can be encrypted on several cores.
+    Jobs of the same key run one at a time and their callbacks are called
+    on the loop thread in submission order.
+    """
+
+    def __init__(self, threads, threshold=CRYPTO_OFFLOAD_THRESHOLD):
+        self._threshold = threshold
+        self._loop = None
+        self._closed = False
+        self._refs = 0
+        self._jobs = queue.Queue()
+        self._done = collections.deque()
+        # key -> deque of jobs, the head one is queued or running
+        self._pending = {}
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._wakeup_w.setblocking(False)
+        self._threads = []
+        for i in range(threads):
+            t = threading.Thread(target=self._worker)
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def add_to_loop(self, loop):
+        if self._loop:
+            raise Exception('already add to loop')
+        self._loop = loop
+        loop.add(self._wakeup_r, eventloop.POLL_IN, self)
+
+    def has_pending(self, key):
+        return key in self._pending
+
+    def should_offload(self, key, size):
+        # once a key has jobs in flight the following data must queue
+        # behind them to keep the cipher stream in order
+        if key in self._pending:
+            return True
+        return bool(self._threads) and size >= self._threshold
+
+    def submit(self, key, func, data, callback):
+        # call func(data) on a worker and callback(result, error) on the
+        # loop thread
+        job = [key, func, data, callback, None, None, False]
+        pending = self._pending.get(key)
+        if pending is None:
+            self._pending[key] = collections.deque([job])
+            self._jobs.put(job)
+        else:
+            pending.append(job)
+
+    def cancel(self, key):
+        pending = self._pending.pop(key, None)
+        if pending:
+            for job in pending:
+                job[JOB_CANCELLED] = True
+
+    def _worker(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            if not job[JOB_CANCELLED]:
+                try:
+                    job[JOB_RESULT] = job[JOB_FUNC](job[JOB_DATA])
+                except Exception as e:
+                    job[JOB_ERROR] = e
+            job[JOB_DATA] = None
+            self._done.append(job)
+            try:
+                self._wakeup_w.send(b'\0')
+            except (OSError, IOError) as e:
+                # a full socket buffer means the loop is woken up anyway
+                if eventloop.errno_from_exception(e) not in \
+                        (errno.EAGAIN, errno.EWOULDBLOCK):
+                    if not self._closed:
+                        shell.print_exception(e)
+
+    def handle_event(self, sock, fd, event):
+        if sock != self._wakeup_r:
+            return
+        try:
+            while self._wakeup_r.recv(4096):
+                pass
+        except (OSError, IOError) as e:
+            if eventloop.errno_from_exception(e) not in \
+                    (errno.EAGAIN, errno.EWOULDBLOCK):
+                shell.print_exception(e)
+        self.handle_done()
+
+    def handle_done(self):
+        while self._done:
+            job = self._done.popleft()
+            if job[JOB_CANCELLED]:
+                continue
+            key = job[JOB_KEY]
+            pending = self._pending[key]
+            pending.popleft()
+            if pending:
+                self._jobs.put(pending[0])
+            else:
+                del self._pending[key]
+            try:
+                job[JOB_CALLBACK](job[JOB_RESULT], job[JOB_ERROR])
+            except Exception as e:
+                shell.print_exception(e)
+
+    def release(self):
+        self._refs -= 1
+        if self._refs <= 0:
+            self.close()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        for key in list(self._pending.keys()):
+            self.cancel(key)
+        for t in self._threads:
+            self._jobs.put(None)
+        if self._loop:
+            self._loop.remove(self._wakeup_r)
+            for loop_id, pool in list(_pools.items()):
+                if pool is self:
+                    del _pools[loop_id]
+            self._loop = None
+        self._wakeup_r.close()
+        self._wakeup_w.close()
+
+
+def test():
+    import select
+    from shadowsocks import encrypt
+
+    pool = CryptoPool(4, 1024)
+    ciphers = {}
+    results = {}
+    expected = {}
+    for key in range(3):
+        ciphers[key] = encrypt.Encryptor(b'key%d' % key, 'aes-128-cfb')
+        inline = encrypt.Encryptor(b'key%d' % key, 'aes-128-cfb',
+                                   ciphers[key].cipher_iv)
+        results[key] = []
+        expected[key] = []
+        for i in range(8):
+            data = bytes(bytearray([i])) * (512 * (i + 1))
+            expected[key].append(inline.encrypt(data))
+            assert pool.should_offload(key, len(data)) == (i > 0)
+
+            def callback(result, error, key=key):
+                assert error is None
+                results[key].append(result)
+            pool.submit(key, ciphers[key].encrypt, data, callback)
+    pool.submit('bad', lambda data: data[10], b'', lambda r, e: results.setdefault('bad', e))
+    pool.submit('gone', lambda data: data, b'', lambda r, e: results.setdefault('gone', r))
+    pool.cancel('gone')
+
+    assert pool.has_pending(0) and not pool.has_pending('gone')
+    while len(pool._pending) > 0:
+        select.select([pool._wakeup_r], [], [], 1)
+        pool.handle_event(pool._wakeup_r, pool._wakeup_r.fileno(),
+                          eventloop.POLL_IN)
+    for key in range(3):
+        assert results[key] == expected[key]
+    assert isinstance(results['bad'], IndexError)
+    assert 'gone' not in results
+    pool.close()
+    for t in pool._threads:
+        t.join(1)
+        assert not t.is_alive()
+
+
+def test_get_pool():
+    from shadowsocks import eventloop
+
+    loop = eventloop.EventLoop1()
+    pool = get_pool(loop, 1)
+    assert get_pool(loop, 1) is pool
+    pool.release()
+    assert not pool._closed and _pools[id(loop)] is pool
+    pool.release()
+    assert pool._closed and id(loop) not in _pools
+
+
+if __name__ == '__main__':
+    test()
@@ -17,13 +17,13 @@
 from __future__ import absolute_import, division, print_function, \
     with_statement
 
-import os
 import sys
 import hashlib
 import logging
+import base64
 
 from shadowsocks import common, lru_cache
-from shadowsocks.crypto import rc4_md5, openssl, sodium, table
+from shadowsocks.crypto import rc4_md5, openssl, sodium, table, randpool
 
 
 method_supported = {}
@@ -34,10 +34,7 @@ method_supported.update(table.ciphers)
 
 
 def random_string(length):
-    try:
-        return os.urandom(length)
-    except NotImplementedError as e:
-        return openssl.rand_bytes(length)
+    return randpool.rand_bytes(length)
 
 cached_keys = lru_cache.LRUCache(timeout=180)
 
@@ -73,8 +70,10 @@ def EVP_BytesToKey(password, key_len, iv_len, cache):
 
 
 class Encryptor(object):
-    def __init__(self, key, method, iv = None, cache = False):
+    def __init__(self, key, method, iv = None, cache = False, key_iv = None):
         self.key = key
+        # EVP_BytesToKey(key) worked out by the caller, see UserKey
+        self.key_iv = key_iv
         self.method = method
         self.iv = None
         self.iv_sent = False
@@ -107,7 +106,10 @@ class Encryptor(object):
         password = common.to_bytes(password)
         m = self._method_info
         if m[0] > 0:
-            key, iv_ = EVP_BytesToKey(password, m[0], m[1], self.cache)
+            if self.key_iv is not None:
+                key, iv_ = self.key_iv
+            else:
+                key, iv_ = EVP_BytesToKey(password, m[0], m[1], self.cache)
         else:
             # key_length == 0 indicates we should use the key directly
             key, iv = password, b''
@@ -131,6 +133,20 @@ class Encryptor(object):
             self.iv_sent = True
             return self.cipher_iv + self.cipher.update(buf)
 
+    def encrypt_into(self, buf, out):
+        # write the iv if not sent yet and the encrypted buf to the start
+        # of the bytearray out, return the length written
+        offset = 0
+        if not self.iv_sent:
+            self.iv_sent = True
+            offset = len(self.cipher_iv)
+            out[:offset] = self.cipher_iv
+        if len(buf) == 0:
+            return offset
+        if offset:
+            out = memoryview(out)[offset:]
+        return offset + self.cipher.update_into(buf, out)
+
     def decrypt(self, buf):
         if len(buf) == 0:
             return buf
@@ -155,6 +171,40 @@ class Encryptor(object):
             self.decipher.clean()
             self.decipher = None
 
+class UserKey(object):
+    """Key material of a user, derived once when the user is added.
+
+    Protocol plugins key their handshake ciphers with base64(key) + salt,
+    the base64 form, hashed forms and EVP_BytesToKey results are kept here
+    so a new connection does no key derivation. A new UserKey is made when
+    the password changes.
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.b64 = common.to_bytes(base64.b64encode(key))
+        self._hashed = {}
+        self._key_ivs = {}
+
+    def hashed(self, hashfunc):
+        # UserKey of hashfunc(key).digest()
+        user_key = self._hashed.get(hashfunc, None)
+        if user_key is None:
+            user_key = UserKey(hashfunc(self.key).digest())
+            self._hashed[hashfunc] = user_key
+        return user_key
+
+    def encryptor(self, salt, method, iv=None):
+        # Encryptor keyed with b64 + salt
+        password = self.b64 + salt
+        key_iv = self._key_ivs.get((salt, method), None)
+        if key_iv is None:
+            (key_len, iv_len, m) = method_supported[method]
+            key_iv = EVP_BytesToKey(password, key_len, iv_len, False)
+            self._key_ivs[(salt, method)] = key_iv
+        return Encryptor(password, method, iv, key_iv=key_iv)
+
+
 def encrypt_all(password, method, op, data):
     result = []
     method = method.lower()
@@ -170,7 +220,11 @@ def encrypt_all(password, method, op, data):
         iv = data[:iv_len]
         data = data[iv_len:]
     cipher = m(method, key, iv, op)
-    result.append(cipher.update(data))
+    if hasattr(cipher, 'update_packet'):
+        # AEAD, one sealed packet instead of a chunk stream
+        result.append(cipher.update_packet(data))
+    else:
+        result.append(cipher.update(data))
     return b''.join(result)
 
 def encrypt_key(password, method):
@@ -204,7 +258,11 @@ def encrypt_all_iv(key, method, op, data, ref_iv):
         data = data[iv_len:]
         ref_iv[0] = iv
     cipher = m(method, key, iv, op)
-    result.append(cipher.update(data))
+    if hasattr(cipher, 'update_packet'):
+        # AEAD, one sealed packet instead of a chunk stream
+        result.append(cipher.update_packet(data))
+    else:
+        result.append(cipher.update(data))
     return b''.join(result)
 
 
@@ -230,6 +288,52 @@ def test_encryptor():
         assert plain == plain2
 
 
+def test_encrypt_into():
+    from os import urandom
+    plain = urandom(10240)
+    out = bytearray(20480)
+    for method in CIPHERS_TO_TEST:
+        logging.warn(method)
+        encryptor = Encryptor(b'key', method)
+        decryptor = Encryptor(b'key', method)
+        cipher = b''
+        for pos in range(0, len(plain), 4096):
+            l = encryptor.encrypt_into(plain[pos:pos + 4096], out)
+            cipher += bytes(out[:l])
+        assert len(cipher) == len(plain) + encryptor.iv_len()
+        plain2 = decryptor.decrypt(cipher)
+        assert plain == plain2
+
+
+def test_aead():
+    from os import urandom
+    plain = urandom(40000)
+    for method in ('aes-128-gcm', 'aes-256-gcm', 'chacha20-ietf-poly1305'):
+        encryptor = Encryptor(b'key', method)
+        decryptor = Encryptor(b'key', method)
+        cipher = encryptor.encrypt(plain[:100]) + encryptor.encrypt(plain[100:])
+        assert decryptor.decrypt(cipher[:10]) == b''
+        assert decryptor.decrypt(cipher[10:]) == plain
+        cipher = encrypt_all(b'key', method, 1, plain[:1400])
+        assert encrypt_all(b'key', method, 0, cipher) == plain[:1400]
+
+
+def test_user_key():
+    from os import urandom
+    user_key = UserKey(b'password')
+    assert user_key.b64 == b'cGFzc3dvcmQ='
+    assert user_key.hashed(hashlib.md5).key == hashlib.md5(b'password').digest()
+    assert user_key.hashed(hashlib.md5) is user_key.hashed(hashlib.md5)
+    plain = urandom(1024)
+    iv = urandom(16)
+    for method in ('aes-128-cbc', 'aes-128-cfb'):
+        encryptor = user_key.encryptor(b'salt', method, iv)
+        decryptor = Encryptor(user_key.b64 + b'salt', method, iv)
+        assert encryptor.cipher_key == decryptor.cipher_key
+        if method == 'aes-128-cfb':
+            assert decryptor.decrypt(encryptor.encrypt(plain)) == plain
+
+
 def test_encrypt_all():
     from os import urandom
     plain = urandom(10240)
@@ -243,3 +347,6 @@ def test_encrypt_all():
 if __name__ == '__main__':
     test_encrypt_all()
     test_encryptor()
+    test_encrypt_into()
+    test_aead()
+    test_user_key()
@@ -161,6 +161,7 @@ class EventLoop1(object):
         self._last_time = time.time()
         self._periodic_callbacks = []
         self._stopping = False
+        self._dispatch_lag = 0
         logging.debug('using event model: %s', model)
 
     def poll(self, timeout=None):
@@ -198,6 +199,13 @@ class EventLoop1(object):
     def stop(self):
         self._stopping = True
 
+    def dispatch_lag(self):
+        # the longest time from a poll returning to its last event being
+        # handled since the previous call
+        lag = self._dispatch_lag
+        self._dispatch_lag = 0
+        return lag
+
     def run(self):
         events = []
         while not self._stopping:
@@ -218,6 +226,7 @@ class EventLoop1(object):
                     continue
 
             handle = False
+            poll_time = time.time()
             for sock, fd, event in events:
                 handler = self._fdmap.get(fd, None)
                 if handler is not None:
@@ -228,6 +237,7 @@ class EventLoop1(object):
                     except (OSError, IOError) as e:
                         shell.print_exception(e)
             now = time.time()
+            self._dispatch_lag = max(self._dispatch_lag, now - poll_time)
             if asap or now - self._last_time >= TIMEOUT_PRECISION:
                 for callback in self._periodic_callbacks:
                     callback()
@@ -247,6 +257,7 @@ class EventLoop(object):
         self._last_time = time.time()
         self._periodic_callbacks = []
         self._stopping = False
+        self._dispatch_lag = 0
         self.loop = asyncio.get_event_loop()
         logging.debug('using event model: %s', model)
 
@@ -283,6 +294,13 @@ class EventLoop(object):
     def stop(self):
         self._stopping = True
 
+    def dispatch_lag(self):
+        # the longest time from a poll returning to its last event being
+        # handled since the previous call
+        lag = self._dispatch_lag
+        self._dispatch_lag = 0
+        return lag
+
     def run(self):
         events = []
         while not self._stopping:
@@ -302,6 +320,7 @@ class EventLoop(object):
                 import traceback
                 traceback.print_exc()
                 return
+        poll_time = time.time()
         tasks = [asyncio.coroutine(self._fdmap.get(fd)[1].handle_event)(sock, fd, event) \
             for sock, fd, event in events \
             if self._fdmap.get(fd, None) is not None]
@@ -311,13 +330,15 @@ class EventLoop(object):
             shell.print_exception(e)
         handle = functools.reduce(lambda x, y: x or y, results, False)
         now = time.time()
+        self._dispatch_lag = max(self._dispatch_lag, now - poll_time)
         tasks = []
         if asap or now - self._last_time >= TIMEOUT_PRECISION:
+            # due every TIMEOUT_PRECISION, busy or not
             tasks = [asyncio.coroutine(callback)() for callback in self._periodic_callbacks]
+            self._last_time = now
         if events and not handle:
             tasks.append(asyncio.sleep(0.001))
         await asyncio.gather(*tasks)
-        self._last_time = now
         
 
     def __del__(self):
@@ -29,6 +29,7 @@ if __name__ == '__main__':
     sys.path.insert(0, os.path.join(file_path, '../'))
 
 from shadowsocks import shell, daemon, eventloop, tcprelay, udprelay, asyncdns
+from shadowsocks.crypto import backend
 
 # copy feature from v2ray by read v2ray code
 def main():
@@ -46,6 +47,9 @@ def main():
         asyncdns.IPV6_CONNECTION_SUPPORT = False
 
     daemon.daemon_exec(config)
+    if config['cipher_autoselect']:
+        backend.select_backends([config['method']],
+                                config['cipher_backend_cache'])
     logging.info("local start with protocol[%s] password [%s] method [%s] obfs [%s] obfs_param [%s] ssr_name [%s]" %
             (config['protocol'], '', config['method'], config['obfs'], config['obfs_param'], config['ssr_name']))
 
@@ -25,7 +25,8 @@ import logging
 import json
 import collections
 
-from shadowsocks import common, eventloop, tcprelay, udprelay, asyncdns, shell
+from shadowsocks import common, eventloop, tcprelay, udprelay, asyncdns, shell, \
+    admission
 
 
 BUF_SIZE = 1506
@@ -68,6 +69,8 @@ class Manager(object):
         self._loop.add(self._control_socket,
                        eventloop.POLL_IN, self)
         self._loop.add_periodic(self.handle_periodic)
+        self._admission = admission.get_controller(self._loop, config)
+        self._admission_report = (admission.NORMAL, [], 0)
 
         port_password = config['port_password']
         del config['port_password']
@@ -172,6 +175,14 @@ class Manager(object):
             send_data(r)
         self._statistics.clear()
 
+        # admission: {"state":"soft","paused_ports":[8001],...} on changes
+        stats = self._admission.get_stats()
+        report = (stats['state'], stats['paused_ports'], stats['rejected'])
+        if report != self._admission_report:
+            self._admission_report = report
+            self._send_control_data(b'admission: ' + common.to_bytes(
+                json.dumps(stats, separators=(',', ':'))))
+
     def _send_control_data(self, data):
         if self._control_client_addr:
             try:
@@ -17,7 +17,6 @@
 from __future__ import absolute_import, division, print_function, \
     with_statement
 
-import os
 import sys
 import hashlib
 import logging
@@ -29,13 +28,16 @@ import random
 import math
 import struct
 import zlib
-import hmac
 import hashlib
 
 import shadowsocks
-from shadowsocks import common, lru_cache, encrypt
+from shadowsocks import common, encrypt, replay
 from shadowsocks.obfsplugin import plain
 from shadowsocks.common import to_bytes, to_str, ord, chr
+from shadowsocks.crypto.mac import hmac_digest, cached_hmac_digest, \
+    cached_hmac_key, HMACKey
+from shadowsocks.crypto.randpool import rand_bytes, rand_view, rand_uint8, \
+    rand_uint16, rand_uint32
 
 def create_auth_sha1_v4(method):
     return auth_sha1_v4(method)
@@ -94,89 +96,23 @@ class auth_base(plain.plain):
             return (b'E'*2048, False)
         return (buf, False)
 
-class client_queue(object):
-    def __init__(self, begin_id):
-        self.front = begin_id - 64
-        self.back = begin_id + 1
-        self.alloc = {}
-        self.enable = True
-        self.last_update = time.time()
-
-    def update(self):
-        self.last_update = time.time()
-
-    def is_active(self):
-        return time.time() - self.last_update < 60 * 3
-
-    def re_enable(self, connection_id):
-        self.enable = True
-        self.front = connection_id - 64
-        self.back = connection_id + 1
-        self.alloc = {}
-
-    def insert(self, connection_id):
-        if not self.enable:
-            logging.warn('obfs auth: not enable')
-            return False
-        if not self.is_active():
-            self.re_enable(connection_id)
-        self.update()
-        if connection_id < self.front:
-            logging.warn('obfs auth: deprecated id, someone replay attack')
-            return False
-        if connection_id > self.front + 0x4000:
-            logging.warn('obfs auth: wrong id')
-            return False
-        if connection_id in self.alloc:
-            logging.warn('obfs auth: duplicate id, someone replay attack')
-            return False
-        if self.back <= connection_id:
-            self.back = connection_id + 1
-        self.alloc[connection_id] = 1
-        while (self.front in self.alloc) or self.front + 0x1000 < self.back:
-            if self.front in self.alloc:
-                del self.alloc[self.front]
-            self.front += 1
-        return True
-
 class obfs_auth_v2_data(object):
     def __init__(self):
-        self.client_id = lru_cache.LRUCache()
         self.local_client_id = b''
         self.connection_id = 0
+        self.replay = replay.ReplayTable('auth_sha1_v2', 60 * 3)
         self.set_max_client(64) # max active client count
 
     def update(self, client_id, connection_id):
-        if client_id in self.client_id:
-            self.client_id[client_id].update()
+        self.replay.update(None, client_id)
 
     def set_max_client(self, max_client):
         self.max_client = max_client
         self.max_buffer = max(self.max_client * 2, 1024)
+        self.replay.set_max_client(max_client)
 
     def insert(self, client_id, connection_id):
-        if self.client_id.get(client_id, None) is None or not self.client_id[client_id].enable:
-            if self.client_id.first() is None or len(self.client_id) < self.max_client:
-                if client_id not in self.client_id:
-                    #TODO: check
-                    self.client_id[client_id] = client_queue(connection_id)
-                else:
-                    self.client_id[client_id].re_enable(connection_id)
-                return self.client_id[client_id].insert(connection_id)
-
-            if not self.client_id[self.client_id.first()].is_active():
-                del self.client_id[self.client_id.first()]
-                if client_id not in self.client_id:
-                    #TODO: check
-                    self.client_id[client_id] = client_queue(connection_id)
-                else:
-                    self.client_id[client_id].re_enable(connection_id)
-                return self.client_id[client_id].insert(connection_id)
-
-            logging.warn('auth_sha1_v2: no inactive client')
-            return False
-        else:
-            return self.client_id[client_id].insert(connection_id)
+        return self.replay.insert(None, client_id, connection_id)
 
 class auth_sha1_v4(auth_base):
     def __init__(self, method):
@@ -209,9 +145,9 @@ class auth_sha1_v4(auth_base):
             return b'\x01'
 
         if buf_size > 400:
-            rnd_data = os.urandom(common.ord(os.urandom(1)[0]) % 256)
+            rnd_data = rand_bytes(rand_uint8() % 256)
         else:
-            rnd_data = os.urandom(struct.unpack('>H', os.urandom(2))[0] % 512)
+            rnd_data = rand_bytes(rand_uint16() % 512)
 
         if len(rnd_data) < 128:
             return common.chr(len(rnd_data) + 1) + rnd_data
@@ -236,7 +172,7 @@ class auth_sha1_v4(auth_base):
         crc = binascii.crc32(struct.pack('>H', data_len) + self.salt + self.server_info.key) & 0xFFFFFFFF
         data = struct.pack('<I', crc) + data
         data = struct.pack('>H', data_len) + data
-        data += hmac.new(self.server_info.iv + self.server_info.key, data, hashlib.sha1).digest()[:10]
+        data += hmac_digest(self.server_info.iv + self.server_info.key, data, hashlib.sha1)[:10]
         return data
 
     def auth_data(self):
@@ -244,9 +180,9 @@ class auth_sha1_v4(auth_base):
         if self.server_info.data.connection_id > 0xFF000000:
             self.server_info.data.local_client_id = b''
         if not self.server_info.data.local_client_id:
-            self.server_info.data.local_client_id = os.urandom(4)
+            self.server_info.data.local_client_id = rand_bytes(4)
             logging.debug("local_client_id %s" % (binascii.hexlify(self.server_info.data.local_client_id),))
-            self.server_info.data.connection_id = struct.unpack('<I', os.urandom(4))[0] & 0xFFFFFF
+            self.server_info.data.connection_id = rand_uint32() & 0xFFFFFF
         self.server_info.data.connection_id += 1
         return b''.join([struct.pack('<I', utc_time),
                 self.server_info.data.local_client_id,
@@ -326,7 +262,7 @@ class auth_sha1_v4(auth_base):
             length = struct.unpack('>H', self.recv_buf[:2])[0]
             if length > len(self.recv_buf):
                 return (b'', False)
-            sha1data = hmac.new(self.server_info.recv_iv + self.server_info.key, self.recv_buf[:length - 10], hashlib.sha1).digest()[:10]
+            sha1data = hmac_digest(self.server_info.recv_iv + self.server_info.key, self.recv_buf[:length - 10], hashlib.sha1)[:10]
             if sha1data != self.recv_buf[length - 10:length]:
                 logging.error('auth_sha1_v4 data uncorrect auth HMAC-SHA1')
                 return self.not_match_return(self.recv_buf)
@@ -406,50 +342,21 @@ class auth_sha1_v4(auth_base):
 
 class obfs_auth_mu_data(object):
     def __init__(self):
-        self.user_id = {}
         self.local_client_id = b''
         self.connection_id = 0
+        self.replay = replay.ReplayTable('auth_aes128', 60 * 3)
         self.set_max_client(64) # max active client count
 
     def update(self, user_id, client_id, connection_id):
-        if user_id not in self.user_id:
-            self.user_id[user_id] = lru_cache.LRUCache()
-        local_client_id = self.user_id[user_id]
-
-        if client_id in local_client_id:
-            local_client_id[client_id].update()
+        self.replay.update(user_id, client_id)
 
     def set_max_client(self, max_client):
         self.max_client = max_client
         self.max_buffer = max(self.max_client * 2, 1024)
+        self.replay.set_max_client(max_client)
 
     def insert(self, user_id, client_id, connection_id):
-        if user_id not in self.user_id:
-            self.user_id[user_id] = lru_cache.LRUCache()
-        local_client_id = self.user_id[user_id]
-
-        if local_client_id.get(client_id, None) is None or not local_client_id[client_id].enable:
-            if local_client_id.first() is None or len(local_client_id) < self.max_client:
-                if client_id not in local_client_id:
-                    #TODO: check
-                    local_client_id[client_id] = client_queue(connection_id)
-                else:
-                    local_client_id[client_id].re_enable(connection_id)
-                return local_client_id[client_id].insert(connection_id)
-
-            if not local_client_id[local_client_id.first()].is_active():
-                del local_client_id[local_client_id.first()]
-                if client_id not in local_client_id:
-                    #TODO: check
-                    local_client_id[client_id] = client_queue(connection_id)
-                else:
-                    local_client_id[client_id].re_enable(connection_id)
-                return local_client_id[client_id].insert(connection_id)
-
-            logging.warn('auth_aes128: no inactive client')
-            return False
-        else:
-            return local_client_id[client_id].insert(connection_id)
+        return self.replay.insert(user_id, client_id, connection_id)
 
 class auth_aes128_sha1(auth_base):
     def __init__(self, method, hashfunc):
@@ -465,11 +372,12 @@ class auth_aes128_sha1(auth_base):
         self.max_time_dif = 60 * 60 * 24 # time dif (second) setting
         self.salt = hashfunc == hashlib.md5 and b"auth_aes128_md5" or b"auth_aes128_sha1"
         self.no_compatible_method = hashfunc == hashlib.md5 and "auth_aes128_md5" or 'auth_aes128_sha1'
-        self.extra_wait_size = struct.unpack('>H', os.urandom(2))[0] % 1024
+        self.extra_wait_size = rand_uint16() % 1024
         self.pack_id = 1
         self.recv_id = 1
         self.user_id = None
         self.user_key = None
+        self.user_mac = None
         self.last_rnd_len = 0
         self.overhead = 9
 
@@ -487,6 +395,15 @@ class auth_aes128_sha1(auth_base):
             max_client = 64
         self.server_info.data.set_max_client(max_client)
 
+    def set_user_key(self, user_key, is_user):
+        # keys of real users share the global HMAC cache, per connection
+        # fallback keys get a private one so they cannot evict the users
+        self.user_key = user_key
+        if is_user:
+            self.user_mac = cached_hmac_key(user_key, self.hashfunc)
+        else:
+            self.user_mac = HMACKey(user_key, self.hashfunc)
+
     def trapezoid_random_float(self, d):
         if d == 0:
             return random.random()
@@ -508,57 +425,69 @@ class auth_aes128_sha1(auth_base):
         if rev_len < 0:
             if rev_len > -tcp_mss:
                 return self.trapezoid_random_int(rev_len + tcp_mss, -0.3)
-            return common.ord(os.urandom(1)[0]) % 32
+            return rand_uint8() % 32
         if buf_size > 900:
-            return struct.unpack('>H', os.urandom(2))[0] % rev_len
+            return rand_uint16() % rev_len
         return self.trapezoid_random_int(rev_len, -0.3)
 
-    def rnd_data(self, buf_size, full_buf_size):
-        data_len = self.rnd_data_len(buf_size, full_buf_size)
-
-        if data_len < 128:
-            return common.chr(data_len + 1) + os.urandom(data_len)
-
-        return common.chr(255) + struct.pack('<H', data_len + 1) + os.urandom(data_len - 2)
-
     def pack_data(self, buf, full_buf_size):
-        data = self.rnd_data(len(buf), full_buf_size) + buf
-        data_len = len(data) + 8
-        mac_key = self.user_key + struct.pack('<I', self.pack_id)
-        mac = hmac.new(mac_key, struct.pack('<H', data_len), self.hashfunc).digest()[:2]
-        data = struct.pack('<H', data_len) + mac + data
-        data += hmac.new(mac_key, data, self.hashfunc).digest()[:4]
-        self.pack_id = (self.pack_id + 1) & 0xFFFFFFFF
-        return data
+        # frames of buf in unit_len chunks, at least one for an empty buf.
+        # The chunks are read through a memoryview and every frame is
+        # joined once into the output
+        size = len(buf)
+        if size > self.unit_len:
+            buf = memoryview(buf)
+        out = []
+        pos = 0
+        while True:
+            chunk_len = min(size - pos, self.unit_len)
+            rnd_len = self.rnd_data_len(chunk_len, full_buf_size)
+            # length, MAC of the length, padding, data, MAC of the frame
+            mac_id = struct.pack('<I', self.pack_id)
+            length = struct.pack('<H', chunk_len + rnd_len + 9)
+            if rnd_len < 128:
+                padding = common.chr(rnd_len + 1)
+                rnd_data = rand_view(rnd_len)
+            else:
+                padding = b'\xff' + struct.pack('<H', rnd_len + 1)
+                rnd_data = rand_view(rnd_len - 2)
+            mac = self.user_mac.digest(length, mac_id)[:2]
+            data = b''.join((length, mac, padding, rnd_data, buf[pos:pos + chunk_len]))
+            out.append(data)
+            out.append(self.user_mac.digest(data, mac_id)[:4])
+            self.pack_id = (self.pack_id + 1) & 0xFFFFFFFF
+            pos += chunk_len
+            if pos >= size:
+                return b''.join(out)
 
     def pack_auth_data(self, auth_data, buf):
         if len(buf) == 0:
             return b''
         if len(buf) > 400:
-            rnd_len = struct.unpack('<H', os.urandom(2))[0] % 512
+            rnd_len = rand_uint16() % 512
         else:
-            rnd_len = struct.unpack('<H', os.urandom(2))[0] % 1024
+            rnd_len = rand_uint16() % 1024
         data = auth_data
         data_len = 7 + 4 + 16 + 4 + len(buf) + rnd_len + 4
         data = data + struct.pack('<H', data_len) + struct.pack('<H', rnd_len)
         mac_key = self.server_info.iv + self.server_info.key
-        uid = os.urandom(4)
+        uid = rand_bytes(4)
         if b':' in to_bytes(self.server_info.protocol_param):
             try:
                 items = to_bytes(self.server_info.protocol_param).split(b':')
-                self.user_key = self.hashfunc(items[1]).digest()
+                self.set_user_key(self.hashfunc(items[1]).digest(), True)
                 uid = struct.pack('<I', int(items[0]))
             except:
                 pass
         if self.user_key is None:
-            self.user_key = self.server_info.key
+            self.set_user_key(self.server_info.key, False)
         encryptor = encrypt.Encryptor(to_bytes(base64.b64encode(self.user_key)) + self.salt, 'aes-128-cbc', b'\x00' * 16)
         data = uid + encryptor.encrypt(data)[16:]
-        data += hmac.new(mac_key, data, self.hashfunc).digest()[:4]
-        check_head = os.urandom(1)
-        check_head += hmac.new(mac_key, check_head, self.hashfunc).digest()[:6]
-        data = check_head + data + os.urandom(rnd_len) + buf
-        data += hmac.new(self.user_key, data, self.hashfunc).digest()[:4]
+        data += hmac_digest(mac_key, data, self.hashfunc)[:4]
+        check_head = rand_bytes(1)
+        check_head += hmac_digest(mac_key, check_head, self.hashfunc)[:6]
+        data = check_head + data + rand_view(rnd_len) + buf
+        data += self.user_mac.digest(data)[:4]
         return data
 
     def auth_data(self):
@@ -566,9 +495,9 @@ class auth_aes128_sha1(auth_base):
         if self.server_info.data.connection_id > 0xFF000000:
             self.server_info.data.local_client_id = b''
         if not self.server_info.data.local_client_id:
-            self.server_info.data.local_client_id = os.urandom(4)
+            self.server_info.data.local_client_id = rand_bytes(4)
             logging.debug("local_client_id %s" % (binascii.hexlify(self.server_info.data.local_client_id),))
-            self.server_info.data.connection_id = struct.unpack('<I', os.urandom(4))[0] & 0xFFFFFF
+            self.server_info.data.connection_id = rand_uint32() & 0xFFFFFF
         self.server_info.data.connection_id += 1
         return b''.join([struct.pack('<I', utc_time),
                 self.server_info.data.local_client_id,
@@ -580,12 +509,9 @@ class auth_aes128_sha1(auth_base):
         if not self.has_sent_header:
             head_size = self.get_head_size(buf, 30)
             datalen = min(len(buf), random.randint(0, 31) + head_size)
-            ret += self.pack_auth_data(self.auth_data(), buf[:datalen])
-            buf = buf[datalen:]
+            ret = self.pack_auth_data(self.auth_data(), buf[:datalen])
+            buf = memoryview(buf)[datalen:]
             self.has_sent_header = True
-        while len(buf) > self.unit_len:
-            ret += self.pack_data(buf[:self.unit_len], ogn_data_len)
-            buf = buf[self.unit_len:]
         ret += self.pack_data(buf, ogn_data_len)
         self.last_rnd_len = ogn_data_len
         return ret
@@ -596,8 +522,8 @@ class auth_aes128_sha1(auth_base):
         self.recv_buf += buf
         out_buf = b''
         while len(self.recv_buf) > 4:
-            mac_key = self.user_key + struct.pack('<I', self.recv_id)
-            mac = hmac.new(mac_key, self.recv_buf[:2], self.hashfunc).digest()[:2]
+            mac_id = struct.pack('<I', self.recv_id)
+            mac = self.user_mac.digest(self.recv_buf[:2], mac_id)[:2]
             if mac != self.recv_buf[2:4]:
                 raise Exception('client_post_decrypt data uncorrect mac')
             length = struct.unpack('<H', self.recv_buf[:2])[0]
@@ -608,7 +534,7 @@ class auth_aes128_sha1(auth_base):
             if length > len(self.recv_buf):
                 break
 
-            if hmac.new(mac_key, self.recv_buf[:length - 4], self.hashfunc).digest()[:4] != self.recv_buf[length - 4:length]:
+            if self.user_mac.digest(self.recv_buf[:length - 4], mac_id)[:4] != self.recv_buf[length - 4:length]:
                 self.raw_trans = True
                 self.recv_buf = b''
                 raise Exception('client_post_decrypt data uncorrect checksum')
@@ -627,12 +553,8 @@ class auth_aes128_sha1(auth_base):
     def server_pre_encrypt(self, buf):
         if self.raw_trans:
             return buf
-        ret = b''
         ogn_data_len = len(buf)
-        while len(buf) > self.unit_len:
-            ret += self.pack_data(buf[:self.unit_len], ogn_data_len)
-            buf = buf[self.unit_len:]
-        ret += self.pack_data(buf, ogn_data_len)
+        ret = self.pack_data(buf, ogn_data_len)
         self.last_rnd_len = ogn_data_len
         return ret
 
@@ -647,13 +569,13 @@ class auth_aes128_sha1(auth_base):
             if len(self.recv_buf) >= 7 or len(self.recv_buf) in [2, 3]:
                 recv_len = min(len(self.recv_buf), 7)
                 mac_key = self.server_info.recv_iv + self.server_info.key
-                sha1data = hmac.new(mac_key, self.recv_buf[:1], self.hashfunc).digest()[:recv_len - 1]
+                sha1data = hmac_digest(mac_key, self.recv_buf[:1], self.hashfunc)[:recv_len - 1]
                 if sha1data != self.recv_buf[1:recv_len]:
                     return self.not_match_return(self.recv_buf)
 
             if len(self.recv_buf) < 31:
                 return (b'', False)
-            sha1data = hmac.new(mac_key, self.recv_buf[7:27], self.hashfunc).digest()[:4]
+            sha1data = hmac_digest(mac_key, self.recv_buf[7:27], self.hashfunc)[:4]
             if sha1data != self.recv_buf[27:31]:
                 logging.error('%s data uncorrect auth HMAC-SHA1 from %s:%d, data %s' % (self.no_compatible_method, self.server_info.client, self.server_info.client_port, binascii.hexlify(self.recv_buf)))
                 if len(self.recv_buf) < 31 + self.extra_wait_size:
@@ -663,14 +585,15 @@ class auth_aes128_sha1(auth_base):
             uid = self.recv_buf[7:11]
             if uid in self.server_info.users:
                 self.user_id = uid
-                self.user_key = self.hashfunc(self.server_info.users[uid]).digest()
+                user_key = self.server_info.user_keys[uid].hashed(self.hashfunc)
                 self.server_info.update_user_func(uid)
             else:
                 if not self.server_info.users:
-                    self.user_key = self.server_info.key
+                    user_key = self.server_info.server_key
                 else:
-                    self.user_key = self.server_info.recv_iv
-            encryptor = encrypt.Encryptor(to_bytes(base64.b64encode(self.user_key)) + self.salt, 'aes-128-cbc')
+                    user_key = encrypt.UserKey(self.server_info.recv_iv)
+            self.set_user_key(user_key.key, self.user_id is not None)
+            encryptor = user_key.encryptor(self.salt, 'aes-128-cbc')
             head = encryptor.decrypt(b'\x00' * 16 + self.recv_buf[11:27] + b'\x00') # need an extra byte or recv empty
             length = struct.unpack('<H', head[12:14])[0]
             if len(self.recv_buf) < length:
@@ -680,7 +603,7 @@ class auth_aes128_sha1(auth_base):
             client_id = struct.unpack('<I', head[4:8])[0]
             connection_id = struct.unpack('<I', head[8:12])[0]
             rnd_len = struct.unpack('<H', head[14:16])[0]
-            if hmac.new(self.user_key, self.recv_buf[:length - 4], self.hashfunc).digest()[:4] != self.recv_buf[length - 4:length]:
+            if self.user_mac.digest(self.recv_buf[:length - 4])[:4] != self.recv_buf[length - 4:length]:
                 logging.info('%s: checksum error, data %s' % (self.no_compatible_method, binascii.hexlify(self.recv_buf[:length])))
                 return self.not_match_return(self.recv_buf)
             time_dif = common.int32(utc_time - (int(time.time()) & 0xffffffff))
@@ -700,8 +623,8 @@ class auth_aes128_sha1(auth_base):
             sendback = True
 
         while len(self.recv_buf) > 4:
-            mac_key = self.user_key + struct.pack('<I', self.recv_id)
-            mac = hmac.new(mac_key, self.recv_buf[:2], self.hashfunc).digest()[:2]
+            mac_id = struct.pack('<I', self.recv_id)
+            mac = self.user_mac.digest(self.recv_buf[:2], mac_id)[:2]
             if mac != self.recv_buf[2:4]:
                 self.raw_trans = True
                 logging.info(self.no_compatible_method + ': wrong crc')
@@ -722,7 +645,7 @@ class auth_aes128_sha1(auth_base):
             if length > len(self.recv_buf):
                 break
 
-            if hmac.new(mac_key, self.recv_buf[:length - 4], self.hashfunc).digest()[:4] != self.recv_buf[length - 4:length]:
+            if self.user_mac.digest(self.recv_buf[:length - 4], mac_id)[:4] != self.recv_buf[length - 4:length]:
                 logging.info('%s: checksum error, data %s' % (self.no_compatible_method, binascii.hexlify(self.recv_buf[:length])))
                 self.raw_trans = True
                 self.recv_buf = b''
@@ -751,37 +674,41 @@ class auth_aes128_sha1(auth_base):
             if b':' in to_bytes(self.server_info.protocol_param):
                 try:
                     items = to_bytes(self.server_info.protocol_param).split(':')
-                    self.user_key = self.hashfunc(items[1]).digest()
+                    self.set_user_key(self.hashfunc(items[1]).digest(), True)
                     self.user_id = struct.pack('<I', int(items[0]))
                 except:
                     pass
             if self.user_key is None:
-                self.user_id = os.urandom(4)
-                self.user_key = self.server_info.key
+                self.user_id = rand_bytes(4)
+                self.set_user_key(self.server_info.key, False)
         buf += self.user_id
-        return buf + hmac.new(self.user_key, buf, self.hashfunc).digest()[:4]
+        return buf + self.user_mac.digest(buf)[:4]
 
     def client_udp_post_decrypt(self, buf):
         user_key = self.server_info.key
-        if hmac.new(user_key, buf[:-4], self.hashfunc).digest()[:4] != buf[-4:]:
+        if hmac_digest(user_key, buf[:-4], self.hashfunc)[:4] != buf[-4:]:
             return b''
         return buf[:-4]
 
     def server_udp_pre_encrypt(self, buf, uid):
         user_key = self.server_info.key
-        return buf + hmac.new(user_key, buf, self.hashfunc).digest()[:4]
+        return buf + hmac_digest(user_key, buf, self.hashfunc)[:4]
 
     def server_udp_post_decrypt(self, buf):
         uid = buf[-8:-4]
         if uid in self.server_info.users:
-            user_key = self.hashfunc(self.server_info.users[uid]).digest()
+            user_key = self.server_info.user_keys[uid].hashed(self.hashfunc).key
         else:
             uid = None
             if not self.server_info.users:
                 user_key = self.server_info.key
             else:
                 user_key = self.server_info.recv_iv
-        if hmac.new(user_key, buf[:-4], self.hashfunc).digest()[:4] != buf[-4:]:
+        if uid is not None:
+            mac = cached_hmac_digest(user_key, buf[:-4], self.hashfunc)
+        else:
+            mac = hmac_digest(user_key, buf[:-4], self.hashfunc)
+        if mac[:4] != buf[-4:]:
             return (b'', None)
         return (buf[:-8], uid)
 
@@ -27,16 +27,16 @@ import datetime
 import random
 import math
 import struct
-import hmac
 import bisect
 
 import shadowsocks
-from shadowsocks import common, lru_cache, encrypt
+from shadowsocks import common, encrypt, replay
 from shadowsocks.obfsplugin import plain
 from shadowsocks.common import to_bytes, to_str, ord, chr
-from shadowsocks.crypto import openssl
+from shadowsocks.crypto.mac import hmac_digest, cached_hmac_digest, \
+    cached_hmac_key, HMACKey
+from shadowsocks.crypto.randpool import rand_bytes, rand_view, rand_uint32
 
-rand_bytes = openssl.rand_bytes
 
 def create_auth_chain_a(method):
     return auth_chain_a(method)
@@ -84,25 +84,29 @@ class xorshift128plus(object):
         x = self.v0
         y = self.v1
         self.v0 = y
-        x ^= ((x & xorshift128plus.mov_mask) << 23)
+        x ^= ((x & 0x1FFFFFFFFFF) << 23)
         x ^= (y ^ (x >> 17) ^ (y >> 26))
         self.v1 = x
-        return (x + y) & xorshift128plus.max_int
+        return (x + y) & 0xFFFFFFFFFFFFFFFF
 
     def init_from_bin(self, bin):
         if len(bin) < 16:
             bin += b'\0' * 16
-        self.v0 = struct.unpack('<Q', bin[:8])[0]
-        self.v1 = struct.unpack('<Q', bin[8:16])[0]
+        self.v0, self.v1 = struct.unpack_from('<QQ', bin)
 
     def init_from_bin_len(self, bin, length):
+        # called once per frame, so the four next() are run on locals
         if len(bin) < 16:
             bin += b'\0' * 16
-        self.v0 = struct.unpack('<Q', struct.pack('<H', length) + bin[2:8])[0]
-        self.v1 = struct.unpack('<Q', bin[8:16])[0]
-
+        x, y = struct.unpack_from('<QQ', bin)
+        x = (x & 0xFFFFFFFFFFFF0000) | length
         for i in range(4):
-            self.next()
+            x ^= ((x & 0x1FFFFFFFFFF) << 23)
+            x ^= (y ^ (x >> 17) ^ (y >> 26))
+            x, y = y, x
+        self.v0 = x
+        self.v1 = y
+
 
 def match_begin(str1, str2):
     if len(str1) >= len(str2):
@@ -147,121 +151,35 @@ class auth_base(plain.plain):
         return (buf, False)
 
 
-class client_queue(object):
-    def __init__(self, begin_id):
-        self.front = begin_id - 64
-        self.back = begin_id + 1
-        self.alloc = {}
-        self.enable = True
-        self.last_update = time.time()
-        self.ref = 0
-
-    def update(self):
-        self.last_update = time.time()
-
-    def addref(self):
-        self.ref += 1
-
-    def delref(self):
-        if self.ref > 0:
-            self.ref -= 1
-
-    def is_active(self):
-        return (self.ref > 0) and (time.time() - self.last_update < 60 * 10)
-
-    def re_enable(self, connection_id):
-        self.enable = True
-        self.front = connection_id - 64
-        self.back = connection_id + 1
-        self.alloc = {}
-
-    def insert(self, connection_id):
-        if not self.enable:
-            logging.warn('obfs auth: not enable')
-            return False
-        if not self.is_active():
-            self.re_enable(connection_id)
-        self.update()
-        if connection_id < self.front:
-            logging.warn('obfs auth: deprecated id, someone replay attack')
-            return False
-        if connection_id > self.front + 0x4000:
-            logging.warn('obfs auth: wrong id')
-            return False
-        if connection_id in self.alloc:
-            logging.warn('obfs auth: duplicate id, someone replay attack')
-            return False
-        if self.back <= connection_id:
-            self.back = connection_id + 1
-        self.alloc[connection_id] = 1
-        while (self.front in self.alloc) or self.front + 0x1000 < self.back:
-            if self.front in self.alloc:
-                del self.alloc[self.front]
-            self.front += 1
-        self.addref()
-        return True
-
-
 class obfs_auth_chain_data(object):
     def __init__(self, name):
         self.name = name
-        self.user_id = {}
         self.local_client_id = b''
         self.connection_id = 0
+        # a client stays active for 10 minutes while it has connections open
+        self.replay = replay.ReplayTable(name, 60 * 10, True)
         self.set_max_client(64)  # max active client count
 
     def update(self, user_id, client_id, connection_id):
-        if user_id not in self.user_id:
-            self.user_id[user_id] = lru_cache.LRUCache()
-        local_client_id = self.user_id[user_id]
-
-        if client_id in local_client_id:
-            local_client_id[client_id].update()
+        self.replay.update(user_id, client_id)
 
     def set_max_client(self, max_client):
         self.max_client = max_client
         self.max_buffer = max(self.max_client * 2, 1024)
+        self.replay.set_max_client(max_client)
 
     def insert(self, user_id, client_id, connection_id):
-        if user_id not in self.user_id:
-            self.user_id[user_id] = lru_cache.LRUCache()
-        local_client_id = self.user_id[user_id]
-
-        if local_client_id.get(client_id, None) is None or not local_client_id[client_id].enable:
-            if local_client_id.first() is None or len(local_client_id) < self.max_client:
-                if client_id not in local_client_id:
-                    # TODO: check
-                    local_client_id[client_id] = client_queue(connection_id)
-                else:
-                    local_client_id[client_id].re_enable(connection_id)
-                return local_client_id[client_id].insert(connection_id)
-
-            if not local_client_id[local_client_id.first()].is_active():
-                del local_client_id[local_client_id.first()]
-                if client_id not in local_client_id:
-                    # TODO: check
-                    local_client_id[client_id] = client_queue(connection_id)
-                else:
-                    local_client_id[client_id].re_enable(connection_id)
-                return local_client_id[client_id].insert(connection_id)
-
-            logging.warn(self.name + ': no inactive client')
-            return False
-        else:
-            return local_client_id[client_id].insert(connection_id)
+        return self.replay.insert(user_id, client_id, connection_id)
 
     def remove(self, user_id, client_id):
-        if user_id in self.user_id:
-            local_client_id = self.user_id[user_id]
-            if client_id in local_client_id:
-                local_client_id[client_id].delref()
+        self.replay.remove(user_id, client_id)
 
 
 class auth_chain_a(auth_base):
     def __init__(self, method):
         super(auth_chain_a, self).__init__(method)
         self.hashfunc = hashlib.md5
-        self.recv_buf = b''
+        self.recv_buf = bytearray()
         self.unit_len = 2800
         self.raw_trans = False
         self.has_sent_header = False
@@ -276,6 +194,7 @@ class auth_chain_a(auth_base):
         self.user_id = None
         self.user_id_num = 0
         self.user_key = None
+        self.user_mac = None
         self.overhead = 4
         self.client_over_head = 4
         self.last_client_hash = b''
@@ -298,6 +217,15 @@ class auth_chain_a(auth_base):
             max_client = 64
         self.server_info.data.set_max_client(max_client)
 
+    def set_user_key(self, user_key, is_user):
+        # keys of real users share the global HMAC cache, per connection
+        # fallback keys get a private one so they cannot evict the users
+        self.user_key = user_key
+        if is_user:
+            self.user_mac = cached_hmac_key(user_key, self.hashfunc)
+        else:
+            self.user_mac = HMACKey(user_key, self.hashfunc)
+
     def trapezoid_random_float(self, d):
         if d == 0:
             return random.random()
@@ -330,41 +258,46 @@ class auth_chain_a(auth_base):
             return random.next() % 8589934609 % rand_len
         return 0
 
-    def rnd_data(self, buf_size, buf, last_hash, random):
-        rand_len = self.rnd_data_len(buf_size, last_hash, random)
-
-        rnd_data_buf = rand_bytes(rand_len)
-
-        if buf_size == 0:
-            return rnd_data_buf
-        else:
-            if rand_len > 0:
+    def pack_frames(self, buf, last_hash, random, out):
+        # append the frames of buf in unit_len chunks to the bytearray out,
+        # at least one for an empty buf, and return the hash of the last.
+        # The padding of a frame depends on the hash of the one before, so
+        # the frames are appended instead of sized up front
+        buf = self.encryptor.encrypt(buf)
+        view = memoryview(buf)
+        size = len(buf)
+        pos = 0
+        while True:
+            chunk_len = min(size - pos, self.unit_len)
+            rand_len = self.rnd_data_len(chunk_len, last_hash, random)
+            start = len(out)
+            out += struct.pack('<H', chunk_len ^ struct.unpack_from('<H', last_hash, 14)[0])
+            rnd_data = rand_view(rand_len)
+            if chunk_len > 0 and rand_len > 0:
                 start_pos = self.rnd_start_pos(rand_len, random)
-                return rnd_data_buf[:start_pos] + buf + rnd_data_buf[start_pos:]
+                out += rnd_data[:start_pos]
+                out += view[pos:pos + chunk_len]
+                out += rnd_data[start_pos:]
             else:
-                return buf
+                out += rnd_data
+                out += view[pos:pos + chunk_len]
+            mac_id = struct.pack('<I', self.pack_id)
+            last_hash = self.user_mac.digest(memoryview(out)[start:], mac_id)
+            out += last_hash[:2]
+            self.pack_id = (self.pack_id + 1) & 0xFFFFFFFF
+            pos += chunk_len
+            if pos >= size:
+                return last_hash
 
     def pack_client_data(self, buf):
-        buf = self.encryptor.encrypt(buf)
-        data = self.rnd_data(len(buf), buf, self.last_client_hash, self.random_client)
-        mac_key = self.user_key + struct.pack('<I', self.pack_id)
-        length = len(buf) ^ struct.unpack('<H', self.last_client_hash[14:])[0]
-        data = struct.pack('<H', length) + data
-        self.last_client_hash = hmac.new(mac_key, data, self.hashfunc).digest()
-        data += self.last_client_hash[:2]
-        self.pack_id = (self.pack_id + 1) & 0xFFFFFFFF
-        return data
+        out = bytearray()
+        self.last_client_hash = self.pack_frames(buf, self.last_client_hash, self.random_client, out)
+        return bytes(out)
 
     def pack_server_data(self, buf):
-        buf = self.encryptor.encrypt(buf)
-        data = self.rnd_data(len(buf), buf, self.last_server_hash, self.random_server)
-        mac_key = self.user_key + struct.pack('<I', self.pack_id)
-        length = len(buf) ^ struct.unpack('<H', self.last_server_hash[14:])[0]
-        data = struct.pack('<H', length) + data
-        self.last_server_hash = hmac.new(mac_key, data, self.hashfunc).digest()
-        data += self.last_server_hash[:2]
-        self.pack_id = (self.pack_id + 1) & 0xFFFFFFFF
-        return data
+        out = bytearray()
+        self.last_server_hash = self.pack_frames(buf, self.last_server_hash, self.random_server, out)
+        return bytes(out)
 
     def pack_auth_data(self, auth_data, buf):
         data = auth_data
@@ -372,20 +305,20 @@ class auth_chain_a(auth_base):
         mac_key = self.server_info.iv + self.server_info.key
 
         check_head = rand_bytes(4)
-        self.last_client_hash = hmac.new(mac_key, check_head, self.hashfunc).digest()
+        self.last_client_hash = hmac_digest(mac_key, check_head, self.hashfunc)
         check_head += self.last_client_hash[:8]
 
         if b':' in to_bytes(self.server_info.protocol_param):
             try:
                 items = to_bytes(self.server_info.protocol_param).split(b':')
-                self.user_key = items[1]
+                self.set_user_key(items[1], True)
                 uid = struct.pack('<I', int(items[0]))
             except:
                 uid = rand_bytes(4)
         else:
             uid = rand_bytes(4)
         if self.user_key is None:
-            self.user_key = self.server_info.key
+            self.set_user_key(self.server_info.key, False)
 
         encryptor = encrypt.Encryptor(
             to_bytes(base64.b64encode(self.user_key)) + self.salt, 'aes-128-cbc', b'\x00' * 16)
@@ -393,7 +326,7 @@ class auth_chain_a(auth_base):
         uid = struct.unpack('<I', uid)[0] ^ struct.unpack('<I', self.last_client_hash[8:12])[0]
         uid = struct.pack('<I', uid)
         data = uid + encryptor.encrypt(data)[16:]
-        self.last_server_hash = hmac.new(self.user_key, data, self.hashfunc).digest()
+        self.last_server_hash = self.user_mac.digest(data)
         data = check_head + data + self.last_server_hash[:4]
         self.encryptor = encrypt.Encryptor(
             to_bytes(base64.b64encode(self.user_key)) + to_bytes(base64.b64encode(self.last_client_hash)), 'rc4')
@@ -406,7 +339,7 @@ class auth_chain_a(auth_base):
         if not self.server_info.data.local_client_id:
             self.server_info.data.local_client_id = rand_bytes(4)
             logging.debug("local_client_id %s" % (binascii.hexlify(self.server_info.data.local_client_id),))
-            self.server_info.data.connection_id = struct.unpack('<I', rand_bytes(4))[0] & 0xFFFFFF
+            self.server_info.data.connection_id = rand_uint32() & 0xFFFFFF
         self.server_info.data.connection_id += 1
         return b''.join([struct.pack('<I', utc_time),
                          self.server_info.data.local_client_id,
@@ -416,88 +349,90 @@ class auth_chain_a(auth_base):
         pass
 
     def client_pre_encrypt(self, buf):
-        ret = b''
-        ogn_data_len = len(buf)
+        out = bytearray()
         if not self.has_sent_header:
             head_size = self.get_head_size(buf, 30)
             datalen = min(len(buf), random.randint(0, 31) + head_size)
-            ret += self.pack_auth_data(self.auth_data(), buf[:datalen])
+            out += self.pack_auth_data(self.auth_data(), buf[:datalen])
             buf = buf[datalen:]
             self.has_sent_header = True
-        while len(buf) > self.unit_len:
-            ret += self.pack_client_data(buf[:self.unit_len])
-            buf = buf[self.unit_len:]
-        ret += self.pack_client_data(buf)
-        return ret
+        self.last_client_hash = self.pack_frames(buf, self.last_client_hash, self.random_client, out)
+        return bytes(out)
 
     def client_post_decrypt(self, buf):
         if self.raw_trans:
             return buf
-        self.recv_buf += buf
-        out_buf = b''
-        while len(self.recv_buf) > 4:
-            mac_key = self.user_key + struct.pack('<I', self.recv_id)
-            data_len = struct.unpack('<H', self.recv_buf[:2])[0] ^ struct.unpack('<H', self.last_server_hash[14:16])[0]
+        recv_buf = self.recv_buf
+        recv_buf += buf
+        view = memoryview(recv_buf)
+        out_buf = []
+        pos = 0
+        end = len(recv_buf)
+        while end - pos > 4:
+            mac_id = struct.pack('<I', self.recv_id)
+            data_len = struct.unpack_from('<H', recv_buf, pos)[0] ^ \
+                struct.unpack_from('<H', self.last_server_hash, 14)[0]
             rand_len = self.rnd_data_len(data_len, self.last_server_hash, self.random_server)
             length = data_len + rand_len
             if length >= 4096:
                 self.raw_trans = True
-                self.recv_buf = b''
+                del view
+                self.recv_buf = bytearray()
                 raise Exception('client_post_decrypt data error')
 
-            if length + 4 > len(self.recv_buf):
+            if pos + length + 4 > end:
                 break
 
-            server_hash = hmac.new(mac_key, self.recv_buf[:length + 2], self.hashfunc).digest()
-            if server_hash[:2] != self.recv_buf[length + 2: length + 4]:
+            server_hash = self.user_mac.digest(view[pos:pos + length + 2], mac_id)
+            if server_hash[:2] != recv_buf[pos + length + 2:pos + length + 4]:
                 logging.info('%s: checksum error, data %s'
-                             % (self.no_compatible_method, binascii.hexlify(self.recv_buf[:length])))
+                             % (self.no_compatible_method, binascii.hexlify(recv_buf[pos:pos + length])))
                 self.raw_trans = True
-                self.recv_buf = b''
+                del view
+                self.recv_buf = bytearray()
                 raise Exception('client_post_decrypt data uncorrect checksum')
 
-            pos = 2
+            start = pos + 2
             if data_len > 0 and rand_len > 0:
-                pos = 2 + self.rnd_start_pos(rand_len, self.random_server)
-            out_buf += self.encryptor.decrypt(self.recv_buf[pos: data_len + pos])
+                start += self.rnd_start_pos(rand_len, self.random_server)
+            data = self.encryptor.decrypt(view[start:start + data_len].tobytes())
             self.last_server_hash = server_hash
             if self.recv_id == 1:
-                self.server_info.tcp_mss = struct.unpack('<H', out_buf[:2])[0]
-                out_buf = out_buf[2:]
+                self.server_info.tcp_mss = struct.unpack('<H', data[:2])[0]
+                data = data[2:]
+            out_buf.append(data)
             self.recv_id = (self.recv_id + 1) & 0xFFFFFFFF
-            self.recv_buf = self.recv_buf[length + 4:]
+            pos += length + 4
 
-        return out_buf
+        # drop the decoded frames once per call instead of once per frame
+        del view
+        if pos:
+            del recv_buf[:pos]
+        return b''.join(out_buf)
 
     def server_pre_encrypt(self, buf):
         if self.raw_trans:
             return buf
-        ret = b''
         if self.pack_id == 1:
             tcp_mss = self.server_info.tcp_mss if self.server_info.tcp_mss < 1500 else 1500
             self.server_info.tcp_mss = tcp_mss
             buf = struct.pack('<H', tcp_mss) + buf
             self.unit_len = tcp_mss - self.client_over_head
-        while len(buf) > self.unit_len:
-            ret += self.pack_server_data(buf[:self.unit_len])
-            buf = buf[self.unit_len:]
-        ret += self.pack_server_data(buf)
-        return ret
+        return self.pack_server_data(buf)
 
     def server_post_decrypt(self, buf):
         if self.raw_trans:
             return (buf, False)
         self.recv_buf += buf
-        out_buf = b''
         sendback = False
 
         if not self.has_recv_header:
             if len(self.recv_buf) >= 12 or len(self.recv_buf) in [7, 8]:
                 recv_len = min(len(self.recv_buf), 12)
                 mac_key = self.server_info.recv_iv + self.server_info.key
-                md5data = hmac.new(mac_key, self.recv_buf[:4], self.hashfunc).digest()
+                md5data = hmac_digest(mac_key, self.recv_buf[:4], self.hashfunc)
                 if md5data[:recv_len - 4] != self.recv_buf[4:recv_len]:
-                    return self.not_match_return(self.recv_buf)
+                    return self.not_match_return(bytes(self.recv_buf))
 
             if len(self.recv_buf) < 12 + 24:
                 return (b'', False)
@@ -508,16 +443,17 @@ class auth_chain_a(auth_base):
             uid = struct.pack('<I', uid)
             if uid in self.server_info.users:
                 self.user_id = uid
-                self.user_key = self.server_info.users[uid]
+                user_key = self.server_info.user_keys[uid]
                 self.server_info.update_user_func(uid)
             else:
                 self.user_id_num = 0
                 if not self.server_info.users:
-                    self.user_key = self.server_info.key
+                    user_key = self.server_info.server_key
                 else:
-                    self.user_key = self.server_info.recv_iv
+                    user_key = encrypt.UserKey(self.server_info.recv_iv)
+            self.set_user_key(user_key.key, self.user_id is not None)
 
-            md5data = hmac.new(self.user_key, self.recv_buf[12: 12 + 20], self.hashfunc).digest()
+            md5data = self.user_mac.digest(self.recv_buf[12: 12 + 20])
             if md5data[:4] != self.recv_buf[32:36]:
                 logging.error('%s data uncorrect auth HMAC-MD5 from %s:%d, data %s' % (
                     self.no_compatible_method, self.server_info.client, self.server_info.client_port,
@@ -525,10 +461,10 @@ class auth_chain_a(auth_base):
                 ))
                 if len(self.recv_buf) < 36:
                     return (b'', False)
-                return self.not_match_return(self.recv_buf)
+                return self.not_match_return(bytes(self.recv_buf))
 
             self.last_server_hash = md5data
-            encryptor = encrypt.Encryptor(to_bytes(base64.b64encode(self.user_key)) + self.salt, 'aes-128-cbc')
+            encryptor = user_key.encryptor(self.salt, 'aes-128-cbc')
             head = encryptor.decrypt(b'\x00' * 16 + self.recv_buf[16:32] + b'\x00')  # need an extra byte or recv empty
             self.client_over_head = struct.unpack('<H', head[12:14])[0]
 
@@ -540,61 +476,73 @@ class auth_chain_a(auth_base):
                 logging.info('%s: wrong timestamp, time_dif %d, data %s' % (
                     self.no_compatible_method, time_dif, binascii.hexlify(head)
                 ))
-                return self.not_match_return(self.recv_buf)
+                return self.not_match_return(bytes(self.recv_buf))
             elif self.server_info.data.insert(self.user_id, client_id, connection_id):
                 self.has_recv_header = True
                 self.client_id = client_id
                 self.connection_id = connection_id
             else:
-                logging.info('%s: auth fail, data %s' % (self.no_compatible_method, binascii.hexlify(out_buf)))
-                return self.not_match_return(self.recv_buf)
+                logging.info('%s: auth fail, data %s' % (self.no_compatible_method, binascii.hexlify(head)))
+                return self.not_match_return(bytes(self.recv_buf))
 
             self.on_recv_auth_data(utc_time)
             self.encryptor = encrypt.Encryptor(
-                to_bytes(base64.b64encode(self.user_key)) + to_bytes(base64.b64encode(self.last_client_hash)), 'rc4')
-            self.recv_buf = self.recv_buf[36:]
+                user_key.b64 + to_bytes(base64.b64encode(self.last_client_hash)), 'rc4')
+            del self.recv_buf[:36]
             self.has_recv_header = True
             sendback = True
 
-        while len(self.recv_buf) > 4:
-            mac_key = self.user_key + struct.pack('<I', self.recv_id)
-            data_len = struct.unpack('<H', self.recv_buf[:2])[0] ^ struct.unpack('<H', self.last_client_hash[14:16])[0]
+        recv_buf = self.recv_buf
+        view = memoryview(recv_buf)
+        out_buf = []
+        pos = 0
+        end = len(recv_buf)
+        while end - pos > 4:
+            mac_id = struct.pack('<I', self.recv_id)
+            data_len = struct.unpack_from('<H', recv_buf, pos)[0] ^ \
+                struct.unpack_from('<H', self.last_client_hash, 14)[0]
             rand_len = self.rnd_data_len(data_len, self.last_client_hash, self.random_client)
             length = data_len + rand_len
             if length >= 4096:
                 self.raw_trans = True
-                self.recv_buf = b''
+                del view
+                self.recv_buf = bytearray()
                 if self.recv_id == 1:
                     logging.info(self.no_compatible_method + ': over size')
                     return (b'E' * 2048, False)
                 else:
                     raise Exception('server_post_decrype data error')
 
-            if length + 4 > len(self.recv_buf):
+            if pos + length + 4 > end:
                 break
 
-            client_hash = hmac.new(mac_key, self.recv_buf[:length + 2], self.hashfunc).digest()
-            if client_hash[:2] != self.recv_buf[length + 2: length + 4]:
+            client_hash = self.user_mac.digest(view[pos:pos + length + 2], mac_id)
+            if client_hash[:2] != recv_buf[pos + length + 2:pos + length + 4]:
                 logging.info('%s: checksum error, data %s' % (
-                    self.no_compatible_method, binascii.hexlify(self.recv_buf[:length])
+                    self.no_compatible_method, binascii.hexlify(recv_buf[pos:pos + length])
                 ))
                 self.raw_trans = True
-                self.recv_buf = b''
+                del view
+                self.recv_buf = bytearray()
                 if self.recv_id == 1:
                     return (b'E' * 2048, False)
                 else:
                     raise Exception('server_post_decrype data uncorrect checksum')
 
             self.recv_id = (self.recv_id + 1) & 0xFFFFFFFF
-            pos = 2
+            start = pos + 2
             if data_len > 0 and rand_len > 0:
-                pos = 2 + self.rnd_start_pos(rand_len, self.random_client)
-            out_buf += self.encryptor.decrypt(self.recv_buf[pos: data_len + pos])
+                start += self.rnd_start_pos(rand_len, self.random_client)
+            out_buf.append(self.encryptor.decrypt(view[start:start + data_len].tobytes()))
             self.last_client_hash = client_hash
-            self.recv_buf = self.recv_buf[length + 4:]
+            pos += length + 4
             if data_len == 0:
                 sendback = True
 
+        del view
+        if pos:
+            del recv_buf[:pos]
+        out_buf = b''.join(out_buf)
         if out_buf:
             self.server_info.data.update(self.user_id, self.client_id, self.connection_id)
         return (out_buf, sendback)
@@ -604,32 +552,32 @@ class auth_chain_a(auth_base):
             if b':' in to_bytes(self.server_info.protocol_param):
                 try:
                     items = to_bytes(self.server_info.protocol_param).split(':')
-                    self.user_key = self.hashfunc(items[1]).digest()
+                    self.set_user_key(self.hashfunc(items[1]).digest(), True)
                     self.user_id = struct.pack('<I', int(items[0]))
                 except:
                     pass
             if self.user_key is None:
                 self.user_id = rand_bytes(4)
-                self.user_key = self.server_info.key
+                self.set_user_key(self.server_info.key, False)
         authdata = rand_bytes(3)
         mac_key = self.server_info.key
-        md5data = hmac.new(mac_key, authdata, self.hashfunc).digest()
+        md5data = hmac_digest(mac_key, authdata, self.hashfunc)
         uid = struct.unpack('<I', self.user_id)[0] ^ struct.unpack('<I', md5data[:4])[0]
         uid = struct.pack('<I', uid)
         rand_len = self.udp_rnd_data_len(md5data, self.random_client)
         encryptor = encrypt.Encryptor(
             to_bytes(base64.b64encode(self.user_key)) + to_bytes(base64.b64encode(md5data)), 'rc4')
         out_buf = encryptor.encrypt(buf)
-        buf = out_buf + rand_bytes(rand_len) + authdata + uid
-        return buf + hmac.new(self.user_key, buf, self.hashfunc).digest()[:1]
+        buf = out_buf + rand_view(rand_len) + authdata + uid
+        return buf + self.user_mac.digest(buf)[:1]
 
     def client_udp_post_decrypt(self, buf):
         if len(buf) <= 8:
             return (b'', None)
-        if hmac.new(self.user_key, buf[:-1], self.hashfunc).digest()[:1] != buf[-1:]:
+        if self.user_mac.digest(buf[:-1])[:1] != buf[-1:]:
             return (b'', None)
         mac_key = self.server_info.key
-        md5data = hmac.new(mac_key, buf[-8:-1], self.hashfunc).digest()
+        md5data = hmac_digest(mac_key, buf[-8:-1], self.hashfunc)
         rand_len = self.udp_rnd_data_len(md5data, self.random_server)
         encryptor = encrypt.Encryptor(
             to_bytes(base64.b64encode(self.user_key)) + to_bytes(base64.b64encode(md5data)), 'rc4')
@@ -637,39 +585,47 @@ class auth_chain_a(auth_base):
 
     def server_udp_pre_encrypt(self, buf, uid):
         if uid in self.server_info.users:
-            user_key = self.server_info.users[uid]
+            user_key = self.server_info.user_keys[uid]
         else:
             uid = None
             if not self.server_info.users:
-                user_key = self.server_info.key
+                user_key = self.server_info.server_key
             else:
-                user_key = self.server_info.recv_iv
+                user_key = encrypt.UserKey(self.server_info.recv_iv)
         authdata = rand_bytes(7)
         mac_key = self.server_info.key
-        md5data = hmac.new(mac_key, authdata, self.hashfunc).digest()
+        md5data = hmac_digest(mac_key, authdata, self.hashfunc)
         rand_len = self.udp_rnd_data_len(md5data, self.random_server)
-        encryptor = encrypt.Encryptor(to_bytes(base64.b64encode(user_key)) + to_bytes(base64.b64encode(md5data)), 'rc4')
+        encryptor = encrypt.Encryptor(user_key.b64 + to_bytes(base64.b64encode(md5data)), 'rc4')
         out_buf = encryptor.encrypt(buf)
-        buf = out_buf + rand_bytes(rand_len) + authdata
-        return buf + hmac.new(user_key, buf, self.hashfunc).digest()[:1]
+        buf = out_buf + rand_view(rand_len) + authdata
+        if uid is not None:
+            mac = cached_hmac_digest(user_key.key, buf, self.hashfunc)
+        else:
+            mac = hmac_digest(user_key.key, buf, self.hashfunc)
+        return buf + mac[:1]
 
     def server_udp_post_decrypt(self, buf):
         mac_key = self.server_info.key
-        md5data = hmac.new(mac_key, buf[-8:-5], self.hashfunc).digest()
+        md5data = hmac_digest(mac_key, buf[-8:-5], self.hashfunc)
         uid = struct.unpack('<I', buf[-5:-1])[0] ^ struct.unpack('<I', md5data[:4])[0]
         uid = struct.pack('<I', uid)
         if uid in self.server_info.users:
-            user_key = self.server_info.users[uid]
+            user_key = self.server_info.user_keys[uid]
         else:
             uid = None
             if not self.server_info.users:
-                user_key = self.server_info.key
+                user_key = self.server_info.server_key
             else:
-                user_key = self.server_info.recv_iv
-        if hmac.new(user_key, buf[:-1], self.hashfunc).digest()[:1] != buf[-1:]:
+                user_key = encrypt.UserKey(self.server_info.recv_iv)
+        if uid is not None:
+            mac = cached_hmac_digest(user_key.key, buf[:-1], self.hashfunc)
+        else:
+            mac = hmac_digest(user_key.key, buf[:-1], self.hashfunc)
+        if mac[:1] != buf[-1:]:
             return (b'', None)
         rand_len = self.udp_rnd_data_len(md5data, self.random_client)
-        encryptor = encrypt.Encryptor(to_bytes(base64.b64encode(user_key)) + to_bytes(base64.b64encode(md5data)), 'rc4')
+        encryptor = encrypt.Encryptor(user_key.b64 + to_bytes(base64.b64encode(md5data)), 'rc4')
         out_buf = encryptor.decrypt(buf[:-8 - rand_len])
         return (out_buf, uid)
 
@@ -915,3 +871,15 @@ class auth_chain_f(auth_chain_e):
         # if check_and_patch_data_size are work, re-sort again.
         if old_len != len(self.data_size_list0):
             self.data_size_list0.sort()
+
+
+def test_xorshift128plus():
+    last_hash = bytes(bytearray(range(16)))
+    random = xorshift128plus()
+    random.init_from_bin_len(last_hash, 1300)
+    expected = xorshift128plus()
+    expected.init_from_bin(struct.pack('<H', 1300) + last_hash[2:])
+    for i in range(4):
+        expected.next()
+    assert (random.v0, random.v1) == (expected.v0, expected.v1)
+    assert random.next() == expected.next()
@@ -17,7 +17,6 @@
 from __future__ import absolute_import, division, print_function, \
     with_statement
 
-import os
 import sys
 import hashlib
 import logging
@@ -30,6 +29,7 @@ import random
 from shadowsocks import common
 from shadowsocks.obfsplugin import plain
 from shadowsocks.common import to_bytes, to_str, ord, chr
+from shadowsocks.crypto.randpool import rand_bytes, rand_uint8
 
 def create_http_simple_obfs(method):
     return http_simple(method)
@@ -49,12 +49,41 @@ obfs_map = {
         'random_head_compatible': (create_random_head_obfs,),
 }
 
+# longest request header the server reads before giving up, see
+# set_header_limit
+HEADER_LIMIT = 8192
+
 def match_begin(str1, str2):
     if len(str1) >= len(str2):
         if str1[:len(str2)] == str2:
             return True
     return False
 
+def set_header_limit(limit):
+    global HEADER_LIMIT
+    HEADER_LIMIT = limit
+
+def parse_http_header(header):
+    # (data encoded in the request path, Host) of a request header without
+    # the blank line, the host is None when there is no Host line
+    lines = header.split(b'\r\n')
+    hex_items = lines[0].split(b'%')
+    chunks = []
+    for item in hex_items[1:]:
+        if len(item) < 2:
+            chunks.append(b'0' + item)
+            break
+        elif len(item) > 2:
+            chunks.append(item[:2])
+            break
+        chunks.append(item)
+    host = None
+    for line in lines[1:]:
+        if match_begin(line, b"Host: "):
+            host = common.to_str(line[6:])
+            break
+    return binascii.unhexlify(b''.join(chunks)), host
+
 class http_simple(plain.plain):
     def __init__(self, method):
         self.method = method
@@ -62,7 +91,11 @@ class http_simple(plain.plain):
         self.has_recv_header = False
         self.host = None
         self.port = 0
-        self.recv_buffer = b''
+        self.recv_buffer = bytearray()
+        # where the search for the end of the header goes on
+        self.scan_pos = 0
+        # set when a _compatible server passes data through
+        self.raw_trans = False
         # TODO user config user_agent
         self.user_agent = [b"Mozilla/5.0 (Windows NT 6.3; WOW64; rv:40.0) Gecko/20100101 Firefox/40.0",
             b"Mozilla/5.0 (Windows NT 6.3; WOW64; rv:40.0) Gecko/20100101 Firefox/44.0",
@@ -136,37 +169,12 @@ class http_simple(plain.plain):
         self.has_sent_header = True
         return header + buf
 
-    def get_data_from_http_header(self, buf):
-        ret_buf = b''
-        lines = buf.split(b'\r\n')
-        if lines and len(lines) > 1:
-            hex_items = lines[0].split(b'%')
-            if hex_items and len(hex_items) > 1:
-                for index in range(1, len(hex_items)):
-                    if len(hex_items[index]) < 2:
-                        ret_buf += binascii.unhexlify('0' + hex_items[index])
-                        break
-                    elif len(hex_items[index]) > 2:
-                        ret_buf += binascii.unhexlify(hex_items[index][:2])
-                        break
-                    else:
-                        ret_buf += binascii.unhexlify(hex_items[index])
-                return ret_buf
-        return b''
-
-    def get_host_from_http_header(self, buf):
-        ret_buf = b''
-        lines = buf.split(b'\r\n')
-        if lines and len(lines) > 1:
-            for line in lines:
-                if match_begin(line, b"Host: "):
-                    return common.to_str(line[6:])
-
     def not_match_return(self, buf):
         self.has_sent_header = True
         self.has_recv_header = True
         if self.method == 'http_simple':
             return (b'E'*2048, False, False)
+        self.raw_trans = True
         return (buf, True, False)
 
     def error_return(self, buf):
@@ -174,46 +182,53 @@ class http_simple(plain.plain):
         self.has_recv_header = True
         return (b'E'*2048, False, False)
 
+    def server_fallback(self, buf):
+        if self.has_recv_header or not self.method.endswith('_compatible'):
+            return False
+        if match_begin(b'GET ', buf[:4]) or match_begin(b'POST ', buf[:5]):
+            return False
+        self.recv_buffer = None
+        self.not_match_return(buf)
+        return True
+
     def server_decode(self, buf):
         if self.has_recv_header:
             return (buf, True, False)
 
         self.recv_buffer += buf
         buf = self.recv_buffer
-        if len(buf) > 10:
-            if match_begin(buf, b'GET ') or match_begin(buf, b'POST '):
-                if len(buf) > 65536:
-                    self.recv_buffer = None
-                    logging.warn('http_simple: over size')
-                    return self.not_match_return(buf)
-            else: #not http header, run on original protocol
+        if not (match_begin(b'GET ', buf[:4]) or match_begin(b'POST ', buf[:5])):
+            # not http header, run on original protocol
+            self.recv_buffer = None
+            logging.debug('http_simple: not match begin')
+            return self.not_match_return(bytes(buf))
+
+        # only the new bytes and the three before them are searched
+        end = buf.find(b'\r\n\r\n', self.scan_pos, HEADER_LIMIT + 4)
+        if end < 0:
+            if len(buf) >= HEADER_LIMIT + 4:
                 self.recv_buffer = None
-                logging.debug('http_simple: not match begin')
-                return self.not_match_return(buf)
-        else:
+                logging.warn('http_simple: over size')
+                return self.not_match_return(bytes(buf))
+            self.scan_pos = max(len(buf) - 3, 0)
             return (b'', True, False)
 
-        if b'\r\n\r\n' in buf:
-            datas = buf.split(b'\r\n\r\n', 1)
-            ret_buf = self.get_data_from_http_header(buf)
-            host = self.get_host_from_http_header(buf)
-            if host and self.server_info.obfs_param:
-                pos = host.find(":")
-                if pos >= 0:
-                    host = host[:pos]
-                hosts = self.server_info.obfs_param.split(',')
-                if host not in hosts:
-                    return self.not_match_return(buf)
-            if len(ret_buf) < 4:
-                return self.error_return(buf)
-            if len(datas) > 1:
-                ret_buf += datas[1]
-            if len(ret_buf) >= 13:
-                self.has_recv_header = True
-                return (ret_buf, True, False)
-            return self.not_match_return(buf)
-        else:
-            return (b'', True, False)
+        ret_buf, host = parse_http_header(bytes(buf[:end]))
+        if host and self.server_info.obfs_param:
+            pos = host.find(":")
+            if pos >= 0:
+                host = host[:pos]
+            hosts = self.server_info.obfs_param.split(',')
+            if host not in hosts:
+                return self.not_match_return(bytes(buf))
+        if len(ret_buf) < 4:
+            return self.error_return(buf)
+        ret_buf += bytes(buf[end + 4:])
+        if len(ret_buf) >= 13:
+            self.has_recv_header = True
+            self.recv_buffer = None
+            return (ret_buf, True, False)
+        return self.not_match_return(bytes(buf))
 
 class http_post(http_simple):
     def __init__(self, method):
@@ -260,6 +275,7 @@ class http_post(http_simple):
         self.has_recv_header = True
         if self.method == 'http_post':
             return (b'E'*2048, False, False)
+        self.raw_trans = True
         return (buf, True, False)
 
 class random_head(plain.plain):
@@ -277,7 +293,7 @@ class random_head(plain.plain):
         self.send_buffer += buf
         if not self.has_sent_header:
             self.has_sent_header = True
-            data = os.urandom(common.ord(os.urandom(1)[0]) % 96 + 4)
+            data = rand_bytes(rand_uint8() % 96 + 4)
             crc = (0xffffffff - binascii.crc32(data)) & 0xffffffff
             return data + struct.pack('<I', crc)
         if self.raw_trans_recv:
@@ -297,7 +313,7 @@ class random_head(plain.plain):
         if self.has_sent_header:
             return buf
         self.has_sent_header = True
-        return os.urandom(common.ord(os.urandom(1)[0]) % 96 + 4)
+        return rand_bytes(rand_uint8() % 96 + 4)
 
     def server_decode(self, buf):
         if self.has_recv_header:
@@ -313,3 +329,29 @@ class random_head(plain.plain):
         # (buffer_to_recv, is_need_decrypt, is_need_to_encode_and_send_back)
         return (b'', False, True)
 
+
+
+def test_server_decode():
+    from shadowsocks import pipeline
+
+    payload = b'\x03\x0bexample.com\x00\x50' + b'x' * 100
+    for name in ('http_simple', 'http_post'):
+        client = pipeline.new_plugin(name, 'aes-128-cfb', b'i' * 16, True)
+        server = pipeline.new_plugin(name, 'aes-128-cfb', b'i' * 16, False)
+        data = client.client_encode(payload)
+        end = data.find(b'\r\n\r\n') + 4
+        for i in range(end - 1):
+            assert server.server_decode(data[i:i + 1]) == (b'', True, False)
+        assert server.server_decode(data[end - 1:]) == (payload, True, False)
+        assert server.server_decode(b'more') == (b'more', True, False)
+
+    server = pipeline.new_plugin('http_simple_compatible', 'aes-128-cfb',
+                                 b'i' * 16, False)
+    assert server.server_decode(b'\x03\x0bexample') == \
+        (b'\x03\x0bexample', True, False)
+    server = pipeline.new_plugin('http_simple', 'aes-128-cfb', b'i' * 16,
+                                 False)
+    data = b'GET /' + b'a' * HEADER_LIMIT
+    assert server.server_decode(data[:HEADER_LIMIT]) == (b'', True, False)
+    assert server.server_decode(data[HEADER_LIMIT:]) == \
+        (b'E' * 2048, False, False)
@@ -17,7 +17,6 @@
 from __future__ import absolute_import, division, print_function, \
     with_statement
 
-import os
 import sys
 import hashlib
 import logging
@@ -26,14 +25,18 @@ import struct
 import base64
 import time
 import random
-import hmac
 import hashlib
 import string
 
 from shadowsocks import common
 from shadowsocks.obfsplugin import plain
 from shadowsocks.common import to_bytes, to_str, ord
-from shadowsocks import lru_cache
+from shadowsocks import lru_cache, replay
+from shadowsocks.crypto.mac import hmac_digest
+from shadowsocks.crypto.randpool import rand_bytes, rand_view, rand_uint16
+
+# session tickets kept by a client, one per server name
+TICKET_BUF_LIMIT = 64
 
 def create_tls_ticket_auth_obfs(method):
     return tls_ticket_auth(method)
@@ -51,12 +54,39 @@ def match_begin(str1, str2):
             return True
     return False
 
+def pack_records(buf, tls_version):
+    # application data records of buf as a list of buffers, to be joined
+    # or handed to sendmsg. Above 2048 bytes records of 100 to 4195 bytes
+    # are cut off, their sizes come from one draw of the random pool
+    size = len(buf)
+    if size == 0:
+        return []
+    header = b"\x17" + tls_version
+    if size <= 2048:
+        return [header + struct.pack('>H', size), buf]
+    view = memoryview(buf)
+    records = []
+    pos = 0
+    # each cut takes at least 100 bytes
+    count = (size - 2048) // 100 + 1
+    for r in struct.unpack('<%dH' % count, rand_view(count * 2)):
+        if size - pos <= 2048:
+            break
+        record_len = min(r % 4096 + 100, size - pos)
+        records.append(header + struct.pack('>H', record_len))
+        records.append(view[pos:pos + record_len])
+        pos += record_len
+    if pos < size:
+        records.append(header + struct.pack('>H', size - pos))
+        records.append(view[pos:])
+    return records
+
 class obfs_auth_data(object):
     def __init__(self):
         self.client_data = lru_cache.LRUCache(60 * 5)
-        self.client_id = os.urandom(32)
+        self.client_id = rand_bytes(32)
         self.startup_time = int(time.time() - 60 * 30) & 0xFFFFFFFF
-        self.ticket_buf = {}
+        self.ticket_buf = lru_cache.LRUCache()
 
 class tls_ticket_auth(plain.plain):
     def __init__(self, method):
@@ -64,10 +94,14 @@ class tls_ticket_auth(plain.plain):
         self.handshake_status = 0
         self.send_buffer = b''
         self.recv_buffer = b''
+        # application data not parsed yet, see decode_records
+        self.record_buffer = bytearray()
         self.client_id = b''
         self.max_time_dif = 60 * 60 * 24 # time dif (second) setting
         self.tls_version = b'\x03\x03'
         self.overhead = 5
+        # set when a _compatible server passes data through
+        self.raw_trans = False
 
     def init_data(self):
         return obfs_auth_data()
@@ -83,22 +117,15 @@ class tls_ticket_auth(plain.plain):
 
     def pack_auth_data(self, client_id):
         utc_time = int(time.time()) & 0xFFFFFFFF
-        data = struct.pack('>I', utc_time) + os.urandom(18)
-        data += hmac.new(self.server_info.key + client_id, data, hashlib.sha1).digest()[:10]
+        data = struct.pack('>I', utc_time) + rand_bytes(18)
+        data += hmac_digest(self.server_info.key + client_id, data, hashlib.sha1)[:10]
         return data
 
     def client_encode(self, buf):
         if self.handshake_status == -1:
             return buf
         if self.handshake_status == 8:
-            ret = b''
-            while len(buf) > 2048:
-                size = min(struct.unpack('>H', os.urandom(2))[0] % 4096 + 100, len(buf))
-                ret += b"\x17" + self.tls_version + struct.pack('>H', size) + buf[:size]
-                buf = buf[size:]
-            if len(buf) > 0:
-                ret += b"\x17" + self.tls_version + struct.pack('>H', len(buf)) + buf
-            return ret
+            return b''.join(pack_records(buf, self.tls_version))
         if len(buf) > 0:
             self.send_buffer += b"\x17" + self.tls_version + struct.pack('>H', len(buf)) + buf
         if self.handshake_status == 0:
@@ -113,7 +140,8 @@ class tls_ticket_auth(plain.plain):
             ext += self.sni(host)
             ext += b"\x00\x17\x00\x00"
             if host not in self.server_info.data.ticket_buf:
-                self.server_info.data.ticket_buf[host] = os.urandom((struct.unpack('>H', os.urandom(2))[0] % 17 + 8) * 16)
+                self.server_info.data.ticket_buf.clear(TICKET_BUF_LIMIT - 1)
+                self.server_info.data.ticket_buf[host] = rand_bytes((rand_uint16() % 17 + 8) * 16)
             ext += b"\x00\x23" + struct.pack('>H', len(self.server_info.data.ticket_buf[host])) + self.server_info.data.ticket_buf[host]
             ext += binascii.unhexlify(b"000d001600140601060305010503040104030301030302010203")
             ext += binascii.unhexlify(b"000500050100000000")
@@ -127,8 +155,8 @@ class tls_ticket_auth(plain.plain):
             return data
         elif self.handshake_status == 1 and len(buf) == 0:
             data = b"\x14" + self.tls_version + b"\x00\x01\x01" #ChangeCipherSpec
-            data += b"\x16" + self.tls_version + b"\x00\x20" + os.urandom(22) #Finished
-            data += hmac.new(self.server_info.key + self.server_info.data.client_id, data, hashlib.sha1).digest()[:10]
+            data += b"\x16" + self.tls_version + b"\x00\x20" + rand_view(22) #Finished
+            data += hmac_digest(self.server_info.key + self.server_info.data.client_id, data, hashlib.sha1)[:10]
             ret = data + self.send_buffer
             self.send_buffer = b''
             self.handshake_status = 8
@@ -140,26 +168,14 @@ class tls_ticket_auth(plain.plain):
             return (buf, False)
 
         if self.handshake_status == 8:
-            ret = b''
-            self.recv_buffer += buf
-            while len(self.recv_buffer) > 5:
-                if ord(self.recv_buffer[0]) != 0x17:
-                    logging.info("data = %s" % (binascii.hexlify(self.recv_buffer)))
-                    raise Exception('server_decode appdata error')
-                size = struct.unpack('>H', self.recv_buffer[3:5])[0]
-                if len(self.recv_buffer) < size + 5:
-                    break
-                buf = self.recv_buffer[5:size+5]
-                ret += buf
-                self.recv_buffer = self.recv_buffer[size+5:]
-            return (ret, False)
+            return (self.decode_records(buf, b"\x17"), False)
 
         if len(buf) < 11 + 32 + 1 + 32:
             raise Exception('client_decode data error')
         verify = buf[11:33]
-        if hmac.new(self.server_info.key + self.server_info.data.client_id, verify, hashlib.sha1).digest()[:10] != buf[33:43]:
+        if hmac_digest(self.server_info.key + self.server_info.data.client_id, verify, hashlib.sha1)[:10] != buf[33:43]:
             raise Exception('client_decode data error')
-        if hmac.new(self.server_info.key + self.server_info.data.client_id, buf[:-10], hashlib.sha1).digest()[:10] != buf[-10:]:
+        if hmac_digest(self.server_info.key + self.server_info.data.client_id, buf[:-10], hashlib.sha1)[:10] != buf[-10:]:
             raise Exception('client_decode data error')
         return (b'', True)
 
@@ -167,30 +183,53 @@ class tls_ticket_auth(plain.plain):
         if self.handshake_status == -1:
             return buf
         if (self.handshake_status & 8) == 8:
-            ret = b''
-            while len(buf) > 2048:
-                size = min(struct.unpack('>H', os.urandom(2))[0] % 4096 + 100, len(buf))
-                ret += b"\x17" + self.tls_version + struct.pack('>H', size) + buf[:size]
-                buf = buf[size:]
-            if len(buf) > 0:
-                ret += b"\x17" + self.tls_version + struct.pack('>H', len(buf)) + buf
-            return ret
+            return b''.join(pack_records(buf, self.tls_version))
         self.handshake_status |= 8
         data = self.tls_version + self.pack_auth_data(self.client_id) + b"\x20" + self.client_id + binascii.unhexlify(b"c02f000005ff01000100")
         data = b"\x02\x00" + struct.pack('>H', len(data)) + data #server hello
         data = b"\x16" + self.tls_version + struct.pack('>H', len(data)) + data
         if random.randint(0, 8) < 1:
-            ticket = os.urandom((struct.unpack('>H', os.urandom(2))[0] % 164) * 2 + 64)
+            ticket = rand_bytes((rand_uint16() % 164) * 2 + 64)
             ticket = struct.pack('>H', len(ticket) + 4) + b"\x04\x00" + struct.pack('>H', len(ticket)) + ticket
             data += b"\x16" + self.tls_version + ticket #New session ticket
         data += b"\x14" + self.tls_version + b"\x00\x01\x01" #ChangeCipherSpec
         finish_len = random.choice([32, 40])
-        data += b"\x16" + self.tls_version + struct.pack('>H', finish_len) + os.urandom(finish_len - 10) #Finished
-        data += hmac.new(self.server_info.key + self.client_id, data, hashlib.sha1).digest()[:10]
+        data += b"\x16" + self.tls_version + struct.pack('>H', finish_len) + rand_view(finish_len - 10) #Finished
+        data += hmac_digest(self.server_info.key + self.client_id, data, hashlib.sha1)[:10]
         if buf:
             data += self.server_encode(buf)
         return data
 
+    def decode_records(self, buf, header):
+        # payload of the complete application data records received so
+        # far, each must start with header. The records are read at an
+        # offset and the buffer is compacted once per call
+        data = self.record_buffer
+        if not data and len(buf) > 5 and buf[:len(header)] == header and \
+                struct.unpack('>H', buf[3:5])[0] == len(buf) - 5:
+            # a single whole record
+            return buf[5:]
+        data += buf
+        view = memoryview(data)
+        out = []
+        pos = 0
+        end = len(data)
+        header_len = len(header)
+        while end - pos > 5:
+            if data[pos:pos + header_len] != header:
+                logging.info("data = %s" % (binascii.hexlify(data[pos:])))
+                raise Exception('server_decode appdata error')
+            size = struct.unpack_from('>H', data, pos + 3)[0]
+            if end - pos < size + 5:
+                break
+            out.append(view[pos + 5:pos + 5 + size])
+            pos += size + 5
+        ret = b''.join(out)
+        del out, view
+        if pos:
+            del data[:pos]
+        return ret
+
     def decode_error_return(self, buf):
         self.handshake_status = -1
         if self.overhead > 0:
@@ -198,25 +237,24 @@ class tls_ticket_auth(plain.plain):
         self.overhead = 0
         if self.method in ['tls1.2_ticket_auth', 'tls1.2_ticket_fastauth']:
             return (b'E'*2048, False, False)
+        self.raw_trans = True
         return (buf, True, False)
 
+    def server_fallback(self, buf):
+        if self.handshake_status != 0 or self.recv_buffer or \
+                not self.method.endswith('_compatible'):
+            return False
+        if match_begin(b'\x16\x03\x01', buf[:3]):
+            return False
+        self.decode_error_return(buf)
+        return True
+
     def server_decode(self, buf):
         if self.handshake_status == -1:
             return (buf, True, False)
 
         if (self.handshake_status & 4) == 4:
-            ret = b''
-            self.recv_buffer += buf
-            while len(self.recv_buffer) > 5:
-                if ord(self.recv_buffer[0]) != 0x17 or ord(self.recv_buffer[1]) != 0x3 or ord(self.recv_buffer[2]) != 0x3:
-                    logging.info("data = %s" % (binascii.hexlify(self.recv_buffer)))
-                    raise Exception('server_decode appdata error')
-                size = struct.unpack('>H', self.recv_buffer[3:5])[0]
-                if len(self.recv_buffer) < size + 5:
-                    break
-                ret += self.recv_buffer[5:size+5]
-                self.recv_buffer = self.recv_buffer[size+5:]
-            return (ret, True, False)
+            return (self.decode_records(buf, b"\x17\x03\x03"), True, False)
 
         if (self.handshake_status & 1) == 1:
             self.recv_buffer += buf
@@ -232,9 +270,10 @@ class tls_ticket_auth(plain.plain):
             verify_len = struct.unpack('>H', buf[3:5])[0] + 1 # 11 - 10
             if len(verify) < verify_len + 10:
                 return (b'', False, False)
-            if hmac.new(self.server_info.key + self.client_id, verify[:verify_len], hashlib.sha1).digest()[:10] != verify[verify_len:verify_len+10]:
+            if hmac_digest(self.server_info.key + self.client_id, verify[:verify_len], hashlib.sha1)[:10] != verify[verify_len:verify_len+10]:
                 raise Exception('server_decode data error')
-            self.recv_buffer = verify[verify_len + 10:]
+            self.record_buffer += verify[verify_len + 10:]
+            self.recv_buffer = b''
             status = self.handshake_status
             self.handshake_status |= 4
             ret = self.server_decode(b'')
@@ -277,7 +316,7 @@ class tls_ticket_auth(plain.plain):
         sessionid = buf[1:sessionid_len + 1]
         buf = buf[sessionid_len+1:]
         self.client_id = sessionid
-        sha1 = hmac.new(self.server_info.key + sessionid, verifyid[:22], hashlib.sha1).digest()[:10]
+        sha1 = hmac_digest(self.server_info.key + sessionid, verifyid[:22], hashlib.sha1)[:10]
         utc_time = struct.unpack('>I', verifyid[:4])[0]
         time_dif = common.int32((int(time.time()) & 0xffffffff) - utc_time)
         if self.server_info.obfs_param:
@@ -295,11 +334,38 @@ class tls_ticket_auth(plain.plain):
         if self.server_info.data.client_data.get(verifyid[:22]):
             logging.info("replay attack detect, id = %s" % (binascii.hexlify(verifyid)))
             return self.decode_error_return(ogn_buf)
-        self.server_info.data.client_data.sweep()
-        self.server_info.data.client_data[verifyid[:22]] = sessionid
+        client_data = self.server_info.data.client_data
+        client_data.sweep()
+        # the oldest ids go first when a reconnect storm fills the table
+        client_data.clear(replay.MAX_CLIENTS - 1)
+        client_data[verifyid[:22]] = sessionid
         if len(self.recv_buffer) >= 11:
             ret = self.server_decode(b'')
             return (ret[0], True, True)
         # (buffer_to_recv, is_need_decrypt, is_need_to_encode_and_send_back)
         return (b'', False, True)
 
+
+
+def test_records():
+    from os import urandom
+
+    tls = tls_ticket_auth('tls1.2_ticket_auth')
+    for size in (0, 1, 2048, 2049, 5000, 64 * 1024):
+        data = urandom(size)
+        records = pack_records(data, tls.tls_version)
+        sizes = [len(record) for record in records[1::2]]
+        assert sum(sizes) == size
+        assert all(n <= 4195 for n in sizes)
+        assert all(n >= 100 for n in sizes[:-1])
+        stream = b''.join(records)
+        out = [tls.decode_records(stream[i:i + 1000], b"\x17\x03\x03")
+               for i in range(0, len(stream), 1000)]
+        assert b''.join(out) == data
+        assert not tls.record_buffer
+    try:
+        tls.decode_records(b"\x16\x03\x03\x00\x01\x00", b"\x17\x03\x03")
+    except Exception:
+        pass
+    else:
+        assert False
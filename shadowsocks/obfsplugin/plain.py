@@ -75,6 +75,11 @@ class plain(object):
     def server_post_decrypt(self, buf):
         return (buf, False)
 
+    def server_fallback(self, buf):
+        # _compatible plugins pass the data through untouched from here on
+        # and return True when buf can not start their own format
+        return False
+
     def client_udp_pre_encrypt(self, buf):
         return buf
 
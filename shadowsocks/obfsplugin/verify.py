@@ -76,79 +76,192 @@ class verify_base(plain.plain):
     def server_decode(self, buf):
         return (buf, True, False)
 
+# A classic frame is a big endian length, which counts itself, and a zlib
+# stream without its 2 byte header. Stream frames have the high bit of the
+# length set and carry the next piece of one raw deflate stream per
+# direction up to a sync flush, or raw data when DEFLATE_RAW_FLAG is set
+DEFLATE_STREAM_FLAG = 0x8000
+DEFLATE_RAW_FLAG = 0x4000
+DEFLATE_LENGTH_MASK = 0x3FFF
+DEFLATE_STREAM_UNIT = 16000
+# once this much was compressed, send raw frames if the output was larger
+# than DEFLATE_MAX_RATIO of the input
+DEFLATE_SAMPLE_SIZE = 64 * 1024
+DEFLATE_MAX_RATIO = 0.9
+
 class verify_deflate(verify_base):
     def __init__(self, method):
         super(verify_deflate, self).__init__(method)
-        self.recv_buf = b''
+        self.recv_buf = bytearray()
         self.unit_len = 32700
         self.decrypt_packet_num = 0
         self.raw_trans = False
+        self.level = zlib.Z_DEFAULT_COMPRESSION
+        # the client sends stream frames when protocol_param asks for them,
+        # the server once the client sent one
+        self.client_stream = False
+        self.peer_stream = False
+        self.compressor = None
+        self.decompressor = None
+        self.compress = True
+        self.sample_in = 0
+        self.sample_out = 0
+
+    def set_server_info(self, server_info):
+        # protocol_param is a comma separated list of the compression level
+        # and "stream"
+        self.server_info = server_info
+        for item in to_str(server_info.protocol_param).split(','):
+            item = item.strip()
+            if item == 'stream':
+                self.client_stream = True
+            elif item:
+                try:
+                    self.level = int(item)
+                except ValueError:
+                    logging.warn('verify_deflate: bad protocol_param %s' % (item,))
 
     def pack_data(self, buf):
         if len(buf) == 0:
             return b''
-        data = zlib.compress(buf)
-        data = struct.pack('>H', len(data)) + data[2:]
-        return data
+        view = memoryview(buf)
+        out = []
+        for pos in range(0, len(buf), self.unit_len):
+            data = zlib.compress(view[pos:pos + self.unit_len], self.level)
+            out.append(struct.pack('>H', len(data)))
+            out.append(data[2:])
+        return b''.join(out)
+
+    def pack_stream_data(self, buf):
+        if self.compressor is None:
+            self.compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        view = memoryview(buf)
+        out = []
+        for pos in range(0, len(buf), DEFLATE_STREAM_UNIT):
+            chunk = view[pos:pos + DEFLATE_STREAM_UNIT]
+            if not self.compress:
+                out.append(struct.pack('>H', (len(chunk) + 2) | DEFLATE_STREAM_FLAG | DEFLATE_RAW_FLAG))
+                out.append(chunk)
+                continue
+            data = self.compressor.compress(chunk) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+            out.append(struct.pack('>H', (len(data) + 2) | DEFLATE_STREAM_FLAG))
+            out.append(data)
+            if self.sample_in < DEFLATE_SAMPLE_SIZE:
+                self.sample_in += len(chunk)
+                self.sample_out += len(data)
+                if self.sample_in >= DEFLATE_SAMPLE_SIZE and \
+                        self.sample_out > self.sample_in * DEFLATE_MAX_RATIO:
+                    logging.debug('verify_deflate: ratio %.2f, stop compressing'
+                                  % (self.sample_out / self.sample_in,))
+                    self.compress = False
+        return b''.join(out)
+
+    def unpack_data(self, buf):
+        # data of the complete frames, raise when a frame is invalid
+        recv_buf = self.recv_buf
+        recv_buf += buf
+        out = []
+        pos = 0
+        end = len(recv_buf)
+        while end - pos > 2:
+            head = struct.unpack_from('>H', recv_buf, pos)[0]
+            if head & DEFLATE_STREAM_FLAG:
+                length = head & DEFLATE_LENGTH_MASK
+                if length < 3:
+                    raise Exception('verify_deflate stream frame error')
+            else:
+                length = head
+                if length < 6:
+                    raise Exception('verify_deflate frame error')
+            if pos + length > end:
+                break
+            data = bytes(recv_buf[pos + 2:pos + length])
+            if not head & DEFLATE_STREAM_FLAG:
+                out.append(zlib.decompress(b'\x78\x9c' + data))
+            elif head & DEFLATE_RAW_FLAG:
+                out.append(data)
+            else:
+                if self.decompressor is None:
+                    self.decompressor = zlib.decompressobj(-15)
+                # a frame never holds more than DEFLATE_STREAM_UNIT bytes
+                out.append(self.decompressor.decompress(data, DEFLATE_STREAM_UNIT + 1))
+                if self.decompressor.unconsumed_tail:
+                    raise Exception('verify_deflate stream frame too large')
+            if head & DEFLATE_STREAM_FLAG:
+                self.peer_stream = True
+            pos += length
+        if pos:
+            del recv_buf[:pos]
+        return b''.join(out)
 
     def client_pre_encrypt(self, buf):
-        ret = b''
-        while len(buf) > self.unit_len:
-            ret += self.pack_data(buf[:self.unit_len])
-            buf = buf[self.unit_len:]
-        ret += self.pack_data(buf)
-        return ret
+        if self.client_stream:
+            return self.pack_stream_data(buf)
+        return self.pack_data(buf)
 
     def client_post_decrypt(self, buf):
         if self.raw_trans:
             return buf
-        self.recv_buf += buf
-        out_buf = b''
-        while len(self.recv_buf) > 2:
-            length = struct.unpack('>H', self.recv_buf[:2])[0]
-            if length >= 32768 or length < 6:
-                self.raw_trans = True
-                self.recv_buf = b''
-                raise Exception('client_post_decrypt data error')
-            if length > len(self.recv_buf):
-                break
-
-            out_buf += zlib.decompress(b'x\x9c' + self.recv_buf[2:length])
-            self.recv_buf = self.recv_buf[length:]
+        try:
+            out_buf = self.unpack_data(buf)
+        except Exception:
+            self.raw_trans = True
+            self.recv_buf = bytearray()
+            raise Exception('client_post_decrypt data error')
 
         if out_buf:
             self.decrypt_packet_num += 1
         return out_buf
 
     def server_pre_encrypt(self, buf):
-        ret = b''
-        while len(buf) > self.unit_len:
-            ret += self.pack_data(buf[:self.unit_len])
-            buf = buf[self.unit_len:]
-        ret += self.pack_data(buf)
-        return ret
+        if self.peer_stream:
+            return self.pack_stream_data(buf)
+        return self.pack_data(buf)
 
     def server_post_decrypt(self, buf):
         if self.raw_trans:
             return (buf, False)
-        self.recv_buf += buf
-        out_buf = b''
-        while len(self.recv_buf) > 2:
-            length = struct.unpack('>H', self.recv_buf[:2])[0]
-            if length >= 32768 or length < 6:
-                self.raw_trans = True
-                self.recv_buf = b''
-                if self.decrypt_packet_num == 0:
-                    return (b'E'*2048, False)
-                else:
-                    raise Exception('server_post_decrype data error')
-            if length > len(self.recv_buf):
-                break
-
-            out_buf += zlib.decompress(b'\x78\x9c' + self.recv_buf[2:length])
-            self.recv_buf = self.recv_buf[length:]
+        try:
+            out_buf = self.unpack_data(buf)
+        except Exception:
+            self.raw_trans = True
+            self.recv_buf = bytearray()
+            if self.decrypt_packet_num == 0:
+                return (b'E'*2048, False)
+            else:
+                raise Exception('server_post_decrype data error')
 
         if out_buf:
             self.decrypt_packet_num += 1
         return (out_buf, False)
 
+
+def test_verify_deflate():
+    from os import urandom
+    from shadowsocks import pipeline
+
+    text = b''.join(b'line %d of a compressible stream\n' % i
+                    for i in range(5000))
+    noise = urandom(200 * 1024)
+    for param in ('', '1', 'stream', 'stream,9'):
+        client = pipeline.new_plugin('verify_deflate', 'aes-128-cfb',
+                                     b'i' * 16, True)
+        server = pipeline.new_plugin('verify_deflate', 'aes-128-cfb',
+                                     b'i' * 16, False)
+        client.get_server_info().protocol_param = param
+        client.set_server_info(client.get_server_info())
+        for data in (noise, text, noise):
+            sent = client.client_pre_encrypt(data)
+            out = [server.server_post_decrypt(sent[i:i + 5000])[0]
+                   for i in range(0, len(sent), 5000)]
+            assert b''.join(out) == data
+            assert client.client_post_decrypt(
+                server.server_pre_encrypt(data)) == data
+        assert client.obfs.compress == ('stream' not in param)
+        assert server.obfs.peer_stream == ('stream' in param)
+    try:
+        server.server_post_decrypt(b'\x80\x10' + b'\x00' * 14)
+    except Exception:
+        pass
+    else:
+        assert False
@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+#
+# Copyright 2015 clowwindy
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+from shadowsocks import common, encrypt, obfs
+from shadowsocks.obfsplugin import plain
+
+# room for the iv or AEAD salt, a partial cipher block and the AEAD chunk
+# lengths and tags in a send buffer
+SEND_BUFFER_EXTRA = 256
+
+# (protocol, obfs, is_local) -> stage method names, see get_plan
+_plans = {}
+
+
+def is_plain(name):
+    # plain and origin pass data through untouched
+    m = obfs.method_supported.get(common.to_str(name).lower())
+    return m is not None and m[0] is plain.create_obfs
+
+
+def get_plan(protocol_name, obfs_name, is_local):
+    # (pre_encrypt, encode, decode, post_decrypt) plugin method names of a
+    # combination, None for the stages it skips
+    key = (protocol_name, obfs_name, is_local)
+    plan = _plans.get(key, None)
+    if plan is None:
+        side = is_local and 'client' or 'server'
+        protocol_plain = is_plain(protocol_name)
+        obfs_plain = is_plain(obfs_name)
+        plan = (None if protocol_plain else side + '_pre_encrypt',
+                None if obfs_plain else side + '_encode',
+                None if obfs_plain else side + '_decode',
+                None if protocol_plain else side + '_post_decrypt')
+        _plans[key] = plan
+    return plan
+
+
+class Pipeline(object):
+    """Protocol, cipher and obfs stages of a TCP connection.
+
+    The stages are bound to the plugin objects inside the obfs.obfs
+    wrappers and the ones of plain and origin are left out. When obfs is
+    plain the cipher is the last stage and can write into the relay's
+    send buffer.
+    """
+
+    def __init__(self, protocol, encryptor, obfs, is_local, send_buffer=None):
+        pre, encode, decode, post = get_plan(protocol.method, obfs.method,
+                                             is_local)
+        self._protocol = protocol
+        self._obfs = obfs
+        self._protocol_plugin = protocol.obfs
+        self._encryptor = encryptor
+        self._is_local = is_local
+        self._send_buffer = send_buffer
+        self._pre_stages = [getattr(protocol.obfs, pre)] if pre else []
+        self._encode_stages = [getattr(obfs.obfs, encode)] if encode else []
+        self._decode = getattr(obfs.obfs, decode) if decode else None
+        self._obfs_fallback = obfs.obfs.server_fallback
+        self._post_decrypt = getattr(protocol.obfs, post) if post else None
+        # nothing but the cipher
+        self.plain = not (pre or encode)
+
+    def overhead(self):
+        return self._obfs.get_overhead(self._is_local) + \
+            self._protocol.get_overhead(self._is_local)
+
+    def pre_encrypt(self, data):
+        for stage in self._pre_stages:
+            data = stage(data)
+        return data
+
+    def encode(self, data):
+        for stage in self._encode_stages:
+            data = stage(data)
+        return data
+
+    def encrypt(self, data, view=False):
+        # cipher and obfs stages. With view the output may be a memoryview
+        # of the send buffer, only valid until the next call
+        out = self._send_buffer
+        if view and not self._encode_stages and out is not None and \
+                len(data) + SEND_BUFFER_EXTRA <= len(out):
+            return memoryview(out)[:self._encryptor.encrypt_into(data, out)]
+        data = self._encryptor.encrypt(data)
+        for stage in self._encode_stages:
+            data = stage(data)
+        return data
+
+    def send(self, data, view=False):
+        for stage in self._pre_stages:
+            data = stage(data)
+        return self.encrypt(data, view)
+
+    def _decrypt(self, data):
+        server_info = self._protocol_plugin.server_info
+        if not server_info.recv_iv:
+            server_info.recv_iv = data[:len(server_info.iv)]
+        return self._encryptor.decrypt(data)
+
+    def server_recv(self, data, update_overhead=False, obfs_fallback=False):
+        """Decode, decrypt and post decrypt data from the client.
+
+        Return (data, obfs_sendback, protocol_sendback), send encode(b'')
+        back for obfs_sendback and send(b'') for protocol_sendback. With
+        update_overhead the protocol overhead is worked out again once the
+        obfs has seen the data, as the protocol decoder depends on it.
+        With obfs_fallback a _compatible obfs checks for plain data first,
+        as the client sent last time.
+        """
+        need_decrypt = True
+        obfs_sendback = False
+        if self._decode is not None and not (
+                obfs_fallback and self._obfs_fallback(data)):
+            data, need_decrypt, obfs_sendback = self._decode(data)
+        if update_overhead:
+            self._protocol_plugin.server_info.overhead = self.overhead()
+        if need_decrypt:
+            data = self._decrypt(data)
+        protocol_sendback = False
+        if self._post_decrypt is not None:
+            data, protocol_sendback = self._post_decrypt(data)
+        return data, obfs_sendback, protocol_sendback
+
+    def client_recv(self, data):
+        # return (data, obfs_sendback), send encode(b'') back for
+        # obfs_sendback
+        obfs_sendback = False
+        if self._decode is not None:
+            data, obfs_sendback = self._decode(data)
+        data = self._decrypt(data)
+        if self._post_decrypt is not None:
+            data = self._post_decrypt(data)
+        return data, obfs_sendback
+
+
+class UDPPipeline(object):
+    """Protocol and cipher stages of UDP packets, one per relay."""
+
+    def __init__(self, protocol, method, is_local):
+        self._protocol_plugin = protocol.obfs
+        self._method = method
+        self._is_local = is_local
+        side = is_local and 'client' or 'server'
+        if is_plain(protocol.method):
+            self._pre_encrypt = None
+            self._post_decrypt = None
+        else:
+            self._pre_encrypt = getattr(protocol.obfs,
+                                        side + '_udp_pre_encrypt')
+            self._post_decrypt = getattr(protocol.obfs,
+                                         side + '_udp_post_decrypt')
+
+    def send(self, data, uid=None):
+        server_info = self._protocol_plugin.server_info
+        ref_iv = [encrypt.encrypt_new_iv(self._method)]
+        server_info.iv = ref_iv[0]
+        if self._pre_encrypt is not None:
+            if self._is_local:
+                data = self._pre_encrypt(data)
+            else:
+                data = self._pre_encrypt(data, uid)
+        return encrypt.encrypt_all_iv(server_info.key, self._method, 1, data,
+                                      ref_iv)
+
+    def recv(self, data):
+        # return (data, uid), uid is None unless the server protocol
+        # knows the user
+        server_info = self._protocol_plugin.server_info
+        ref_iv = [0]
+        data = encrypt.encrypt_all_iv(server_info.key, self._method, 0, data,
+                                      ref_iv)
+        if not data:
+            return data, None
+        server_info.recv_iv = ref_iv[0]
+        if self._post_decrypt is None:
+            return data, None
+        if self._is_local:
+            return self._post_decrypt(data), None
+        return self._post_decrypt(data)
+
+
+def new_plugin(name, method, iv, is_local):
+    plugin = obfs.obfs(name)
+    server_info = obfs.server_info(plugin.init_data())
+    server_info.host = '127.0.0.1'
+    server_info.port = 8388
+    server_info.client = '127.0.0.1'
+    server_info.client_port = 1080
+    server_info.protocol_param = ''
+    server_info.obfs_param = ''
+    server_info.iv = iv
+    server_info.recv_iv = b''
+    server_info.key_str = b'password'
+    server_info.key = encrypt.encrypt_key(b'password', method)
+    server_info.head_len = 30
+    server_info.tcp_mss = 1460
+    server_info.buffer_size = 32 * 1024
+    server_info.overhead = plugin.get_overhead(is_local)
+    server_info.users = {}
+    server_info.user_keys = {}
+    server_info.server_key = encrypt.UserKey(server_info.key)
+    server_info.update_user_func = lambda uid: None
+    plugin.set_server_info(server_info)
+    return plugin
+
+
+def test_pipeline():
+    method = 'aes-128-cfb'
+    payload = b'\x03\x0bexample.com\x00\x50' + b'x' * 1000
+    for protocol_name, obfs_name in (('origin', 'plain'),
+                                     ('auth_aes128_md5', 'plain'),
+                                     ('auth_aes128_sha1', 'http_simple'),
+                                     ('origin', 'http_simple')):
+        send_buffer = bytearray(4096 + SEND_BUFFER_EXTRA)
+        ends = []
+        for is_local in (True, False):
+            encryptor = encrypt.Encryptor(b'password', method)
+            iv = encryptor.cipher_iv
+            ends.append(Pipeline(new_plugin(protocol_name, method, iv,
+                                            is_local),
+                                 encryptor,
+                                 new_plugin(obfs_name, method, iv, is_local),
+                                 is_local, send_buffer))
+        client, server = ends
+        assert client.plain == (protocol_name == 'origin' and
+                                obfs_name == 'plain')
+        for i in range(3):
+            sent = client.send(payload, True)
+            assert isinstance(sent, memoryview) == (obfs_name == 'plain')
+            data, obfs_sendback, protocol_sendback = server.server_recv(
+                bytes(sent), i == 0)
+            assert data == payload
+            assert not obfs_sendback
+            data, obfs_sendback = client.client_recv(server.send(b'y' * 100))
+            assert data == b'y' * 100
+
+
+def test_obfs_fallback():
+    method = 'aes-128-cfb'
+    payload = b'\x03\x0bexample.com\x00\x50' + b'x' * 1000
+    for obfs_name in ('http_simple_compatible',
+                      'tls1.2_ticket_auth_compatible'):
+        for fallback in (False, True):
+            encryptor = encrypt.Encryptor(b'password', method)
+            iv = encryptor.cipher_iv
+            client = Pipeline(new_plugin('origin', method, iv, True),
+                              encryptor, new_plugin('plain', method, iv, True),
+                              True)
+            server_obfs = new_plugin(obfs_name, method, iv, False)
+            server = Pipeline(new_plugin('origin', method, iv, False),
+                              encrypt.Encryptor(b'password', method),
+                              server_obfs, False)
+            data, obfs_sendback, protocol_sendback = server.server_recv(
+                client.send(payload), True, fallback)
+            assert data == payload
+            assert server_obfs.obfs.raw_trans
+    # obfs data is still decoded when the client stopped sending plain data
+    server_obfs = new_plugin('http_simple_compatible', method, b'', False)
+    server = Pipeline(new_plugin('origin', method, b'', False),
+                      encrypt.Encryptor(b'password', method), server_obfs,
+                      False)
+    server.server_recv(b'GET / HTTP/1.1\r\n', True, True)
+    assert not server_obfs.obfs.raw_trans
+
+
+def test_udp_pipeline():
+    method = 'aes-128-cfb'
+    for protocol_name in ('origin', 'auth_aes128_md5'):
+        client = UDPPipeline(new_plugin(protocol_name, method, b'', True),
+                             method, True)
+        server = UDPPipeline(new_plugin(protocol_name, method, b'', False),
+                             method, False)
+        data, uid = server.recv(client.send(b'\x01\x7f\x00\x00\x01'
+                                            b'\x00\x35request'))
+        assert data == b'\x01\x7f\x00\x00\x01\x00\x35request'
+        assert uid is None
+        data, uid = client.recv(server.send(b'response', uid))
+        assert data == b'response'
+
+
+if __name__ == '__main__':
+    test_pipeline()
+    test_obfs_fallback()
+    test_udp_pipeline()
@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 clowwindy
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import sys
+import time
+import logging
+
+if __name__ == '__main__':
+    import os
+    import inspect
+    file_path = os.path.dirname(os.path.realpath(inspect.getfile(inspect.currentframe())))
+    sys.path.insert(0, os.path.join(file_path, '../'))
+
+try:
+    from collections import OrderedDict
+except:
+    from shadowsocks.ordereddict import OrderedDict
+
+# clients tracked by a table over all its users, the least recently seen
+# user gives up its oldest client past this, see set_max_clients
+MAX_CLIENTS = 1 << 20
+
+# connection ids more than WINDOW_SIZE below the newest one of a client are
+# refused, as are ids more than WINDOW_AHEAD above the window
+WINDOW_SIZE = 0x1000
+WINDOW_AHEAD = 0x4000
+# a new window starts this far below the first connection id
+WINDOW_START = 64
+
+
+def set_max_clients(max_clients):
+    global MAX_CLIENTS
+    MAX_CLIENTS = max_clients
+
+
+class ReplayWindow(object):
+    # connection ids seen from one client. Bit i of bits is set when
+    # front + i was accepted, front moves up over the accepted ids and
+    # keeps within WINDOW_SIZE of back
+    __slots__ = ('front', 'back', 'bits', 'last_update', 'ref')
+
+    def __init__(self, connection_id):
+        self.reset(connection_id)
+        self.last_update = time.time()
+        self.ref = 0
+
+    def reset(self, connection_id):
+        self.front = connection_id - WINDOW_START
+        self.back = connection_id + 1
+        self.bits = 0
+
+
+class ReplayTable(object):
+    """Connection ids seen from the clients of every user.
+
+    A user keeps at most max_client clients and one that has not been seen
+    for active_time seconds makes room for a new one. With use_ref a client
+    is only active while it has open connections, see remove. All lookups
+    are O(1), the table as a whole stays below MAX_CLIENTS clients.
+    """
+
+    def __init__(self, name, active_time, use_ref=False):
+        self.name = name
+        self.active_time = active_time
+        self.use_ref = use_ref
+        self.max_client = 64
+        self.max_clients = MAX_CLIENTS
+        # user id -> OrderedDict of client id -> ReplayWindow, both
+        # ordered from the least recently seen
+        self._users = OrderedDict()
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def set_max_client(self, max_client):
+        self.max_client = max_client
+
+    def _touch_user(self, user_id):
+        clients = self._users.pop(user_id, None)
+        if clients is None:
+            clients = OrderedDict()
+        self._users[user_id] = clients
+        return clients
+
+    def _is_active(self, window, now):
+        if self.use_ref and window.ref <= 0:
+            return False
+        return now - window.last_update < self.active_time
+
+    def _evict(self):
+        while self._count > self.max_clients:
+            for user_id in self._users:
+                break
+            clients = self._users[user_id]
+            clients.popitem(last=False)
+            self._count -= 1
+            if not clients:
+                del self._users[user_id]
+
+    def update(self, user_id, client_id):
+        clients = self._users.get(user_id, None)
+        if clients is not None:
+            window = clients.pop(client_id, None)
+            if window is not None:
+                clients[client_id] = window
+                window.last_update = time.time()
+
+    def insert(self, user_id, client_id, connection_id):
+        now = time.time()
+        clients = self._touch_user(user_id)
+        window = clients.pop(client_id, None)
+        if window is None:
+            if len(clients) >= self.max_client:
+                for oldest in clients:
+                    break
+                if self._is_active(clients[oldest], now):
+                    logging.warn(self.name + ': no inactive client')
+                    return False
+                del clients[oldest]
+                self._count -= 1
+            window = ReplayWindow(connection_id)
+            clients[client_id] = window
+            self._count += 1
+            self._evict()
+        else:
+            clients[client_id] = window
+            if not self._is_active(window, now):
+                window.reset(connection_id)
+        window.last_update = now
+
+        offset = connection_id - window.front
+        if offset < 0:
+            logging.warn('obfs auth: deprecated id, someone replay attack')
+            return False
+        if offset > WINDOW_AHEAD:
+            logging.warn('obfs auth: wrong id')
+            return False
+        bits = window.bits
+        if bits >> offset & 1:
+            logging.warn('obfs auth: duplicate id, someone replay attack')
+            return False
+        bits |= 1 << offset
+        if window.back <= connection_id:
+            window.back = connection_id + 1
+        # drop the ids that fell out of the window, then the accepted ones
+        # at its front
+        shift = window.back - WINDOW_SIZE - window.front
+        if shift > 0:
+            bits >>= shift
+            window.front += shift
+        if bits & 1:
+            shift = (~bits & (bits + 1)).bit_length() - 1
+            bits >>= shift
+            window.front += shift
+        window.bits = bits
+        if self.use_ref:
+            window.ref += 1
+        return True
+
+    def remove(self, user_id, client_id):
+        clients = self._users.get(user_id, None)
+        if clients is not None:
+            window = clients.get(client_id, None)
+            if window is not None and window.ref > 0:
+                window.ref -= 1
+
+    def memory_usage(self):
+        # (users, clients, approximate bytes held), walks the whole table
+        size = sys.getsizeof(self._users)
+        for clients in self._users.values():
+            size += sys.getsizeof(clients)
+            for client_id, window in clients.items():
+                size += sys.getsizeof(client_id) + \
+                    sys.getsizeof(window) + sys.getsizeof(window.bits) + \
+                    sys.getsizeof(window.last_update)
+        return len(self._users), self._count, size
+
+
+def test_window():
+    table = ReplayTable('test', 60)
+    assert table.insert(1, b'a', 1000)
+    assert not table.insert(1, b'a', 1000)
+    assert table.insert(1, b'a', 1002)
+    assert table.insert(1, b'a', 990)
+    assert not table.insert(1, b'a', 900)
+    assert not table.insert(1, b'a', 1000 + WINDOW_AHEAD)
+    assert table.insert(1, b'a', 1001)
+    assert not table.insert(1, b'a', 1002)
+    # the window follows the newest id
+    assert table.insert(1, b'a', 1000 + WINDOW_SIZE * 2)
+    assert not table.insert(1, b'a', 1003)
+    assert not table.insert(1, b'a', 1000 + WINDOW_SIZE * 2)
+    assert table.insert(1, b'a', 1000 + WINDOW_SIZE + 1)
+    # clients and users are tracked apart
+    assert table.insert(1, b'b', 1000)
+    assert table.insert(2, b'a', 1000)
+    assert table.memory_usage()[:2] == (2, 3)
+
+
+def test_limits():
+    table = ReplayTable('test', 60, True)
+    table.set_max_client(2)
+    assert table.insert(1, b'a', 1)
+    assert table.insert(1, b'b', 1)
+    assert not table.insert(1, b'c', 1)
+    # a client without connections makes room
+    table.remove(1, b'a')
+    assert table.insert(1, b'c', 1)
+    assert len(table) == 2
+    # and starts over when it comes back
+    table.remove(1, b'b')
+    assert table.insert(1, b'b', 1)
+    table.max_clients = 3
+    table.set_max_client(10)
+    for user_id in range(2, 6):
+        assert table.insert(user_id, b'a', 1)
+    assert len(table) == 3
+    assert table.memory_usage()[:2] == (3, 3)
+
+
+if __name__ == '__main__':
+    test_window()
+    test_limits()
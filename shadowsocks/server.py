@@ -30,7 +30,9 @@ if __name__ == '__main__':
     sys.path.insert(0, os.path.join(file_path, '../'))
 
 from shadowsocks import shell, daemon, eventloop, tcprelay, udprelay, \
-    asyncdns, manager, common
+    asyncdns, manager, common, replay
+from shadowsocks.crypto import backend, table
+from shadowsocks.obfsplugin import http_simple
 
 
 def main():
@@ -70,13 +72,23 @@ def main():
 
     tcp_servers = []
     udp_servers = []
-    dns_resolver = asyncdns.DNSResolver(config['black_hostname_list'])
+    dns_resolver = asyncdns.DNSResolver(config['black_hostname_list'],
+                                        cache_file=config['dns_cache_file'])
     if int(config['workers']) > 1:
         stat_counter_dict = None
     else:
         stat_counter_dict = {}
     port_password = config['port_password']
     config_password = config.get('password', 'm')
+    table.set_cache_dir(config['table_cache_dir'])
+    http_simple.set_header_limit(config['http_header_limit'])
+    replay.set_max_clients(config['replay_max_clients'])
+    if config['cipher_autoselect']:
+        methods = [config['method']]
+        for password_obfs in port_password.values():
+            if type(password_obfs) == dict and 'method' in password_obfs:
+                methods.append(password_obfs['method'])
+        backend.select_backends(methods, config['cipher_backend_cache'])
     del config['port_password']
     for port, password_obfs in port_password.items():
         method = config["method"]
@@ -152,6 +164,7 @@ def main():
     def run_server():
         def child_handler(signum, _):
             logging.warn('received SIGQUIT, doing graceful shutting down..')
+            dns_resolver.save_snapshot()
             list(map(lambda s: s.close(next_tick=True),
                      tcp_servers + udp_servers))
 
@@ -159,10 +172,22 @@ def main():
                       child_handler)
 
         def int_handler(signum, _):
+            dns_resolver.save_snapshot()
             sys.exit(1)
 
         signal.signal(signal.SIGINT, int_handler)
 
+        def term_handler(signum, _):
+            # SIGTERM is the normal way to stop the server, keep the DNS
+            # cache and exit cleanly
+            dns_resolver.save_snapshot()
+            sys.exit(0)
+
+        # on Windows there is no SIGQUIT and SIGTERM already runs the
+        # graceful child_handler above, don't replace it
+        if hasattr(signal, 'SIGQUIT'):
+            signal.signal(signal.SIGTERM, term_handler)
+
         try:
             loop = eventloop.EventLoop()
             dns_resolver.add_to_loop(loop)
@@ -263,9 +263,49 @@ def get_config(is_local):
     config['additional_ports'] = config.get('additional_ports', {})
     config['additional_ports_only'] = config.get('additional_ports_only', False)
     config['timeout'] = int(config.get('timeout', 300))
+    config['pre_data_timeout'] = int(config.get('pre_data_timeout', 10))
+    config['handshake_timeout'] = int(config.get('handshake_timeout', 30))
+    config['dns_timeout'] = int(config.get('dns_timeout', 30))
+    config['connect_timeout'] = int(config.get('connect_timeout', 30))
+    config['tcp_keepalive'] = int(config.get('tcp_keepalive', 60))
+    config['tcp_keepalive_interval'] = \
+        int(config.get('tcp_keepalive_interval', 10))
+    config['tcp_keepalive_count'] = int(config.get('tcp_keepalive_count', 3))
+    config['tcp_user_timeout'] = int(config.get('tcp_user_timeout', 60))
     config['udp_timeout'] = int(config.get('udp_timeout', 120))
     config['udp_cache'] = int(config.get('udp_cache', 64))
     config['fast_open'] = config.get('fast_open', False)
+    config['crypto_threads'] = int(config.get('crypto_threads', 0))
+    config['cipher_autoselect'] = config.get('cipher_autoselect', False)
+    config['cipher_backend_cache'] = \
+        to_str(config.get('cipher_backend_cache', ''))
+    config['crypto_offload_threshold'] = \
+        int(config.get('crypto_offload_threshold', 16 * 1024))
+    config['table_cache_dir'] = to_str(config.get('table_cache_dir', ''))
+    config['http_header_limit'] = int(config.get('http_header_limit', 8192))
+    config['replay_max_clients'] = \
+        int(config.get('replay_max_clients', 1 << 20))
+    config['compatible_cache_timeout'] = \
+        int(config.get('compatible_cache_timeout', 600))
+    config['admission_fd_soft'] = \
+        float(config.get('admission_fd_soft', 0.8))
+    config['admission_fd_hard'] = \
+        float(config.get('admission_fd_hard', 0.95))
+    config['admission_buffer_soft'] = \
+        int(config.get('admission_buffer_soft', 128 << 20))
+    config['admission_buffer_hard'] = \
+        int(config.get('admission_buffer_hard', 512 << 20))
+    config['admission_lag_soft'] = \
+        float(config.get('admission_lag_soft', 0.5))
+    config['admission_lag_hard'] = \
+        float(config.get('admission_lag_hard', 2.0))
+    # left alone by the admission controller, priority_users are listen
+    # ports and priority_uids the user ids of multi-user ports
+    for key in ('priority_users', 'priority_uids'):
+        values = config.get(key, [])
+        if type(values) in (bytes, str, type(u'')):
+            values = [x for x in to_str(values).split(',') if x.strip()]
+        config[key] = [int(x) for x in values]
     config['workers'] = config.get('workers', 1)
     config['pid-file'] = config.get('pid-file', '/var/run/shadowsocksr.pid')
     config['log-file'] = config.get('log-file', '/var/log/shadowsocksr.log')
@@ -287,6 +327,7 @@ def get_config(is_local):
         config['black_hostname_list'] = to_str(config.get('black_hostname_list', '')).split(',')
         if len(config['black_hostname_list']) == 1 and config['black_hostname_list'][0] == '':
             config['black_hostname_list'] = []
+        config['dns_cache_file'] = to_str(config.get('dns_cache_file', ''))
         try:
             config['forbidden_ip'] = \
                 IPNetwork(config.get('forbidden_ip', '127.0.0.0/8,::1/128'))
@@ -30,14 +30,26 @@ import platform
 import threading
 import re
 
-from shadowsocks import encrypt, obfs, eventloop, shell, common, lru_cache, version
+from shadowsocks import encrypt, obfs, eventloop, shell, common, lru_cache, version, \
+    cryptopool, pipeline, admission
 from shadowsocks.common import pre_parse_header, parse_header
 
 # we clear at most TIMEOUTS_CLEAN_SIZE timeouts each time
 TIMEOUTS_CLEAN_SIZE = 512
 
+# client addresses remembered by a _compatible server, and how often the
+# fallback counters are logged while they change
+COMPATIBLE_CACHE_SIZE = 65536
+COMPATIBLE_STATS_INTERVAL = 600
+TIMEOUT_STATS_INTERVAL = 600
+
 MSG_FASTOPEN = 0x20000000
 
+# socket.TCP_USER_TIMEOUT is missing before Python 3.6, 18 in linux/tcp.h
+TCP_USER_TIMEOUT = getattr(socket, 'TCP_USER_TIMEOUT', None)
+if TCP_USER_TIMEOUT is None and platform.system() == 'Linux':
+    TCP_USER_TIMEOUT = 18
+
 # SOCKS command definition
 CMD_CONNECT = 1
 CMD_BIND = 2
@@ -76,6 +88,15 @@ STAGE_CONNECTING = 4
 STAGE_STREAM = 5
 STAGE_DESTROYED = -1
 
+# a handler times out after the timeout of the first of these it is in:
+# accept before any data, handshake until the address header is parsed,
+# dns and connect for the remote side, then stream
+TIMEOUT_STAGES = (('accept', 'pre_data_timeout'),
+                  ('handshake', 'handshake_timeout'),
+                  ('dns', 'dns_timeout'),
+                  ('connect', 'connect_timeout'),
+                  ('stream', 'timeout'))
+
 # for each handler, we have 2 stream directions:
 #    upstream:    from client to server direction
 #                 read local and write to remote
@@ -94,6 +115,8 @@ WAIT_STATUS_READWRITING = WAIT_STATUS_READING | WAIT_STATUS_WRITING
 NETWORK_MTU = 1500
 TCP_MSS = NETWORK_MTU - 40
 BUF_SIZE = 32 * 1024
+# reads are cut down to this while the process is under pressure
+SHED_READ_SIZE = 8 * 1024
 UDP_MAX_BUF_SIZE = 65536
 
 class SpeedTester(object):
@@ -141,19 +164,85 @@ class TCPRelayHandler(object):
         self._local_type = config['local_type']
         self._dns_resolver = dns_resolver
         self._add_ref = 0
-        if not self._create_encryptor(config):
-            return
 
         self._client_address = local_sock.getpeername()[:2]
         self._accept_address = local_sock.getsockname()[:2]
         self._user = None
         self._user_id = server._listen_port
-        self._update_tcp_mss(local_sock)
+        self._compatible_hint = None
 
         # TCP Relay works as either sslocal or ssserver
         # if is_local, this is sslocal
         self._is_local = is_local
         self._encrypt_correct = True
+        # the cipher, plugins and speed testers wait for the first data,
+        # see _create_pipeline
+        self._encryptor = None
+        self._obfs = None
+        self._protocol = None
+        self._pipeline = None
+        self._overhead = 0
+        self._tcp_mss = TCP_MSS
+        self.speed_tester_u = None
+        self.speed_tester_d = None
+
+        self._redir_list = config.get('redirect', ["*#0.0.0.0:0"])
+        self._is_redirect = False
+        self._bind = config.get('out_bind', '')
+        self._bindv6 = config.get('out_bindv6', '')
+        self._ignore_bind_list = config.get('ignore_bind', [])
+
+        self._fastopen_connected = False
+        self._data_to_write_to_local = []
+        self._data_to_write_to_remote = []
+        self._udp_data_send_buffer = b''
+        self._upstream_status = WAIT_STATUS_READING
+        self._downstream_status = WAIT_STATUS_INIT
+        self._remote_address = None
+
+        self._forbidden_iplist = config.get('forbidden_ip', None)
+        self._forbidden_portset = config.get('forbidden_port', None)
+        if is_local:
+            self._chosen_server = self._get_a_server()
+
+        self.last_activity = 0
+        self._timeout_stage = 'accept'
+        self._update_activity()
+        self._server.add_connection(1)
+        self._server.stat_add(self._client_address[0], 1)
+        self._add_ref = 1
+        self._recv_u_max_size = BUF_SIZE
+        self._recv_d_max_size = BUF_SIZE
+        self._recv_pack_id = 0
+        self._udp_send_pack_id = 0
+        self._udpv6_send_pack_id = 0
+
+        # local_sock: broswer connect to ssr
+        local_sock.setblocking(False)
+        local_sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
+        self._local_sock_fd = local_sock.fileno()
+        fd_to_handlers[self._local_sock_fd] = self
+        # print(f"===235=add_local_sock: {local_sock}") mode 9
+        loop.add(local_sock, eventloop.POLL_IN | eventloop.POLL_ERR, self._server)
+        self._stage = STAGE_INIT
+        self._stage1 = STAGE_INIT
+
+    def _create_pipeline(self):
+        # the cipher and plugins of the connection, made once the first
+        # data arrives. Return False when the cipher can not be made
+        config = self._config
+        server = self._server
+        is_local = self._is_local
+        if not self._create_encryptor(config):
+            return False
+        self._update_tcp_mss(self._local_sock)
+        self._set_keepalive(self._local_sock)
+        # how the last connection from this address got through a
+        # _compatible server, see TCPRelay.compatible_hint
+        if not is_local:
+            self._compatible_hint = server.compatible_hint(
+                self._client_address[0])
+
         self._obfs = obfs.obfs(config['obfs'])
         self._protocol = obfs.obfs(config['protocol'])
         self._overhead = self._obfs.get_overhead(self._is_local) + self._protocol.get_overhead(self._is_local)
@@ -182,6 +271,8 @@ class TCPRelayHandler(object):
         server_info.host = config['server']
         server_info.port = server._listen_port
         server_info.users = server.server_users
+        server_info.user_keys = server.server_user_keys
+        server_info.server_key = server.server_key
         server_info.update_user_func = self._update_user
         server_info.client = self._client_address[0]
         server_info.client_port = self._client_address[1]
@@ -196,48 +287,13 @@ class TCPRelayHandler(object):
         server_info.buffer_size = self._recv_buffer_size
         server_info.overhead = self._overhead
         self._protocol.set_server_info(server_info)
-
-        self._redir_list = config.get('redirect', ["*#0.0.0.0:0"])
-        self._is_redirect = False
-        self._bind = config.get('out_bind', '')
-        self._bindv6 = config.get('out_bindv6', '')
-        self._ignore_bind_list = config.get('ignore_bind', [])
-
-        self._fastopen_connected = False
-        self._data_to_write_to_local = []
-        self._data_to_write_to_remote = []
-        self._udp_data_send_buffer = b''
-        self._upstream_status = WAIT_STATUS_READING
-        self._downstream_status = WAIT_STATUS_INIT
-        self._remote_address = None
-
-        self._forbidden_iplist = config.get('forbidden_ip', None)
-        self._forbidden_portset = config.get('forbidden_port', None)
-        if is_local:
-            self._chosen_server = self._get_a_server()
-
-        self.last_activity = 0
-        self._update_activity()
-        self._server.add_connection(1)
-        self._server.stat_add(self._client_address[0], 1)
-        self._add_ref = 1
+        self._pipeline = pipeline.Pipeline(self._protocol, self._encryptor,
+                                           self._obfs, is_local,
+                                           server.send_buffer)
         self.speed_tester_u = SpeedTester(config.get("speed_limit_per_con", 0))
         self.speed_tester_d = SpeedTester(config.get("speed_limit_per_con", 0))
-        self._recv_u_max_size = BUF_SIZE
-        self._recv_d_max_size = BUF_SIZE
-        self._recv_pack_id = 0
-        self._udp_send_pack_id = 0
-        self._udpv6_send_pack_id = 0
-
-        # local_sock: broswer connect to ssr
-        local_sock.setblocking(False)
-        local_sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
-        self._local_sock_fd = local_sock.fileno()
-        fd_to_handlers[self._local_sock_fd] = self
-        # print(f"===235=add_local_sock: {local_sock}") mode 9
-        loop.add(local_sock, eventloop.POLL_IN | eventloop.POLL_ERR, self._server)
-        self._stage = STAGE_INIT
-        self._stage1 = STAGE_INIT
+        self._update_activity()
+        return True
 
     def __hash__(self):
         # default __hash__ is id / 16
@@ -274,8 +330,8 @@ class TCPRelayHandler(object):
                                                 config['method'], None, True)
             return True
         except Exception:
-            self._stage = STAGE_DESTROYED
             logging.error('create encryptor fail at port %d', self._server._listen_port)
+            return False
 
     def _update_user(self, user):
         self._user = user
@@ -286,9 +342,67 @@ class TCPRelayHandler(object):
             self.speed_tester_u.update_limit(speed)
             self.speed_tester_d.update_limit(speed)
 
+    def _set_keepalive(self, sock):
+        # let the kernel find dead peers, see tcp_keepalive and
+        # tcp_user_timeout
+        config = self._config
+        idle = config.get('tcp_keepalive', 0)
+        options = []
+        if idle > 0:
+            options = [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+            for name, value in (
+                    ('TCP_KEEPIDLE', idle),
+                    ('TCP_KEEPINTVL', config.get('tcp_keepalive_interval', 10)),
+                    ('TCP_KEEPCNT', config.get('tcp_keepalive_count', 3))):
+                if hasattr(socket, name):
+                    options.append((socket.SOL_TCP, getattr(socket, name),
+                                    value))
+        user_timeout = config.get('tcp_user_timeout', 0)
+        if user_timeout > 0 and TCP_USER_TIMEOUT is not None:
+            options.append((socket.SOL_TCP, TCP_USER_TIMEOUT,
+                            user_timeout * 1000))
+        for level, option, value in options:
+            try:
+                sock.setsockopt(level, option, value)
+            except (OSError, IOError):
+                pass
+
+    def timeout_stage(self):
+        return self._timeout_stage
+
+    def pending_bytes(self):
+        size = len(self._udp_data_send_buffer)
+        for data in self._data_to_write_to_local:
+            size += len(data)
+        for data in self._data_to_write_to_remote:
+            size += len(data)
+        return size
+
+    def _recv_size(self, size):
+        # smaller reads under pressure, except for priority_uids. The
+        # ports of priority_users are not shed at all
+        read_size = self._server.read_size
+        if size > read_size and \
+                self._user_id not in self._server.priority_uids:
+            return read_size
+        return size
+
     def _update_activity(self, data_len=0):
         # tell the TCP Relay we have activities recently
         # else it will think we are inactive and timed out
+        if self._pipeline is None:
+            timeout_stage = 'accept'
+        elif self._stage == STAGE_STREAM or self._stage == STAGE_UDP_ASSOC:
+            timeout_stage = 'stream'
+        elif self._stage == STAGE_DNS:
+            timeout_stage = 'dns'
+        elif self._stage == STAGE_CONNECTING:
+            timeout_stage = 'connect'
+        else:
+            timeout_stage = 'handshake'
+        if timeout_stage != self._timeout_stage:
+            self._server.remove_handler(self)
+            self._timeout_stage = timeout_stage
         self._server.update_activity(self, data_len)
 
     def _update_stream(self, stream, status):
@@ -323,6 +437,87 @@ class TCPRelayHandler(object):
                 if self._remote_sock_v6:
                     self._loop.modify(self._remote_sock_v6, event)
 
+    def _offload_encrypt(self, data, callback):
+        # hand large buffers to the crypto pool, callback(data, error) is
+        # called on the loop once they are encrypted
+        pool = self._server.crypto_pool
+        if pool is None or not pool.should_offload(self, len(data)):
+            return False
+        pool.submit(self, self._encryptor.encrypt, data, callback)
+        return True
+
+    def _write_sendback(self, encrypt, sock):
+        # replies of the obfs and protocol plugins, queued behind the pool
+        # jobs of this handler to keep the cipher and obfs streams in order
+        data = b''
+        if encrypt:
+            data = self._pipeline.pre_encrypt(data)
+        pool = self._server.crypto_pool
+        if pool is not None and pool.has_pending(self):
+            if encrypt:
+                func = self._encryptor.encrypt
+            else:
+                func = lambda data: data
+            pool.submit(self, func, data, lambda data, error:
+                        self._on_sendback_encrypted(sock, data, error))
+            return
+        if encrypt:
+            data = self._pipeline.encrypt(data, True)
+        else:
+            data = self._pipeline.encode(data)
+        self._write_to_sock(data, sock)
+
+    def _destroy_after_crypto(self, sock, fd):
+        # sock is at EOF, but pool jobs of its data may still have to be
+        # written out. Close sock alone and destroy once they are done
+        pool = self._server.crypto_pool
+        if pool is None or not pool.has_pending(self):
+            self.destroy()
+            return
+        try:
+            self._loop.removefd(fd)
+            del self._fd_to_handlers[fd]
+        except Exception as e:
+            shell.print_exception(e)
+        sock.close()
+        if sock is self._local_sock:
+            self._local_sock = None
+        else:
+            self._remote_sock = None
+        pool.submit(self, lambda data: data, b'',
+                    lambda data, error: self.destroy())
+
+    def _on_sendback_encrypted(self, sock, data, error):
+        if self._stage == STAGE_DESTROYED:
+            return
+        if error:
+            shell.print_exception(error)
+            self.destroy()
+            return
+        self._write_to_sock(self._pipeline.encode(data), sock)
+
+    def _on_local_encrypted(self, data, error):
+        if self._stage == STAGE_DESTROYED:
+            return
+        if error:
+            shell.print_exception(error)
+            self.destroy()
+            return
+        data = self._pipeline.encode(data)
+        self._write_to_sock(data, self._remote_sock)
+
+    def _on_remote_encrypted(self, data, error):
+        if self._stage == STAGE_DESTROYED:
+            return
+        if error:
+            shell.print_exception(error)
+            self.destroy()
+            return
+        data = self._pipeline.encode(data)
+        self._server.add_transfer_d(self._user, len(data))
+        self._update_activity(len(data))
+        self._write_to_sock(data, self._local_sock)
+
     def _write_to_sock(self, data, sock):
         # write data to sock
         # if only some of the data are written, put remaining in the buffer
@@ -407,6 +602,9 @@ class TCPRelayHandler(object):
                 self.destroy()
                 return False
         if uncomplete:
+            if type(data) is memoryview:
+                # the send buffer is reused by the next read
+                data = data.tobytes()
             if sock == self._local_sock:
                 self._data_to_write_to_local.append(data)
                 self._update_stream(STREAM_DOWN, WAIT_STATUS_WRITING)
@@ -537,9 +735,7 @@ class TCPRelayHandler(object):
     def _handle_stage_connecting(self, data):
         if self._is_local:
             if self._encryptor is not None:
-                data = self._protocol.client_pre_encrypt(data)
-                data = self._encryptor.encrypt(data)
-                data = self._obfs.client_encode(data)
+                data = self._pipeline.send(data)
         if data:
             self._data_to_write_to_remote.append(data)
         if self._is_local and not self._fastopen_connected and \
@@ -606,6 +802,7 @@ class TCPRelayHandler(object):
             self._remote_udp = False
             self._update_stream(STREAM_UP, WAIT_STATUS_WRITING)
             self._stage = STAGE_DNS
+            self._update_activity()
             if self._is_local:
                 self._write_to_sock((b'HTTP/1.1 200 Connection established\r\n\r\n'), self._local_sock)
                 # fake_data = b'\x03\x12zhuanlan.zhihu.com\x01\xbb'
@@ -614,9 +811,7 @@ class TCPRelayHandler(object):
                 self._obfs.obfs.server_info.head_len = head_len
                 self._protocol.obfs.server_info.head_len = head_len
                 if self._encryptor is not None:
-                    data = self._protocol.client_pre_encrypt(data)
-                    data_to_send = self._encryptor.encrypt(data)
-                    data_to_send = self._obfs.client_encode(data_to_send)
+                    data_to_send = self._pipeline.send(data)
                 if data_to_send:
                     self._data_to_write_to_remote.append(data_to_send)
                 # notice here may go into _handle_dns_resolved directly
@@ -642,6 +837,7 @@ class TCPRelayHandler(object):
                     self._write_to_sock(header + addr_to_send + port_to_send,
                                         self._local_sock)
                     self._stage = STAGE_UDP_ASSOC
+                    self._update_activity()
                     # just wait for the client to disconnect
                     return
                 elif cmd == CMD_CONNECT:
@@ -668,6 +864,11 @@ class TCPRelayHandler(object):
                 if header_result is None:
                     data = self._handel_protocol_error(self._client_address, ogn_data)
                     header_result = parse_header(data)
+                elif not self._is_redirect:
+                    self._server.compatible_detected(
+                        self._client_address[0],
+                        getattr(self._obfs.obfs, 'raw_trans', False),
+                        getattr(self._protocol.obfs, 'raw_trans', False))
                 self._overhead = self._obfs.get_overhead(self._is_local) + self._protocol.get_overhead(self._is_local)
                 self._recv_buffer_size = BUF_SIZE - self._overhead
                 server_info = self._obfs.get_server_info()
@@ -690,6 +891,7 @@ class TCPRelayHandler(object):
             # pause reading
             self._update_stream(STREAM_UP, WAIT_STATUS_WRITING)
             self._stage = STAGE_DNS
+            self._update_activity()
             if self._is_local:
                 # forward address to remote
                 self._write_to_sock((b'\x05\x00\x00\x01'
@@ -699,9 +901,7 @@ class TCPRelayHandler(object):
                 self._obfs.obfs.server_info.head_len = head_len
                 self._protocol.obfs.server_info.head_len = head_len
                 if self._encryptor is not None:
-                    data = self._protocol.client_pre_encrypt(data)
-                    data_to_send = self._encryptor.encrypt(data)
-                    data_to_send = self._obfs.client_encode(data_to_send)
+                    data_to_send = self._pipeline.send(data)
                 if data_to_send:
                     self._data_to_write_to_remote.append(data_to_send)
                 # notice here may go into _handle_dns_resolved directly
@@ -776,6 +976,8 @@ class TCPRelayHandler(object):
             self._fd_to_handlers[self._remotev6_sock_fd] = self
 
         remote_sock.setblocking(False)
+        if not self._remote_udp:
+            self._set_keepalive(remote_sock)
         if self._remote_udp:
             remote_sock_v6.setblocking(False)
 
@@ -798,6 +1000,7 @@ class TCPRelayHandler(object):
             if ip:
                 try:
                     self._stage = STAGE_CONNECTING
+                    self._update_activity()
                     remote_addr = ip
                     if self._is_local:
                         remote_port = self._chosen_server[1]
@@ -883,18 +1086,24 @@ class TCPRelayHandler(object):
         if not self._local_sock:
             return
         is_local = self._is_local
-        if is_local:
+        if is_local and self._pipeline is not None:
             recv_buffer_size = self._get_read_size(self._local_sock, self._recv_buffer_size, True)
         else:
             recv_buffer_size = BUF_SIZE
         data = None
         try:
-            data = self._local_sock.recv(recv_buffer_size)
+            data = self._local_sock.recv(self._recv_size(recv_buffer_size))
         except (OSError, IOError) as e:
             if eventloop.errno_from_exception(e) in \
                     (errno.ETIMEDOUT, errno.EAGAIN, errno.EWOULDBLOCK):
                 return
         if not data:
+            if self._is_local:
+                self._destroy_after_crypto(self._local_sock, self._local_sock_fd)
+            else:
+                self.destroy()
+            return
+        if self._pipeline is None and not self._create_pipeline():
             self.destroy()
             return
 
@@ -905,51 +1114,28 @@ class TCPRelayHandler(object):
             if self._encryptor is not None:
                 if self._encrypt_correct:
                     try:
-                        obfs_decode = self._obfs.server_decode(data)
+                        hint = self._compatible_hint
+                        self._compatible_hint = None
+                        data, obfs_sendback, sendback = \
+                            self._pipeline.server_recv(
+                                data, self._stage == STAGE_INIT,
+                                hint is not None and hint[0])
                         if self._stage == STAGE_INIT:
-                            self._overhead = self._obfs.get_overhead(self._is_local) + self._protocol.get_overhead(self._is_local)
-                            server_info = self._protocol.get_server_info()
-                            server_info.overhead = self._overhead
+                            self._overhead = self._pipeline.overhead()
                     except Exception as e:
                         shell.print_exception(e)
                         logging.error("exception from %s:%d" % (self._client_address[0], self._client_address[1]))
                         self.destroy()
                         return
-                    if obfs_decode[2]:
-                        data = self._obfs.server_encode(b'')
-                        try:
-                            self._write_to_sock(data, self._local_sock)
-                        except Exception as e:
-                            shell.print_exception(e)
-                            if self._config['verbose']:
-                                traceback.print_exc()
-                            logging.error("exception from %s:%d" % (self._client_address[0], self._client_address[1]))
-                            self.destroy()
-                            return
-                    if obfs_decode[1]:
-                        if not self._protocol.obfs.server_info.recv_iv:
-                            iv_len = len(self._protocol.obfs.server_info.iv)
-                            self._protocol.obfs.server_info.recv_iv = obfs_decode[0][:iv_len]
-                        data = self._encryptor.decrypt(obfs_decode[0])
-                    else:
-                        data = obfs_decode[0]
                     try:
-                        data, sendback = self._protocol.server_post_decrypt(data)
+                        if obfs_sendback:
+                            self._write_sendback(False, self._local_sock)
                         if sendback:
-                            backdata = self._protocol.server_pre_encrypt(b'')
-                            backdata = self._encryptor.encrypt(backdata)
-                            backdata = self._obfs.server_encode(backdata)
-                            try:
-                                self._write_to_sock(backdata, self._local_sock)
-                            except Exception as e:
-                                shell.print_exception(e)
-                                if self._config['verbose']:
-                                    traceback.print_exc()
-                                logging.error("exception from %s:%d" % (self._client_address[0], self._client_address[1]))
-                                self.destroy()
-                                return
+                            self._write_sendback(True, self._local_sock)
                     except Exception as e:
                         shell.print_exception(e)
+                        if self._config['verbose']:
+                            traceback.print_exc()
                         logging.error("exception from %s:%d" % (self._client_address[0], self._client_address[1]))
                         self.destroy()
                         return
@@ -957,12 +1143,19 @@ class TCPRelayHandler(object):
                 return
             if not data:
                 return
+            if self._stage == STAGE_INIT and \
+                    self._server.reject_user(self._user_id):
+                # the client is known by now, see TCPRelay.set_pressure
+                self._server.rejected_connections += 1
+                self.destroy()
+                return
         if self._stage == STAGE_STREAM:
             if self._is_local:
                 if self._encryptor is not None:
-                    data = self._protocol.client_pre_encrypt(data)
-                    data = self._encryptor.encrypt(data)
-                    data = self._obfs.client_encode(data)
+                    data = self._pipeline.pre_encrypt(data)
+                    if self._offload_encrypt(data, self._on_local_encrypted):
+                        return
+                    data = self._pipeline.encrypt(data, True)
             self._write_to_sock(data, self._remote_sock)
         elif is_local and self._stage == STAGE_INIT:
             # TODO check auth method
@@ -1002,14 +1195,19 @@ class TCPRelayHandler(object):
                     recv_buffer_size = BUF_SIZE
                 else:
                     recv_buffer_size = self._get_read_size(self._remote_sock, self._recv_buffer_size, False)
-                data = self._remote_sock.recv(recv_buffer_size)
+                data = self._remote_sock.recv(
+                    self._recv_size(recv_buffer_size))
                 self._recv_pack_id += 1
         except (OSError, IOError) as e:
             if eventloop.errno_from_exception(e) in \
                     (errno.ETIMEDOUT, errno.EAGAIN, errno.EWOULDBLOCK, 10035): #errno.WSAEWOULDBLOCK
                 return
         if not data:
-            self.destroy()
+            if self._is_local or self._remote_udp:
+                self.destroy()
+            else:
+                self._destroy_after_crypto(self._remote_sock,
+                                           self._remote_sock_fd)
             return
 
         self.speed_tester_d.add(len(data))
@@ -1017,21 +1215,7 @@ class TCPRelayHandler(object):
         if self._encryptor is not None:
             if self._is_local:
                 try:
-                    obfs_decode = self._obfs.client_decode(data)
-                except Exception as e:
-                    shell.print_exception(e)
-                    logging.error("exception from %s:%d" % (self._client_address[0], self._client_address[1]))
-                    self.destroy()
-                    return
-                if obfs_decode[1]:
-                    send_back = self._obfs.client_encode(b'')
-                    self._write_to_sock(send_back, self._remote_sock)
-                if not self._protocol.obfs.server_info.recv_iv:
-                    iv_len = len(self._protocol.obfs.server_info.iv)
-                    self._protocol.obfs.server_info.recv_iv = obfs_decode[0][:iv_len]
-                data = self._encryptor.decrypt(obfs_decode[0])
-                try:
-                    data = self._protocol.client_post_decrypt(data)
+                    data, obfs_sendback = self._pipeline.client_recv(data)
                     if self._recv_pack_id == 1:
                         self._tcp_mss = self._protocol.get_server_info().tcp_mss
                 except Exception as e:
@@ -1039,11 +1223,14 @@ class TCPRelayHandler(object):
                     logging.error("exception from %s:%d" % (self._client_address[0], self._client_address[1]))
                     self.destroy()
                     return
+                if obfs_sendback:
+                    self._write_sendback(False, self._remote_sock)
             else:
                 if self._encrypt_correct:
-                    data = self._protocol.server_pre_encrypt(data)
-                    data = self._encryptor.encrypt(data)
-                    data = self._obfs.server_encode(data)
+                    data = self._pipeline.pre_encrypt(data)
+                    if self._offload_encrypt(data, self._on_remote_encrypted):
+                        return
+                    data = self._pipeline.encrypt(data, True)
                     self._server.add_transfer_d(self._user, len(data))
                 self._update_activity(len(data))
         else:
@@ -1068,7 +1255,9 @@ class TCPRelayHandler(object):
 
     def _on_remote_write(self):
         # handle remote writable event
-        self._stage = STAGE_STREAM
+        if self._stage != STAGE_STREAM:
+            self._stage = STAGE_STREAM
+            self._update_activity()
         if self._data_to_write_to_remote:
             data = b''.join(self._data_to_write_to_remote)
             self._data_to_write_to_remote = []
@@ -1123,7 +1312,9 @@ class TCPRelayHandler(object):
                 handle = True
                 self._on_local_error()
             elif event & (eventloop.POLL_IN | eventloop.POLL_HUP):
-                if not self.speed_tester_u.isExceed() and not self._server.speed_tester_u(self._user_id).isExceed():
+                if self._pipeline is None or (
+                        not self.speed_tester_u.isExceed() and
+                        not self._server.speed_tester_u(self._user_id).isExceed()):
                     handle = True
                     self._on_local_read()
                 else:
@@ -1216,6 +1407,8 @@ class TCPRelayHandler(object):
             self._protocol.dispose()
             self._protocol = None
 
+        if self._server.crypto_pool is not None:
+            self._server.crypto_pool.cancel(self)
         if self._encryptor:
             self._encryptor.dispose()
             self._encryptor = None
@@ -1241,12 +1434,27 @@ class TCPRelay(object):
         self.server_transfer_dl = 0
         self.server_users = {}
         self.server_users_cfg = {}
+        # uid -> encrypt.UserKey, made again when the password changes
+        self.server_user_keys = {}
+        self.server_key = encrypt.UserKey(
+            encrypt.encrypt_key(config['password'], config['method']))
         self.server_user_transfer_ul = {}
         self.server_user_transfer_dl = {}
         self.mu = False
         self._speed_tester_u = {}
         self._speed_tester_d = {}
         self.server_connections = 0
+        # handlers encrypt into it just before sending, the loop is single
+        # threaded so one buffer per relay is enough
+        self.send_buffer = bytearray(BUF_SIZE + pipeline.SEND_BUFFER_EXTRA)
+        self.crypto_pool = None
+        # set by the admission controller, see set_pressure
+        self.admission = None
+        self.read_size = BUF_SIZE
+        self.priority_uids = set(config.get('priority_uids', []))
+        self.rejected_connections = 0
+        self._accept_paused = False
+        self._reject_new = False
         self.protocol_data = obfs.obfs(config['protocol']).init_data()
         self.obfs_data = obfs.obfs(config['obfs']).init_data()
 
@@ -1254,8 +1462,29 @@ class TCPRelay(object):
             common.connect_log = logging.info
 
         self._timeout = config['timeout']
-        self._timeout_cache = lru_cache.LRUCache(timeout=self._timeout,
-                                         close_callback=self._close_tcp_client)
+        # handlers by their timeout stage, see TIMEOUT_STAGES
+        self._timeout_caches = {}
+        self.timeout_stats = {}
+        for stage, key in TIMEOUT_STAGES:
+            self._timeout_caches[stage] = lru_cache.LRUCache(
+                timeout=config.get(key, self._timeout),
+                close_callback=self._timeout_callback(stage))
+            self.timeout_stats[stage] = 0
+        self._timeout_stats_logged = (time.time(), 0)
+
+        # client ip -> (obfs fell back, protocol fell back) of its last
+        # connection, so a _compatible obfs tries plain data first
+        self._compatible_cache = None
+        self.compatible_stats = {'connections': 0, 'obfs_fallback': 0,
+                                 'protocol_fallback': 0, 'hint_hit': 0,
+                                 'hint_miss': 0}
+        self._compatible_stats_logged = (time.time(), 0)
+        compatible_timeout = config.get('compatible_cache_timeout', 600)
+        if not is_local and compatible_timeout > 0 and \
+                (common.to_str(config['obfs']).endswith('_compatible') or
+                 common.to_str(config['protocol']).endswith('_compatible')):
+            self._compatible_cache = lru_cache.LRUCache(
+                timeout=compatible_timeout)
 
         if is_local:
             listen_addr = config['local_address']
@@ -1299,11 +1528,56 @@ class TCPRelay(object):
         self._eventloop = loop
         self._eventloop.add(self._server_socket,
                             eventloop.POLL_IN | eventloop.POLL_ERR, self)
+        if self._config.get('crypto_threads', 0) > 0:
+            self.crypto_pool = cryptopool.get_pool(loop,
+                self._config['crypto_threads'],
+                self._config.get('crypto_offload_threshold',
+                                 cryptopool.CRYPTO_OFFLOAD_THRESHOLD))
         self._eventloop.add_periodic(self.handle_periodic)
+        self.admission = admission.get_controller(loop, self._config)
+        self.admission.add_relay(self)
+
+    def listen_port(self):
+        return self._listen_port
+
+    def open_fds(self):
+        # the listening socket and the ones of the handlers
+        return len(self._fd_to_handlers) + 1
+
+    def pending_bytes(self):
+        size = 0
+        for handler in set(self._fd_to_handlers.values()):
+            size += handler.pending_bytes()
+        return size
+
+    def has_priority_uids(self):
+        return bool(self.priority_uids)
+
+    def reject_user(self, user_id):
+        return self._reject_new and user_id not in self.priority_uids
+
+    def set_pressure(self, shed, pause_accept, reject):
+        # shed: smaller reads, pause_accept: leave new connections in the
+        # listen backlog, reject: close new connections right away. With
+        # priority_uids they are closed once the client is authenticated
+        if self._closed:
+            return
+        self.read_size = shed and SHED_READ_SIZE or BUF_SIZE
+        self._reject_new = reject
+        if pause_accept != self._accept_paused:
+            self._accept_paused = pause_accept
+            if pause_accept:
+                mode = eventloop.POLL_ERR
+                logging.warn('port %d stops accepting' % self._listen_port)
+            else:
+                mode = eventloop.POLL_IN | eventloop.POLL_ERR
+                logging.info('port %d accepts again' % self._listen_port)
+            self._eventloop.modify(self._server_socket, mode)
 
     def remove_handler(self, client):
-        if hash(client) in self._timeout_cache:
-            del self._timeout_cache[hash(client)]
+        timeout_cache = self._timeout_caches[client.timeout_stage()]
+        if hash(client) in timeout_cache:
+            del timeout_cache[hash(client)]
 
     def add_connection(self, val):
         self.server_connections += val
@@ -1348,8 +1622,11 @@ class TCPRelay(object):
             self.add_user(uid, users[id])
 
     def add_user(self, uid, cfg): # user: binstr[4], passwd: str
-        passwd = cfg['password']
-        self.server_users[uid] = common.to_bytes(passwd)
+        passwd = common.to_bytes(cfg['password'])
+        if self.server_users.get(uid, None) != passwd or \
+                uid not in self.server_user_keys:
+            self.server_user_keys[uid] = encrypt.UserKey(passwd)
+        self.server_users[uid] = passwd
         self.server_users_cfg[uid] = cfg
         speed = cfg.get("speed_limit_per_user", 0)
         if uid in self._speed_tester_u:
@@ -1366,6 +1643,8 @@ class TCPRelay(object):
             del self.server_users[uid]
         if uid in self.server_users_cfg:
             del self.server_users_cfg[uid]
+        if uid in self.server_user_keys:
+            del self.server_user_keys[uid]
 
     def add_transfer_u(self, user, transfer):
         if user is None:
@@ -1447,17 +1726,89 @@ class TCPRelay(object):
         if data_len and self._stat_callback:
             self._stat_callback(self._listen_port, data_len)
 
-        self._timeout_cache[hash(client)] = client
+        self._timeout_caches[client.timeout_stage()][hash(client)] = client
+
+    def compatible_hint(self, client_ip):
+        # (obfs fell back, protocol fell back) of the last connection from
+        # client_ip, None when unknown
+        if self._compatible_cache is None:
+            return None
+        return self._compatible_cache.get(client_ip, None)
+
+    def compatible_detected(self, client_ip, obfs_fallback, protocol_fallback):
+        if self._compatible_cache is None:
+            return
+        stats = self.compatible_stats
+        stats['connections'] += 1
+        if obfs_fallback:
+            stats['obfs_fallback'] += 1
+        if protocol_fallback:
+            stats['protocol_fallback'] += 1
+        path = (obfs_fallback, protocol_fallback)
+        last_path = self._compatible_cache.get(client_ip, None)
+        if last_path is not None:
+            if last_path == path:
+                stats['hint_hit'] += 1
+            else:
+                stats['hint_miss'] += 1
+        self._compatible_cache[client_ip] = path
+
+    def get_compatible_stats(self):
+        # connections through a _compatible server and how many of them
+        # needed the plain fallback, none for a long time means the
+        # _compatible suffix can go
+        return self.compatible_stats.copy()
+
+    def _sweep_compatible(self):
+        self._compatible_cache.sweep()
+        self._compatible_cache.clear(COMPATIBLE_CACHE_SIZE)
+        now = time.time()
+        last_time, last_count = self._compatible_stats_logged
+        count = self.compatible_stats['connections']
+        if count != last_count and \
+                now - last_time >= COMPATIBLE_STATS_INTERVAL:
+            self._compatible_stats_logged = (now, count)
+            stats = self.compatible_stats
+            logging.info('port %d compatible: %d connections, %d obfs '
+                         'fallback, %d protocol fallback, hint %d hit %d '
+                         'miss' % (self._listen_port, count,
+                                   stats['obfs_fallback'],
+                                   stats['protocol_fallback'],
+                                   stats['hint_hit'], stats['hint_miss']))
+
+    def _log_timeout_stats(self):
+        # handlers timed out in each stage of TIMEOUT_STAGES, a stage that
+        # keeps growing hints at a timeout that is too short
+        now = time.time()
+        last_time, last_count = self._timeout_stats_logged
+        count = sum(self.timeout_stats.values())
+        if count != last_count and \
+                now - last_time >= TIMEOUT_STATS_INTERVAL:
+            self._timeout_stats_logged = (now, count)
+            logging.info('port %d timeouts: %s' % (
+                self._listen_port,
+                ', '.join('%s %d' % (stage, self.timeout_stats[stage])
+                          for stage, key in TIMEOUT_STAGES)))
 
     def _sweep_timeout(self):
-        self._timeout_cache.sweep()
+        for timeout_cache in self._timeout_caches.values():
+            timeout_cache.sweep()
+        self._log_timeout_stats()
+        if self._compatible_cache is not None:
+            self._sweep_compatible()
+
+    def _timeout_callback(self, stage):
+        def close(client):
+            self.timeout_stats[stage] += 1
+            self._close_tcp_client(client)
+        return close
 
     def _close_tcp_client(self, client):
         if client.remote_address:
-            logging.debug('timed out: %s:%d' %
-                         client.remote_address)
+            logging.debug('timed out in %s: %s:%d' %
+                          ((client.timeout_stage(),) + client.remote_address))
         else:
-            logging.debug('timed out')
+            logging.debug('timed out in %s' % (client.timeout_stage(),))
         client.destroy()
 
     def handle_event(self, sock, fd, event):
@@ -1475,16 +1826,23 @@ class TCPRelay(object):
             try:
                 logging.debug('accept')
                 conn = self._server_socket.accept()
+                if self._reject_new and not self.priority_uids:
+                    conn[0].close()
+                    self.rejected_connections += 1
+                    return handle
                 handler = TCPRelayHandler(self, self._fd_to_handlers,
                                 self._eventloop, conn[0], self._config,
                                 self._dns_resolver, self._is_local)
-                if handler.stage() == STAGE_DESTROYED:
-                    conn[0].close()
             except (OSError, IOError) as e:
                 error_no = eventloop.errno_from_exception(e)
                 if error_no in (errno.EAGAIN, errno.EINPROGRESS,
                                 errno.EWOULDBLOCK):
                     return
+                elif error_no in (errno.EMFILE, errno.ENFILE) and \
+                        handler is None:
+                    # out of fds, wait for the admission controller
+                    # instead of spinning on the listening socket
+                    self.set_pressure(True, True, False)
                 else:
                     shell.print_exception(e)
                     if self._config['verbose']:
@@ -1524,11 +1882,21 @@ class TCPRelay(object):
                 logging.info('closed TCP port %d', self._listen_port)
             for handler in list(self._fd_to_handlers.values()):
                 handler.destroy()
+            self._release_crypto_pool()
         self._sweep_timeout()
 
+    def _release_crypto_pool(self):
+        # after the handlers are gone, the last relay on the loop closes
+        # the shared pool
+        if self.crypto_pool is not None:
+            self.crypto_pool.release()
+            self.crypto_pool = None
+
     def close(self, next_tick=False):
         logging.debug('TCP close')
         self._closed = True
+        if self.admission is not None:
+            self.admission.remove_relay(self)
         if not next_tick:
             if self._eventloop:
                 self._eventloop.remove_periodic(self.handle_periodic)
@@ -1536,3 +1904,4 @@ class TCPRelay(object):
             self._server_socket.close()
             for handler in list(self._fd_to_handlers.values()):
                 handler.destroy()
+            self._release_crypto_pool()
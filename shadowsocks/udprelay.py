@@ -72,7 +72,8 @@ import binascii
 import traceback
 import threading
 
-from shadowsocks import encrypt, obfs, eventloop, lru_cache, common, shell
+from shadowsocks import encrypt, obfs, eventloop, lru_cache, common, shell, \
+    pipeline
 from shadowsocks.common import pre_parse_header, parse_header, pack_addr
 
 # for each handler, we have 2 stream directions:
@@ -159,6 +160,7 @@ class UDPRelay(object):
         self.server_transfer_ul = 0
         self.server_transfer_dl = 0
         self.server_users = {}
+        self.server_user_keys = {}
         self.server_user_transfer_ul = {}
         self.server_user_transfer_dl = {}
 
@@ -171,17 +173,21 @@ class UDPRelay(object):
         server_info.host = self._listen_addr
         server_info.port = self._listen_port
         server_info.users = self.server_users
+        server_info.user_keys = self.server_user_keys
         server_info.protocol_param = config['protocol_param']
         server_info.obfs_param = ''
         server_info.iv = b''
         server_info.recv_iv = b''
         server_info.key_str = common.to_bytes(config['password'])
         server_info.key = encrypt.encrypt_key(self._password, self._method)
+        server_info.server_key = encrypt.UserKey(server_info.key)
         server_info.head_len = 30
         server_info.tcp_mss = 1452
         server_info.buffer_size = BUF_SIZE
         server_info.overhead = 0
         self._protocol.set_server_info(server_info)
+        self._pipeline = pipeline.UDPPipeline(self._protocol, self._method,
+                                              is_local)
 
         self._sockets = set()
         self._fd_to_handlers = {}
@@ -267,12 +273,17 @@ class UDPRelay(object):
             self.add_user(uid, users[id])
 
     def add_user(self, uid, cfg): # user: binstr[4], passwd: str
-        passwd = cfg['password']
-        self.server_users[uid] = common.to_bytes(passwd)
+        passwd = common.to_bytes(cfg['password'])
+        if self.server_users.get(uid, None) != passwd or \
+                uid not in self.server_user_keys:
+            self.server_user_keys[uid] = encrypt.UserKey(passwd)
+        self.server_users[uid] = passwd
 
     def del_user(self, uid):
         if uid in self.server_users:
             del self.server_users[uid]
+        if uid in self.server_user_keys:
+            del self.server_user_keys[uid]
 
     def add_transfer_u(self, user, transfer):
         if user is None:
@@ -353,14 +364,16 @@ class UDPRelay(object):
             else:
                 data = data[3:]
         else:
-            ref_iv = [0]
-            data = encrypt.encrypt_all_iv(self._protocol.obfs.server_info.key, self._method, 0, data, ref_iv)
+            try:
+                data, uid = self._pipeline.recv(data)
+            except Exception as e:
+                # AEAD methods reject forged or truncated packets
+                logging.debug('UDP handle_server: %s' % (e,))
+                return
             # decrypt data
             if not data:
                 logging.debug('UDP handle_server: data is empty after decrypt')
                 return
-            self._protocol.obfs.server_info.recv_iv = ref_iv[0]
-            data, uid = self._protocol.server_udp_post_decrypt(data)
 
         #logging.info("UDP data %s" % (binascii.hexlify(data),))
         if not self._is_local:
@@ -452,11 +465,7 @@ class UDPRelay(object):
             self._cache_dns_client.clear(16)
 
             if self._is_local:
-                ref_iv = [encrypt.encrypt_new_iv(self._method)]
-                self._protocol.obfs.server_info.iv = ref_iv[0]
-                data = self._protocol.client_udp_pre_encrypt(data)
-                #logging.debug("%s" % (binascii.hexlify(data),))
-                data = encrypt.encrypt_all_iv(self._protocol.obfs.server_info.key, self._method, 1, data, ref_iv)
+                data = self._pipeline.send(data)
                 if not data:
                     return
             else:
@@ -507,21 +516,17 @@ class UDPRelay(object):
                 # drop
                 return
             data = pack_addr(r_addr[0]) + struct.pack('>H', r_addr[1]) + data
-            ref_iv = [encrypt.encrypt_new_iv(self._method)]
-            self._protocol.obfs.server_info.iv = ref_iv[0]
-            data = self._protocol.server_udp_pre_encrypt(data, client_uid)
-            response = encrypt.encrypt_all_iv(self._protocol.obfs.server_info.key, self._method, 1,
-                                           data, ref_iv)
+            response = self._pipeline.send(data, client_uid)
             if not response:
                 return
         else:
-            ref_iv = [0]
-            data = encrypt.encrypt_all_iv(self._protocol.obfs.server_info.key, self._method, 0,
-                                       data, ref_iv)
+            try:
+                data, uid = self._pipeline.recv(data)
+            except Exception as e:
+                logging.debug('UDP handle_client: %s' % (e,))
+                return
             if not data:
                 return
-            self._protocol.obfs.server_info.recv_iv = ref_iv[0]
-            data = self._protocol.client_udp_post_decrypt(data)
             header_result = parse_header(data)
             if header_result is None:
                 return